@@ -1,204 +1,175 @@
 import os
-from openai import OpenAI
-from dotenv import load_dotenv
 from rich.console import Console
+from _get_client import get_llm_client
+from _instrument import add_recorder, track_llm_call
+from _llm_config import get_llm_config, key_status
+from _catalog import Catalog
+from _tools import ToolRegistry
 
 console = Console()
 
 
-# Load environment variables in a file called .env
-# Print the key prefixes to help with any debugging
-load_dotenv()
-
-
-def get_llm_client(llm_choice):
-    if llm_choice == "GROQ":
-        client = OpenAI(
-            base_url="https://api.groq.com/openai/v1",
-            api_key=os.environ.get("GROQ_API_KEY"),
-        )
-        return client
-    elif llm_choice == "OPENAI":
-        load_dotenv()  # load environment variables from .env fil
-        client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-        return client
-    else:
-        raise ValueError("Invalid LLM choice. Please choose 'GROQ' or 'OPENAI'.")
-
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-
+# The provider's client and model come from _llm_config.py - the .env file is loaded there.
+# Only whether each API key is set is printed, never the keys themselves.
 LLM_CHOICE = "OPENAI"
 # LLM_CHOICE = "GROQ"
 
-if OPENAI_API_KEY:
-    print(f"OPENAI_API_KEY exists and begins {OPENAI_API_KEY[:14]}...")
-else:
-    print("OPENAI_API_KEY not set")
-
-if GROQ_API_KEY:
-    print(f"GROQ_API_KEY exists and begins {GROQ_API_KEY[:14]}...")
-else:
-    print("GROQ_API_KEY not set")
-
-
-client = get_llm_client(LLM_CHOICE)
-if LLM_CHOICE == "GROQ":
-    MODEL = "llama-3.3-70b-versatile"
-else:
-    MODEL = "gpt-4o-mini"
+config = get_llm_config(provider=LLM_CHOICE)
+client = get_llm_client(config.provider)
+MODEL = config.model
 
+print(key_status())
 print(f"LLM_CHOICE: {LLM_CHOICE} - MODEL: {MODEL}")
-# See card in ipynb version...
-
-
-def get_product_price(product):
-    if product == "bike":
-        return 100
-    if product == "tv":
-        return 200
-    if product == "laptop":
-        return 300
-    return None
 
+# Print the latency and token usage of every LLM call the agent makes.
+add_recorder(
+    lambda call: console.print(
+        f"[dim]LLM call {call.provider}/{call.model}: {call.latency:.2f}s, "
+        f"{call.prompt_tokens} prompt + {call.completion_tokens} completion tokens {call.error}[/]"
+    )
+)
+# See card in ipynb version...
 
-def calculate_total(amount):
-    amount = int(amount)
-    return int(amount * 1.2)
+# The tools are registered so the model can call them natively (tools=/tool_calls) - no text parsing or eval.
+tools = ToolRegistry(timeout=10)
+
+
+# Products come from the catalog (see _catalog.py) - loaded into memory once and reloaded when the
+# database changes, so one tool call can price a whole basket however large the catalog is.
+# The default database sits next to this script, wherever it is run from.
+CATALOG_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.sqlite3")
+catalog = Catalog(os.environ.get("CATALOG_DB", CATALOG_DB))
+if not len(catalog):
+    catalog.upsert([("BIKE-001", "bike", 100), ("TV-001", "tv", 200), ("LAPTOP-001", "laptop", 300)])
+
+
+@tools.register
+def get_product_prices(products: list[str]) -> dict:
+    """Prices before VAT of one or more products, by name or SKU. null means the product is not sold."""
+    return catalog.prices(products)
+
+
+@tools.register(
+    parameters={
+        "type": "object",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "product": {"type": "string"},
+                        "quantity": {"type": "integer"},
+                    },
+                    "required": ["product", "quantity"],
+                },
+            }
+        },
+        "required": ["items"],
+    }
+)
+def calculate_totals(items: list) -> dict:
+    """Totals including VAT for a basket of products and quantities - line totals and the grand total."""
+    return catalog.totals(items)
 
 
 class Agent:
-    def __init__(self, client: client, system: str = "") -> None:
+    def __init__(self, client: client, system: str = "", tools: ToolRegistry = None) -> None:
         self.client = client
         self.system = system
+        self.tools = tools
         self.messages: list = []
         if self.system:
             self.messages.append({"role": "system", "content": system})
 
     def __call__(self, message=""):
-        """Sets the message and executes the agent"""
+        """Sets the message and executes the agent - returns the answer, or None if tools were run"""
         if message:
             self.messages.append({"role": "user", "content": message})
-            result = self.execute()
-            self.messages.append({"role": "assistant", "content": result})
-            return result
-        else:
-            print("NO MESSAGE")
+        result = self.execute()
+        message = {"role": "assistant", "content": result.content}
+        if result.tool_calls:
+            message["tool_calls"] = [tool_call.model_dump() for tool_call in result.tool_calls]
+        self.messages.append(message)
+        if result.tool_calls:
+            # Every tool asked for in this turn runs at once and the results go back in the next request.
+            observations = self.tools.run(result.tool_calls)
+            for tool_call, observation in zip(result.tool_calls, observations):
+                console.print(
+                    f"[green]OBSERVATION: {tool_call.function.name}({tool_call.function.arguments}) "
+                    f"=> {observation['content']}[/]"
+                )
+            self.messages.extend(observations)
+            return None
+        return result.content
 
     def execute(self):
-        """Executes the ageLLM request and returns the result"""
-        completion = client.chat.completions.create(model=MODEL, messages=self.messages)
-        return completion.choices[0].message.content
+        """Executes the LLM request and returns the assistant message"""
+        options = {"tools": self.tools.schemas()} if self.tools else {}
+        with track_llm_call(LLM_CHOICE, MODEL) as call:
+            completion = self.client.chat.completions.create(
+                model=MODEL, messages=self.messages, **options
+            )
+            call.usage(completion.usage)
+        return completion.choices[0].message
 
 
 system_prompt = """
-You run in a loop of THOUGHT, ACTION, OBSERVATION.
-
-You have a THOUGHT of what you need to do, then you take an ACTION using tools provided, then you get an OBSERVATION. YOu keep repeating this until you have an ANSWER. Then you return the ANSWER and break out of the loop.
-
-You have two tools available for your ACTIONS - **calculate_total** and **get_product_price** so that you can get the total price of an item requested by the user.
-
-# 1. calculate_total:
-
-if amount = 200
-then calculate_total(amount)
-return amount * 1.2
-
-Runs the calculate_total function and returns a JSON FORMAT output as follows:
-{"result": 240, "fn": "calculate_total", "next": "PAUSE"}
-
-# 2. get_product_price:
-
-This uses the get_product_price function and passes in the value of the product
-e.g. get_product_price('bike')
-
-This uses the get_product_price with a product = 'bike', finds the price of the bike and then returns a JSON FORMAT output as follows:
-{"result": 200, "fn": "get_product_price", "next": "PAUSE"}
-
- # Here is an example session:
-
-User Question: What is total cost of a bike including VAT?
-
-AI Response: THOUGHT: I need to find the cost of a bike|ACTION|get_product_price|bike
-
-You will be called again with the result of get_product_price as the OBSERVATION and will have OBSERVATION|200 sent as another LLM prompt along with previous messages.
-
-Then the next message will be:
-
-THOUGHT: I need to calculate the total including the VAT|ACTION|calculate_total|200
-
-The result wil be passed as another prompt as OBSERVATION|240 along with previous messages.
-
-If you have the ANSWER, output it as the ANSWER in this format:
-
-ANSWER|The price of the bike including VAT is 240
+You are a shopping assistant that answers questions about the total price of products including VAT.
 
+Use the tools provided to look up product prices and to calculate totals - never guess a price.
+Both tools take every product in the question at once, so a whole basket needs a single call:
+calculate_totals gives the totals including VAT directly, get_product_prices is only for prices before VAT.
+When you have the answer, reply with it in one sentence.
 """
 
 
 # A bit like recursion, we are going to call the agent in a loop until we get an answer.
 def loop(max_iterations=10, prompt: str = ""):
-    agent = Agent(client=client, system=system_prompt)
-    tools = ["calculate_total", "get_product_price"]
+    agent = Agent(client=client, system=system_prompt, tools=tools)
     console.print("[dark_orange]\nSTARTING LOOP...\n[/]")
     i = 0
+    result = None
     while i < max_iterations:
         i += 1
         #
-        # This is the AI bit, sending the output from the previous prompt as the prompt for the next prompt.
+        # This is the AI bit - each round trip either asks for tools, whose OBSERVATIONS are added
+        # to the messages for the next request, or returns the ANSWER.
         # -------------------------
         #
         result = agent(prompt)
+        prompt = ""
         #
         # -------------------------
         #
-        # Here we loop over responses - if we have a THOUGHT/ACTION, we need to extract the function and arguments - if we have ANSWER, we need to return it and break from loop.
-        if "ACTION" in result:
-            #
-            # extract function and arguments using the fact that we specified th | symbol as the delimiter
-            next = result.split("|")
-            #
-            print(next)
-            next_function = next[2].strip()  # next[2] has the function to be used
-            next_arg = str(next[3]).strip()  # next[3] has the argument to be used
-            #
-            # if a tool/function exists - run it and prepend with OBSERVATION as we descrbed in system prompt
-            #
-            if next_function in tools:
-                result_tool = eval(f"{next_function}('{next_arg}')")
-                ######################################
-                # OBSERVATIONS passed back into prompt in the format OBSERVATION|result as specified in prompt template
-                prompt = f"OBSERVATION: {result_tool}"
-                ######################################
-                console.print(f"[green]{prompt}[/]")
-                print("------------------------------\n")
-            else:
-                prompt = "OBSERVATION: Tool not found"
-            continue
-        #
-        # if we have a final ANSWER, store it and break out of loop
-        #
-        if "ANSWER" in result:
-            #
+        if result is not None:
             print("======================================")
-            console.print(f"[cyan bold]Answer found:\n\t{result}\n[/]")
+            console.print(f"[cyan bold]Answer found after {i} LLM calls:\n\t{result}\n[/]")
             print("======================================")
             break  # we have an answer so break out of loop
+        print("------------------------------\n")
+    return result
+
+
+def answer(question: str) -> str:
+    """One question in, one answer out - used by _batch.py to run many questions concurrently."""
+    result = loop(prompt=question)
+    if result is None:
+        raise RuntimeError("No answer within max_iterations")
     return result
 
 
 # Let's run it...
+# Importing this file (e.g. from _batch.py) does not run the example question.
 
-question = "What is cost of a tv including VAT?"
-console.print(f"\nQuestion is: [cyan italic]{question}\n[/]")  # end of loop
+if __name__ == "__main__":
+    question = "What is cost of a bike, a tv and two laptops including VAT?"
+    console.print(f"\nQuestion is: [cyan italic]{question}\n[/]")  # end of loop
 
-loop(prompt=question)
+    loop(prompt=question)
 
 
-# NB We used
-# 'THOUGHT: I need to calculate the total including the VAT|ACTION|calculate_total|200' a
-# as an instruction to the agent forthe output format
-# and
-# 'ANSWER|The price of the bike including VAT is 240'
-# as an instruction to the agent for the output format wht it has the answer.
+# NB Before native tool calling we asked for
+# 'THOUGHT: I need to calculate the total including the VAT|ACTION|calculate_total|200'
+# in the system prompt, split it on | and eval'd the function - one tool per LLM round trip.
+# Now the model returns structured tool_calls, possibly several per turn, and they run concurrently.
@@ -0,0 +1,169 @@
+"""
+Run many agent questions concurrently, with checkpointing.
+
+Questions are read from a JSONL file, one {"id": ..., "question": ...} object per line (id
+defaults to the line number). Up to `concurrency` questions are answered at once and each result
+is appended to the output JSONL file as soon as it finishes, so the output file is also the
+checkpoint: running the same command again skips every question already answered.
+
+    python _batch.py questions.jsonl results.jsonl --concurrency 16
+    python _batch.py questions.jsonl results.jsonl --retry-errors  # resume, retrying failures
+
+or from Python:
+
+    summary = asyncio.run(run_batch("questions.jsonl", "results.jsonl", answer, concurrency=16))
+
+answer(question) can be a plain function - it runs on a thread pool sized to the concurrency, so
+the synchronous Agent in 09_OPENAI_planning_agent_w_loop.py works as it is - or a coroutine function.
+"""
+
+import argparse
+import asyncio
+import importlib
+import inspect
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_questions(path: str) -> list:
+    questions = []
+    with open(path, encoding="utf-8") as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"question": item}
+            item.setdefault("id", line_number)
+            questions.append(item)
+    return questions
+
+
+def read_checkpoint(path: str, retry_errors: bool = False) -> dict:
+    """Latest result of each id in the output file - leaving out the failed ones if retry_errors."""
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short when the last run was killed
+            results[result["id"]] = result
+    if retry_errors:
+        results = {id: result for id, result in results.items() if not result.get("error")}
+    return results
+
+
+def write_checkpoint(path: str, results: dict) -> None:
+    """Replace the output file with one line per result, atomically."""
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as file:
+        for result in results.values():
+            file.write(json.dumps(result, ensure_ascii=False) + "\n")
+    os.replace(temporary, path)
+
+
+async def iter_batch(questions: list, answer, concurrency: int = 8):
+    """Answer questions concurrently and yield each result as it finishes (not in input order)."""
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in questions:
+        queue.put_nowait(item)
+    results: asyncio.Queue = asyncio.Queue()
+    executor = ThreadPoolExecutor(concurrency, thread_name_prefix="batch")
+    loop = asyncio.get_running_loop()
+
+    async def worker():
+        while not queue.empty():
+            item = queue.get_nowait()
+            started = time.perf_counter()
+            result = {"id": item["id"], "question": item["question"], "answer": None, "error": None}
+            try:
+                if inspect.iscoroutinefunction(answer):
+                    result["answer"] = await answer(item["question"])
+                else:
+                    result["answer"] = await loop.run_in_executor(executor, answer, item["question"])
+            except Exception as exc:
+                result["error"] = f"{type(exc).__name__}: {exc}"
+            result["latency"] = round(time.perf_counter() - started, 3)
+            await results.put(result)
+
+    # A fixed set of workers rather than one task per question keeps memory flat for big batches.
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(questions)))]
+    try:
+        for _ in range(len(questions)):
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_batch(
+    input_path: str,
+    output_path: str,
+    answer,
+    concurrency: int = 8,
+    retry_errors: bool = False,
+    on_result=None,
+) -> dict:
+    """Answer every question in input_path not yet in output_path, appending results to it."""
+    done = read_checkpoint(output_path, retry_errors)
+    if os.path.exists(output_path):
+        # Drops the failures about to be retried and any line cut short, so the output keeps one
+        # line per id and new results are not appended to a partial line.
+        write_checkpoint(output_path, done)
+    items = read_questions(input_path)
+    questions = [item for item in items if item["id"] not in done]
+    summary = {"skipped": len(items) - len(questions), "answered": 0, "errors": 0, "seconds": 0.0}
+    started = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as output:
+        async for result in iter_batch(questions, answer, concurrency):
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()  # the checkpoint - a killed run loses at most the questions in flight
+            summary["errors" if result["error"] else "answered"] += 1
+            if on_result:
+                on_result(result)
+    summary["seconds"] = round(time.perf_counter() - started, 2)
+    return summary
+
+
+def load_function(target: str):
+    """module:function, e.g. 09_OPENAI_planning_agent_w_loop:answer."""
+    module_name, _, function_name = target.partition(":")
+    sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions concurrently")
+    parser.add_argument("input", help="JSONL file of {'id': ..., 'question': ...} lines")
+    parser.add_argument("output", help="JSONL results file, also used to resume")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--retry-errors", action="store_true", help="answer failed questions again")
+    parser.add_argument(
+        "--function",
+        default="09_OPENAI_planning_agent_w_loop:answer",
+        help="module:function that answers one question",
+    )
+    args = parser.parse_args()
+
+    def show(result):
+        status = f"ERROR {result['error']}" if result["error"] else result["answer"]
+        print(f"[{result['id']}] {result['latency']:.2f}s {status}", flush=True)
+
+    summary = asyncio.run(
+        run_batch(
+            args.input,
+            args.output,
+            load_function(args.function),
+            args.concurrency,
+            args.retry_errors,
+            on_result=show,
+        )
+    )
+    print(summary)
@@ -0,0 +1,120 @@
+"""
+A product catalog for the agent tools.
+
+Products live in a SQLite table so they can be edited or bulk loaded by anything that can write
+to the database. Lookups never query it though: the catalog is loaded once into a dict from
+name/SKU to row and NumPy arrays of prices and VAT rates, and reloaded only when the database has
+changed - checked with PRAGMA data_version, which costs microseconds. Pricing a whole basket is
+one dict lookup per item and one vectorised multiply, however many SKUs the catalog holds.
+
+    catalog = Catalog("catalog.sqlite3")
+    catalog.upsert([("SKU-1", "bike", 100), ("SKU-2", "tv", 200)])
+    catalog.prices(["bike", "tv"])  # {"bike": 100.0, "tv": 200.0}
+    catalog.totals([{"product": "tv", "quantity": 2}])
+"""
+
+import sqlite3
+import threading
+
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS product (
+    sku TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    price REAL NOT NULL,
+    vat_rate REAL NOT NULL DEFAULT 0.2
+)
+"""
+
+
+def normalize_name(name: str) -> str:
+    return " ".join(str(name).lower().split())
+
+
+class Catalog:
+    def __init__(self, path: str = ":memory:", vat_rate: float = 0.2) -> None:
+        self.vat_rate = vat_rate
+        # One connection shared by the tool threads - every use is under the lock.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(SCHEMA)
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._load()
+
+    def _load(self) -> None:
+        rows = self._connection.execute("SELECT sku, name, price, vat_rate FROM product").fetchall()
+        index = {}
+        for i, (sku, name, _, _) in enumerate(rows):
+            index[normalize_name(sku)] = i
+            index[normalize_name(name)] = i
+        self.names = [name for _, name, _, _ in rows]
+        self.price_array = np.array([row[2] for row in rows], dtype=np.float64)
+        self.vat_array = np.array([row[3] for row in rows], dtype=np.float64)
+        self.index = index
+        self._data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def _refresh(self) -> None:
+        # Reload the in-memory index if another connection has changed the database.
+        if self._connection.execute("PRAGMA data_version").fetchone()[0] != self._data_version:
+            self._load()
+
+    def upsert(self, products) -> None:
+        """Insert or update (sku, name, price) or (sku, name, price, vat_rate) rows."""
+        rows = [(*product, self.vat_rate)[:4] for product in products]
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT INTO product (sku, name, price, vat_rate) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(sku) DO UPDATE SET "
+                    "name = excluded.name, price = excluded.price, vat_rate = excluded.vat_rate",
+                    rows,
+                )
+            # data_version only changes for other connections' commits, so reload our own now.
+            self._load()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self.names)
+
+    def _lookup(self, products: list) -> np.ndarray:
+        # Row of each product name or SKU, -1 when it is not in the catalog. Called under the lock.
+        self._refresh()
+        rows = []
+        for product in products:
+            key = normalize_name(product)
+            row = self.index.get(key)
+            if row is None and key.endswith("s"):
+                row = self.index.get(key[:-1])  # "laptops"
+            rows.append(-1 if row is None else row)
+        return np.array(rows, dtype=np.int64)
+
+    def prices(self, products: list) -> dict:
+        """Price before VAT of each product, None when it is not in the catalog."""
+        with self._lock:
+            rows = self._lookup(products)
+            prices = [float(self.price_array[row]) if row >= 0 else None for row in rows]
+        return dict(zip(products, prices))
+
+    def totals(self, items: list) -> dict:
+        """
+        Line totals including VAT and the grand total for a basket of
+        {"product": name or SKU, "quantity": n} items. Unknown products are listed in "missing".
+        """
+        quantities = np.array([item.get("quantity", 1) for item in items], dtype=np.float64)
+        with self._lock:
+            rows = self._lookup([item["product"] for item in items])
+            found = rows >= 0
+            prices = self.price_array[rows[found]] * (1 + self.vat_array[rows[found]])
+        lines = np.zeros(len(items))
+        lines[found] = (prices * quantities[found]).round(2)
+        return {
+            "items": [
+                {"product": item["product"], "quantity": item.get("quantity", 1), "total": line}
+                for item, line, ok in zip(items, lines.tolist(), found)
+                if ok
+            ],
+            "missing": [item["product"] for item, ok in zip(items, found) if not ok],
+            "total": round(float(lines.sum()), 2),
+        }
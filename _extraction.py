@@ -0,0 +1,158 @@
+"""
+Teachability fact extraction from 06_extraction_teachability.ipynb, for whole transcript archives.
+
+extract_facts() asks the LLM for the summary and facts of one conversation as JSON and validates
+the reply against ExtractionSchema. When it does not validate, the model is shown exactly which
+fields were wrong and asked again, instead of the whole extraction being retried or json.loads
+failing later.
+
+extract_stream() runs extract_facts over any iterable of (key, conversation) pairs on a thread
+pool. Only `concurrency` conversations are in flight at a time and the iterable is consumed lazily,
+so a database cursor or a large JSONL file is streamed rather than loaded:
+
+    for key, result, error in extract_stream(sources, lambda text: extract_facts(client, MODEL, text)):
+        ...
+"""
+
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from pydantic import BaseModel, ValidationError, model_validator
+
+from _instrument import track_llm_call
+
+SYSTEM_MESSAGE = """
+You are a teachability agent. You examine a conversation listed between <conv> and </conv> and output a list of pertinent facts,
+as well as a concise summary.
+The OUTPUT FORMAT *must have* in the following JSON FORMAT:
+
+{
+    "summary": <SUMMARY>,
+    "number_of_facts": <NUMBER_OF_FACTS>,
+    "facts": [<FACTS>]
+}
+
+A fact is a dictionary with the following keys: "fact" and "category".
+
+Here are some examples of facts:
+
+{"fact": "Charles is a vegan and won't eat any meat.", "category": "personal"}
+{"fact": "Charles works in Brighton", "category": "work"}
+{"fact": "They have four dogs", "category": "pets"}
+
+## NOT A FACT
+This is not a fact as it does not refer to a person:
+"London is a city and the capital of England"
+
+## NUMBER_OF_FACTS
+<NUMBER_OF_FACTS> stores the number of facts in the "facts" list
+*Be as specific as you can about the categories*
+"""
+
+
+class FactSchema(BaseModel):
+    fact: str
+    category: str
+
+
+class ExtractionSchema(BaseModel):
+    summary: str
+    number_of_facts: int
+    facts: list[FactSchema]
+
+    @model_validator(mode="after")
+    def count_facts(self):
+        if self.number_of_facts != len(self.facts):
+            raise ValueError(
+                f"number_of_facts is {self.number_of_facts} "
+                f"but the facts list has {len(self.facts)} items"
+            )
+        return self
+
+
+def describe_errors(error: ValidationError) -> str:
+    """One line per problem, e.g. "facts.2.category: Field required"."""
+    return "\n".join(
+        f"{'.'.join(str(part) for part in problem['loc']) or 'JSON'}: {problem['msg']}"
+        for problem in error.errors()
+    )
+
+
+def extract_facts(
+    client, model: str, conversation: str, max_reasks: int = 2, provider: str = "groq"
+) -> ExtractionSchema:
+    """Validated summary and facts of one conversation. Raises ValidationError after max_reasks."""
+    messages = [
+        # The conversation goes in the user message so the system message is a cacheable prefix.
+        {"role": "system", "content": SYSTEM_MESSAGE},
+        {"role": "user", "content": f"<conv>{conversation}</conv>"},
+    ]
+    for attempt in range(max_reasks + 1):
+        with track_llm_call(provider, model) as call:
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0,
+                response_format={"type": "json_object"},
+            )
+            call.usage(response.usage)
+        reply = response.choices[0].message.content or ""
+        try:
+            return ExtractionSchema.model_validate_json(reply)
+        except ValidationError as error:
+            if attempt == max_reasks:
+                raise
+            # A targeted re-ask: the model keeps its own answer and only fixes what is listed.
+            messages += [
+                {"role": "assistant", "content": reply},
+                {
+                    "role": "user",
+                    "content": "That JSON does not match the OUTPUT FORMAT:\n"
+                    f"{describe_errors(error)}\n"
+                    "Reply with the corrected JSON only.",
+                },
+            ]
+
+
+def extract_stream(sources, extract, concurrency: int = 8):
+    """
+    Yield (key, ExtractionSchema, None) or (key, None, exception) for each (key, conversation) in
+    sources, in completion order, with at most `concurrency` extractions running at once.
+    key can be anything hashable that the caller needs back with the result.
+    """
+    sources = iter(sources)
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="extract") as executor:
+        running = {}
+
+        def fill():
+            # Top the pool back up - the next source is only read when a slot is free.
+            while len(running) < concurrency:
+                try:
+                    key, conversation = next(sources)
+                except StopIteration:
+                    return
+                running[executor.submit(extract, conversation)] = key
+
+        fill()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                if future.exception() is None:
+                    yield key, future.result(), None
+                else:
+                    yield key, None, future.exception()
+            fill()
+
+
+def read_jsonl(path: str):
+    """(key, conversation) pairs from {"id": ..., "text": ...} or {"id": ..., "messages": [...]} lines."""
+    with open(path, encoding="utf-8") as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            text = item.get("text") or "\n".join(
+                f"{message['role']}: {message['content']}" for message in item.get("messages", [])
+            )
+            yield str(item.get("id", line_number)), text
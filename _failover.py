@@ -0,0 +1,434 @@
+"""
+Hedged requests and failover between providers.
+
+A HedgedDispatcher is given an ordered list of (provider, model) routes. A completion is sent to
+the first route whose circuit breaker is closed. If that request fails, or its first token has
+not arrived within the hedge delay, the same request is also sent to the next route. Whichever
+finishes first is returned and the other is cancelled.
+
+The hedge delay is a percentile (p95 by default) of the primary's recent times to first token,
+so only its slow tail is hedged - about 5% extra requests rather than double. A provider that
+keeps failing trips its circuit breaker and is skipped until reset_timeout has passed, then
+tried again by a single request.
+
+    dispatcher = HedgedDispatcher([("groq", "llama-3.3-70b-versatile"), ("openai", "gpt-4o-mini")])
+    result = dispatcher.complete(messages)          # from a thread
+    result = await dispatcher.acomplete(messages)   # from an event loop
+    result.text, result.provider, result.hedged
+"""
+
+import asyncio
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+from _get_client import get_async_llm_client, get_llm_client
+from _instrument import track_llm_call
+
+
+class HedgeCancelled(Exception):
+    """The other route finished first."""
+
+
+class CircuitOpen(Exception):
+    """The circuit breaker of every route (or of the one route tried) is not letting requests through."""
+
+
+@dataclass
+class HedgedResult:
+    provider: str
+    model: str
+    text: str
+    usage: dict = None
+    hedged: bool = False
+
+
+class CircuitBreaker:
+    """
+    Closed until failure_threshold failures in a row, then open for reset_timeout seconds.
+
+    After that it is half-open: a single trial request is let through and the others are refused
+    until its result closes or re-opens the breaker.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing_since = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def _admits(self, state: str) -> bool:
+        if state != "half-open":
+            return state == "closed"
+        # A trial that never reported back (a hung thread) is given up after reset_timeout.
+        return self.probing_since is None or (
+            time.monotonic() - self.probing_since >= self.reset_timeout
+        )
+
+    def allow(self) -> bool:
+        """Whether a request would be let through now, without claiming the half-open trial."""
+        with self._lock:
+            return self._admits(self.state)
+
+    def acquire(self):
+        """
+        Let a request through: the state it was admitted in ("closed" or "half-open"), or None.
+        A half-open admission is the trial - it must end in record_success, record_failure or
+        release.
+        """
+        with self._lock:
+            state = self.state
+            if not self._admits(state):
+                return None
+            if state == "half-open":
+                self.probing_since = time.monotonic()
+            return state
+
+    def release(self) -> None:
+        """The trial ended without a verdict (it lost a hedge race) - let another request try."""
+        with self._lock:
+            self.probing_since = None
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing_since = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self.probing_since = None
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+class LatencyWindow:
+    """The last `size` times to first token of a provider."""
+
+    def __init__(self, size: int = 200) -> None:
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def percentile(self, percent: float):
+        samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+class Attempt:
+    """One route's request in complete() - cancelled from complete's thread when the other wins."""
+
+    def __init__(self) -> None:
+        self.first_token = threading.Event()
+        self.cancelled = False
+        self.stream = None
+        self._lock = threading.Lock()
+
+    def started(self, stream) -> None:
+        with self._lock:
+            self.stream = stream
+            cancelled = self.cancelled
+        if cancelled:
+            stream.close()
+            raise HedgeCancelled()
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            stream = self.stream
+        if stream is None:
+            # Still waiting for the response headers - httpx has no handle to close before then,
+            # so the attempt stops when they arrive (or at its timeout).
+            return
+        # Closing the response alone does not wake a read blocked on a hung provider - shutting
+        # the socket down does, so the thread and the connection are freed straight away.
+        network_stream = stream.response.extensions.get("network_stream")
+        sock = network_stream.get_extra_info("socket") if network_stream else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # already closed
+        stream.close()
+
+
+# Shared by every dispatcher in the process - a provider is healthy or not whoever calls it.
+_breakers: dict = {}
+_latencies: dict = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(provider: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+    with _registry_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(failure_threshold, reset_timeout)
+        return _breakers[provider]
+
+
+def get_latency(provider: str) -> LatencyWindow:
+    with _registry_lock:
+        return _latencies.setdefault(provider, LatencyWindow())
+
+
+def breaker_states() -> dict:
+    with _registry_lock:
+        return {provider: breaker.state for provider, breaker in _breakers.items()}
+
+
+class HedgedDispatcher:
+    def __init__(
+        self,
+        routes: list,
+        percentile: float = 95,
+        min_samples: int = 20,
+        default_delay: float = 2.0,
+        min_delay: float = 0.25,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        max_workers: int = 32,
+    ) -> None:
+        """
+        routes: [(provider, model), ...] in order of preference. Until a provider has min_samples
+        times to first token the hedge delay is default_delay, and it is never below min_delay.
+        """
+        self.routes = list(routes)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_workers = max_workers
+        self.stats = {"requests": 0, "hedged": 0, "secondary_wins": 0, "failovers": 0}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        return get_breaker(provider, self.failure_threshold, self.reset_timeout)
+
+    def available_routes(self) -> list:
+        routes = [route for route in self.routes if self.breaker(route[0]).allow()]
+        if not routes:
+            raise CircuitOpen(f"All providers are failing: {breaker_states()}")
+        return routes
+
+    def hedge_delay(self, provider: str) -> float:
+        latency = get_latency(provider)
+        if len(latency.samples) < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, latency.percentile(self.percentile))
+
+    def _admit(self, provider: str) -> bool:
+        # available_routes() only checked - another request may have taken the half-open trial
+        # since, and this one then fails fast.
+        admitted = self.breaker(provider).acquire()
+        if admitted is None:
+            raise CircuitOpen(f"{provider} is being tried again after failing")
+        return admitted == "half-open"
+
+    def _finished(self, provider: str, error, trial: bool) -> None:
+        # Losing the race is not the provider's fault.
+        if error is None:
+            self.breaker(provider).record_success()
+        elif not isinstance(error, (HedgeCancelled, asyncio.CancelledError)):
+            self.breaker(provider).record_failure()
+        elif trial:
+            self.breaker(provider).release()
+
+    # Threads - for the sync views and scripts
+
+    def _attempt(self, provider, model, messages, options, attempt: Attempt) -> HedgedResult:
+        parts = []
+        usage = None
+        error = None
+        first_token = attempt.first_token
+        try:
+            trial = self._admit(provider)
+        except CircuitOpen:
+            first_token.set()
+            raise
+        try:
+            with track_llm_call(provider, model) as call:
+                stream = get_llm_client(provider).chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    **options,
+                )
+                try:
+                    attempt.started(stream)
+                    for chunk in stream:
+                        if attempt.cancelled:
+                            raise HedgeCancelled()
+                        if chunk.usage:
+                            call.usage(chunk.usage)
+                            usage = chunk.usage.model_dump()
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if not first_token.is_set():
+                                call.first_token()
+                                get_latency(provider).add(call.time_to_first_token)
+                                first_token.set()
+                            parts.append(chunk.choices[0].delta.content)
+                finally:
+                    # Closing the stream drops the connection, which stops a cancelled generation.
+                    stream.close()
+            return HedgedResult(provider, model, "".join(parts).strip(), usage)
+        except BaseException as exc:
+            # A read broken off by Attempt.cancel() fails as a connection error - it still only
+            # lost the race.
+            error = HedgeCancelled() if attempt.cancelled else exc
+            raise
+        finally:
+            first_token.set()  # also wakes complete() when the attempt ends without a token
+            self._finished(provider, error, trial)
+
+    def complete(self, messages: list, **options) -> HedgedResult:
+        """Completion from the first healthy route, hedged to the next one when it is slow or fails."""
+        routes = self.available_routes()
+        self._count("requests")
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="hedge")
+
+        attempts = {}
+
+        def start(route):
+            attempt = Attempt()
+            future = self._executor.submit(self._attempt, *route, messages, options, attempt)
+            attempts[future] = attempt
+            return future
+
+        primary = start(routes[0])
+        pending = routes[1:]
+        if pending and not attempts[primary].first_token.wait(self.hedge_delay(routes[0][0])):
+            self._count("hedged")
+            start(pending.pop(0))
+
+        error = None
+        running = set(attempts)
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # The loser's connection is closed under it - its thread is not waited for.
+                    for other, attempt in attempts.items():
+                        if other is not future:
+                            attempt.cancel()
+                    result = future.result()
+                    result.hedged = len(attempts) > 1
+                    if future is not primary:
+                        self._count("secondary_wins")
+                    return result
+                error = future.exception()
+            if not running and pending:
+                # The request failed before the hedge delay - fail over straight away.
+                self._count("failovers")
+                running = {start(pending.pop(0))}
+        raise error
+
+    # asyncio - for the async views
+
+    async def _aattempt(self, provider, model, messages, options, first_token) -> HedgedResult:
+        parts = []
+        usage = None
+        error = None
+        try:
+            trial = self._admit(provider)
+        except CircuitOpen:
+            first_token.set()
+            raise
+        try:
+            with track_llm_call(provider, model) as call:
+                stream = await get_async_llm_client(provider).chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    **options,
+                )
+                try:
+                    async for chunk in stream:
+                        if chunk.usage:
+                            call.usage(chunk.usage)
+                            usage = chunk.usage.model_dump()
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if not first_token.is_set():
+                                call.first_token()
+                                get_latency(provider).add(call.time_to_first_token)
+                                first_token.set()
+                            parts.append(chunk.choices[0].delta.content)
+                finally:
+                    await stream.close()
+            return HedgedResult(provider, model, "".join(parts).strip(), usage)
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            first_token.set()
+            self._finished(provider, error, trial)
+
+    async def acomplete(self, messages: list, **options) -> HedgedResult:
+        """Async version of complete() - the losing request is cancelled."""
+        routes = self.available_routes()
+        self._count("requests")
+        tasks = {}
+
+        def start(route):
+            first_token = asyncio.Event()
+            task = asyncio.create_task(self._aattempt(*route, messages, options, first_token))
+            tasks[task] = first_token
+            return task
+
+        primary = start(routes[0])
+        pending = routes[1:]
+        if pending:
+            try:
+                await asyncio.wait_for(tasks[primary].wait(), self.hedge_delay(routes[0][0]))
+            except asyncio.TimeoutError:
+                self._count("hedged")
+                start(pending.pop(0))
+
+        error = None
+        running = set(tasks)
+        try:
+            while running:
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        result = task.result()
+                        result.hedged = len(tasks) > 1
+                        if task is not primary:
+                            self._count("secondary_wins")
+                        return result
+                    error = task.exception()
+                if not running and pending:
+                    self._count("failovers")
+                    running = {start(pending.pop(0))}
+            raise error
+        finally:
+            # Cancelling the loser closes its stream and connection.
+            for task in tasks:
+                task.cancel()
@@ -1,36 +1,175 @@
 import os
-import openai
-import groq
-from dotenv import load_dotenv
-from openai import OpenAI
+import atexit
+import asyncio
+import threading
+import weakref
 
+# The OpenAI SDK is imported when the first client is created, not when this module is imported -
+# Django imports it at startup for the metrics and most commands never call an LLM. httpx is loaded
+# at startup anyway: the views import _ratelimit, whose transports subclass httpx's.
+from _llm_config import PROVIDERS, get_llm_config, load_env
 
-def get_llm_client(llm_choice):
-    if llm_choice == "groq":
-        client = openai.OpenAI(
-            base_url="https://api.groq.com/openai/v1",
-            api_key=os.environ.get("GROQ_API_KEY"),
-        )
-        return client
-    elif llm_choice == "openai":
-        load_dotenv()  # load environment variables from .env file
-        openai.api_key = os.getenv(
-            "OPENAI_API_KEY"
-        )  # get API key from environment variables
-        client = OpenAI()
-        return client
-    else:
+# Connections are kept alive between calls so that only the first request pays for the TCP+TLS handshake.
+# The timeouts come from _llm_config (TIMEOUT and CONNECT_TIMEOUT).
+POOL_LIMITS = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 120.0,
+}
+
+# One long-lived client per (provider, base_url, api_key) shared by every thread in the process.
+_clients = {}
+_stats = {}
+_lock = threading.Lock()
+# Async clients hold connections bound to an event loop, so they are shared per running loop.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_base_url(llm_choice):
+    """
+    The provider's API URL. <PROVIDER>_BASE_URL in the environment overrides it,
+    e.g. GROQ_BASE_URL=http://127.0.0.1:8001/v1 to use the local stub server (_stub_server.py).
+    """
+    provider = llm_choice.lower()
+    if provider not in PROVIDERS:
         raise ValueError("Invalid LLM choice. Please choose 'groq' or 'openai'.")
+    return os.getenv(f"{provider.upper()}_BASE_URL") or PROVIDERS[provider]["base_url"]
+
+
+def _resolve(llm_choice, base_url=None, api_key=None):
+    load_env()
+    provider = llm_choice.lower()
+    base_url = base_url or get_base_url(provider)
+    api_key = api_key or os.getenv(PROVIDERS[provider]["api_key_env"])
+    return provider, base_url, api_key
+
+
+def _timeout(provider):
+    import httpx
+
+    config = get_llm_config(provider=provider)
+    return httpx.Timeout(config.timeout, connect=config.connect_timeout)
+
+
+def _count_request(stats):
+    def hook(request):
+        with _lock:
+            stats["requests"] += 1
+
+    return hook
+
+
+def get_llm_client(llm_choice, base_url=None, api_key=None):
+    """
+    Return the shared OpenAI compatible client for a provider.
+
+    The client is created on first use and then reused, so its keep-alive connection pool
+    survives across requests. The OpenAI client is thread safe.
+    """
+    key = _resolve(llm_choice, base_url, api_key)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            import httpx
+            from openai import OpenAI
+            from _ratelimit import RateLimitedTransport
+
+            provider, base_url, api_key = key
+            stats = {"provider": provider, "base_url": base_url, "requests": 0}
+            transport = httpx.HTTPTransport(limits=httpx.Limits(**POOL_LIMITS))
+            http_client = httpx.Client(
+                # Rate limits and retries are shared by every client and worker, see _ratelimit.py
+                transport=RateLimitedTransport(transport, provider),
+                timeout=_timeout(provider),
+                event_hooks={"request": [_count_request(stats)]},
+            )
+            client = OpenAI(
+                base_url=base_url, api_key=api_key, http_client=http_client, max_retries=0
+            )
+            _clients[key] = client
+            _stats[key] = (stats, transport)
+    return client
+
+
+def get_async_llm_client(llm_choice, base_url=None, api_key=None):
+    """
+    Return the shared AsyncOpenAI compatible client for a provider on the running event loop.
+
+    Used by the async views so a request awaits the LLM without holding a worker thread.
+    """
+    key = _resolve(llm_choice, base_url, api_key)
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(key)
+    if client is None:
+        import httpx
+        from openai import AsyncOpenAI
+        from _ratelimit import AsyncRateLimitedTransport
+
+        provider, base_url, api_key = key
+        transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(**POOL_LIMITS))
+        http_client = httpx.AsyncClient(
+            transport=AsyncRateLimitedTransport(transport, provider), timeout=_timeout(provider)
+        )
+        client = AsyncOpenAI(
+            base_url=base_url, api_key=api_key, http_client=http_client, max_retries=0
+        )
+        clients[key] = client
+    return client
+
+
+def warm_up_llm_clients(llm_choices):
+    """
+    Open a connection for each provider in the background so the first chat does not pay the handshake.
+
+    Listing models is free and failures are ignored - warm up is only an optimisation.
+    """
+
+    def warm_up(llm_choice):
+        try:
+            get_llm_client(llm_choice).models.list()
+        except Exception:
+            pass
+
+    for llm_choice in llm_choices:
+        threading.Thread(target=warm_up, args=(llm_choice,), daemon=True).start()
+
+
+def llm_pool_stats():
+    """Requests sent and open/idle pooled connections for every client created so far."""
+    pool_stats = []
+    with _lock:
+        items = list(_stats.values())
+    for stats, transport in items:
+        # httpcore keeps the live connections on the transport's pool.
+        connections = list(getattr(getattr(transport, "_pool", None), "connections", []))
+        pool_stats.append(
+            {
+                **stats,
+                "open_connections": len(connections),
+                "idle_connections": sum(1 for c in connections if c.is_idle()),
+            }
+        )
+    return pool_stats
+
+
+@atexit.register
+def close_llm_clients():
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        _stats.clear()
+    for client in clients:
+        client.close()
 
 
 if __name__ == "__main__":
-    # Example usage:
-    # llm_choice = "openai"
-    llm_choice = "groq"
-    if llm_choice == "groq":
-        model = "llama-3.3-70b-versatile"
-    else:
-        model = "gpt-4o-mini"
+    # Example usage - LLM_PROVIDER=openai in .env switches provider (see _llm_config.py).
+    config = get_llm_config()
+    llm_choice, model = config.provider, config.model
 
     system_message = """
     You are an assistant that is great at telling jokes.
@@ -54,5 +193,6 @@ if __name__ == "__main__":
     answer = response.choices[0].message.content.strip()
     print(f"LLM Choice: {llm_choice}")
     print(f"Model: {model}")
+    print(f"Pool: {llm_pool_stats()}")
     print("\nRESPONSE")
     print(answer)
@@ -0,0 +1,87 @@
+"""
+Instrumentation for LLM calls.
+
+Every provider call is wrapped in track_llm_call(), which times it and collects the model,
+provider, token usage, time to first token (for streams) and the error class if it failed:
+
+    with track_llm_call("groq", MODEL) as call:
+        response = client.chat.completions.create(model=MODEL, messages=messages)
+        call.usage(response.usage)
+
+    with track_llm_call("groq", MODEL) as call:
+        stream = client.chat.completions.create(
+            model=MODEL, messages=messages, stream=True, stream_options={"include_usage": True}
+        )
+        for chunk in stream:
+            call.usage(chunk.usage)  # only the last chunk has usage, when include_usage is set
+            call.first_token()
+            ...
+
+Finished calls are passed to every function registered with add_recorder() - the Django app
+stores them and exposes them as Prometheus metrics, scripts can simply print them.
+"""
+
+import logging
+import time
+from dataclasses import dataclass, field
+
+from _prompt import cached_tokens
+
+logger = logging.getLogger(__name__)
+
+_recorders = []
+
+
+def add_recorder(recorder) -> None:
+    """Call recorder(LLMCallRecord) after every tracked call."""
+    if recorder not in _recorders:
+        _recorders.append(recorder)
+
+
+@dataclass
+class LLMCallRecord:
+    provider: str
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    latency: float = 0.0
+    time_to_first_token: float = None
+    error: str = ""
+    _started: float = field(default_factory=time.perf_counter, repr=False)
+
+    def usage(self, usage) -> None:
+        """Take the token counts from a response usage block (object or dict)."""
+        if usage is None:
+            return
+        if not isinstance(usage, dict):
+            usage = usage.model_dump()
+        self.prompt_tokens = usage.get("prompt_tokens") or 0
+        self.completion_tokens = usage.get("completion_tokens") or 0
+        self.cached_tokens = cached_tokens(usage)
+
+    def first_token(self) -> None:
+        """Mark the first streamed token - later calls are ignored."""
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - self._started
+
+
+class track_llm_call:
+    def __init__(self, provider: str, model: str) -> None:
+        self.call = LLMCallRecord(provider=provider.lower(), model=model)
+
+    def __enter__(self) -> LLMCallRecord:
+        self.call._started = time.perf_counter()
+        return self.call
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        self.call.latency = time.perf_counter() - self.call._started
+        if exc_type is not None:
+            self.call.error = exc_type.__name__
+        for recorder in _recorders:
+            try:
+                recorder(self.call)
+            except Exception:
+                # Measuring must never break the call being measured.
+                logger.exception("LLM call recorder %r failed", recorder)
+        return False
@@ -0,0 +1,129 @@
+"""
+Which LLM provider and model to use, and how long to wait for it - in one place.
+
+The notebooks, scripts and views each repeated the same get_llm_client / LLM_CHOICE / MODEL block
+and printed the start of the API keys, and the Django views crashed on import when a key was
+missing. get_llm_config() resolves a provider, model and timeouts from, highest first:
+
+- its arguments: get_llm_config(provider="openai")
+- the view's entry in LLM["VIEWS"]: get_llm_config(view="chat_view")
+- LLM_PROVIDER / LLM_MODEL in the environment or .env
+- settings.LLM when Django is running, then DEFAULTS
+
+    config = get_llm_config(view="chat_view")
+    client = get_llm_client(config.provider)
+    client.chat.completions.create(model=config.model, timeout=config.timeout, ...)
+
+The .env file is read once, on first use. Nothing here imports a provider SDK - _get_client only
+imports openai when the first client is created, so Django management commands and worker boot
+do not pay for it.
+"""
+
+import os
+import sys
+import threading
+from dataclasses import dataclass
+
+# Every provider speaks the OpenAI API, so a provider is just a base_url and the env var holding its key.
+PROVIDERS = {
+    "groq": {
+        "base_url": "https://api.groq.com/openai/v1",
+        "api_key_env": "GROQ_API_KEY",
+    },
+    "openai": {
+        "base_url": "https://api.openai.com/v1",
+        "api_key_env": "OPENAI_API_KEY",
+    },
+}
+
+DEFAULTS = {
+    "PROVIDER": "groq",
+    "MODELS": {"groq": "llama-3.3-70b-versatile", "openai": "gpt-4o-mini"},
+    "TIMEOUT": 60.0,  # seconds for a whole request
+    "CONNECT_TIMEOUT": 5.0,
+    # Per view overrides of PROVIDER, MODEL and TIMEOUT, e.g. {"chat_view": {"PROVIDER": "openai"}}
+    "VIEWS": {},
+}
+
+
+@dataclass(frozen=True)
+class LLMConfig:
+    provider: str
+    model: str
+    timeout: float
+    connect_timeout: float
+
+    @property
+    def api_key(self):
+        return os.getenv(PROVIDERS[self.provider]["api_key_env"])
+
+
+_env_loaded = False
+_configs: dict = {}
+_lock = threading.Lock()
+
+
+def load_env() -> None:
+    """Load .env into os.environ once. Variables that are already set win."""
+    global _env_loaded
+    if _env_loaded:
+        return
+    with _lock:
+        if not _env_loaded:
+            from dotenv import find_dotenv, load_dotenv
+
+            # From the working directory (manage.py, notebooks) and from the repository root.
+            for path in {find_dotenv(usecwd=True), find_dotenv()}:
+                if path:
+                    load_dotenv(path)
+            _env_loaded = True
+
+
+def _base_config() -> dict:
+    load_env()
+    config = {**DEFAULTS, "MODELS": dict(DEFAULTS["MODELS"])}
+    # Only read Django's settings when Django is already in use - notebooks never import it.
+    django_conf = sys.modules.get("django.conf")
+    if django_conf is not None and django_conf.settings.configured:
+        overrides = getattr(django_conf.settings, "LLM", {})
+        config.update({key: value for key, value in overrides.items() if key != "MODELS"})
+        config["MODELS"].update(overrides.get("MODELS", {}))
+    if os.getenv("LLM_PROVIDER"):
+        config["PROVIDER"] = os.environ["LLM_PROVIDER"].lower()
+    if os.getenv("LLM_MODEL"):
+        config["MODELS"][config["PROVIDER"]] = os.environ["LLM_MODEL"]
+    return config
+
+
+def get_llm_config(view: str = None, provider: str = None, model: str = None) -> LLMConfig:
+    """The provider, model and timeouts for a view (or the defaults), resolved once and cached."""
+    key = (view, provider, model)
+    config = _configs.get(key)
+    if config is None:
+        base = _base_config()
+        overrides = base["VIEWS"].get(view, {}) if view else {}
+        provider = (provider or overrides.get("PROVIDER") or base["PROVIDER"]).lower()
+        if provider not in PROVIDERS:
+            raise ValueError(f"Invalid LLM provider {provider!r}. Choose from {sorted(PROVIDERS)}.")
+        config = LLMConfig(
+            provider=provider,
+            model=model or overrides.get("MODEL") or base["MODELS"][provider],
+            timeout=float(overrides.get("TIMEOUT", base["TIMEOUT"])),
+            connect_timeout=float(overrides.get("CONNECT_TIMEOUT", base["CONNECT_TIMEOUT"])),
+        )
+        _configs[key] = config
+    return config
+
+
+def clear_llm_config() -> None:
+    """Forget the resolved configs, e.g. after changing settings.LLM in a test."""
+    _configs.clear()
+
+
+def key_status() -> str:
+    """Which API keys are set, for debugging - never any part of the keys themselves."""
+    load_env()
+    return ", ".join(
+        f"{spec['api_key_env']} {'set' if os.getenv(spec['api_key_env']) else 'not set'}"
+        for spec in PROVIDERS.values()
+    )
@@ -0,0 +1,88 @@
+"""
+Prompt assembly that keeps the provider's prompt prefix cache warm.
+
+Providers cache the longest prompt prefix they have seen recently (OpenAI does this automatically
+for prompts over 1024 tokens) and bill/serve the cached part faster. That only works if the start
+of every request is byte-for-byte identical, so messages are always assembled in the same order:
+
+    1. static prefix  - system instructions, fixed facts, tool docs (identical for every request)
+    2. summary        - rolling summary of older turns (changes rarely)
+    3. history        - previous turns, append only
+    4. context        - facts retrieved for this question
+    5. user message
+
+The prefix is fingerprinted so the cached token counts reported in the usage block can be
+tracked per prefix with record_usage() / prefix_cache_stats().
+"""
+
+import hashlib
+import json
+import threading
+
+
+class PromptPrefix:
+    """The static start of a prompt. Build it once at import time and reuse it for every request."""
+
+    def __init__(self, system: str, facts: tuple = (), tool_docs: str = "") -> None:
+        content = system.strip()
+        if facts:
+            content += "\n\n" + "\n".join(fact.strip() for fact in facts)
+        if tool_docs:
+            content += "\n\n" + tool_docs.strip()
+        self.messages = ({"role": "system", "content": content},)
+        self.fingerprint = hashlib.sha256(
+            json.dumps(self.messages, sort_keys=True).encode()
+        ).hexdigest()[:16]
+
+
+def assemble_messages(
+    prefix: PromptPrefix,
+    user: str,
+    history: list = (),
+    summary: str = "",
+    context: list = (),
+) -> list:
+    """Static prefix first, then everything that changes between requests, then the user message."""
+    messages = list(prefix.messages)
+    if summary:
+        messages.append(
+            {"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}
+        )
+    messages.extend(history)
+    if context:
+        messages.append({"role": "system", "content": "Relevant facts:\n" + "\n".join(context)})
+    messages.append({"role": "user", "content": user})
+    return messages
+
+
+def cached_tokens(usage) -> int:
+    """Prompt tokens served from the provider's prefix cache - 0 when the provider does not report it."""
+    if usage is None:
+        return 0
+    if not isinstance(usage, dict):
+        usage = usage.model_dump()
+    details = usage.get("prompt_tokens_details") or {}
+    return details.get("cached_tokens") or 0
+
+
+_stats = {}
+_lock = threading.Lock()
+
+
+def record_usage(prefix: PromptPrefix, usage) -> None:
+    if usage is None:
+        return
+    prompt_tokens = usage["prompt_tokens"] if isinstance(usage, dict) else usage.prompt_tokens
+    with _lock:
+        stats = _stats.setdefault(
+            prefix.fingerprint, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+        )
+        stats["requests"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["cached_tokens"] += cached_tokens(usage)
+
+
+def prefix_cache_stats() -> dict:
+    """Requests, prompt tokens and cached prompt tokens per prefix fingerprint."""
+    with _lock:
+        return {fingerprint: dict(stats) for fingerprint, stats in _stats.items()}
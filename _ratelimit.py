@@ -0,0 +1,369 @@
+"""
+Client side rate limiting and retries for the LLM providers.
+
+Groq and OpenAI limit requests and tokens per minute and answer 429 (with Retry-After) when a
+limit is hit. Instead of every call site retrying on its own - and every worker retrying at once -
+all calls go through two token buckets per provider, one for requests and one for tokens:
+
+- a call reserves a request and its estimated tokens before it is sent. When a bucket is empty the
+  reservation takes the next free slot and the caller sleeps until then, so bursts are spread out
+  at the limit rather than sent and rejected
+- a 429 or 5xx is retried with jittered exponential backoff, never sooner than Retry-After.
+  A Retry-After also pauses the provider for every other caller
+- no call waits more than MAX_WAIT seconds (LLM_RATE_LIMIT_MAX_WAIT) in total for a slot or a
+  retry. Past that nothing is reserved and the call fails at once as rate limited - a 429 for
+  the SDK clients (openai.RateLimitError), RateLimitExceeded from post_with_retry(). A caller
+  cancelled while it waits gives its reservation back
+
+The buckets live in a small SQLite file so every Django worker process on the host shares them.
+The limits default to RATE_LIMITS and can be set with <PROVIDER>_RPM / <PROVIDER>_TPM, the file
+with LLM_RATE_LIMIT_DB.
+
+_get_client.py installs RateLimitedTransport under the shared clients, so callers need no changes.
+Raw HTTP calls can use post_with_retry().
+"""
+
+import asyncio
+import email.utils
+import json
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+import httpx
+
+# Requests and tokens per minute - the free tier for Groq, tier 1 for OpenAI.
+RATE_LIMITS = {
+    "groq": {"rpm": 30, "tpm": 6_000},
+    "openai": {"rpm": 500, "tpm": 200_000},
+}
+# Completion tokens assumed when the request sets no max_tokens.
+DEFAULT_COMPLETION_TOKENS = 256
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# Longest a call waits for a slot or a retry before it fails as rate limited.
+MAX_WAIT = 10.0
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bucket (
+    name TEXT PRIMARY KEY,
+    level REAL NOT NULL,
+    updated REAL NOT NULL,
+    blocked_until REAL NOT NULL DEFAULT 0
+)
+"""
+
+
+class RateLimitExceeded(Exception):
+    """The provider's limits would keep the call waiting longer than MAX_WAIT."""
+
+    def __init__(self, provider: str, retry_after: float) -> None:
+        super().__init__(f"{provider} rate limit - retry in {retry_after:.1f}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+def max_wait() -> float:
+    return float(os.getenv("LLM_RATE_LIMIT_MAX_WAIT", MAX_WAIT))
+
+
+def limits_for(provider: str) -> dict:
+    defaults = RATE_LIMITS.get(provider, {"rpm": 60, "tpm": 100_000})
+    return {
+        "rpm": float(os.getenv(f"{provider.upper()}_RPM", defaults["rpm"])),
+        "tpm": float(os.getenv(f"{provider.upper()}_TPM", defaults["tpm"])),
+    }
+
+
+def estimate_tokens(body: dict) -> int:
+    """Prompt tokens (about 4 characters each) plus the completion tokens the request allows."""
+    messages = body.get("messages", [])
+    characters = sum(len(str(message.get("content") or "")) for message in messages)
+    completion = (
+        body.get("max_completion_tokens") or body.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    )
+    return characters // 4 + completion
+
+
+def retry_after(headers) -> float:
+    """Seconds from a Retry-After (or retry-after-ms) header, 0 if there is none."""
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time()) if date else 0.0
+
+
+def backoff(attempt: int) -> float:
+    # "Full jitter" - spreads retries from many clients out instead of synchronising them.
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+class SharedBuckets:
+    """Token buckets in a SQLite file, updated in one IMMEDIATE transaction per reservation."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def reserve(self, provider: str, tokens: int, max_wait: float = None) -> float:
+        """
+        Take one request and `tokens` tokens and return how long to wait before sending.
+
+        Raises RateLimitExceeded, taking nothing, if that would be longer than max_wait.
+        """
+        limits = limits_for(provider)
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            wait = 0.0
+            for kind, amount, per_minute in (
+                ("requests", 1, limits["rpm"]),
+                ("tokens", tokens, limits["tpm"]),
+            ):
+                name = f"{provider}:{kind}"
+                row = connection.execute(
+                    "SELECT level, updated, blocked_until FROM bucket WHERE name = ?", (name,)
+                ).fetchone()
+                level, updated, blocked_until = row or (per_minute, now, 0.0)
+                rate = per_minute / 60
+                # Refill since the last reservation, up to one minute's worth, then take our share.
+                # The level may go negative - that is the queue of callers already waiting for it.
+                level = min(per_minute, level + (now - updated) * rate) - amount
+                wait = max(wait, -level / rate, blocked_until - now)
+                connection.execute(
+                    "INSERT OR REPLACE INTO bucket (name, level, updated, blocked_until) "
+                    "VALUES (?, ?, ?, ?)",
+                    (name, level, now, blocked_until),
+                )
+            if max_wait is not None and wait > max_wait:
+                raise RateLimitExceeded(provider, wait)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return max(0.0, wait)
+
+    def release(self, provider: str, tokens: int) -> None:
+        """Give back a reservation that was not used - its caller was cancelled while waiting."""
+        limits = limits_for(provider)
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for kind, amount, per_minute in (
+                ("requests", 1, limits["rpm"]),
+                ("tokens", tokens, limits["tpm"]),
+            ):
+                connection.execute(
+                    "UPDATE bucket SET level = MIN(?, level + ?) WHERE name = ?",
+                    (per_minute, amount, f"{provider}:{kind}"),
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def block(self, provider: str, seconds: float) -> None:
+        """Pause the provider for every caller, e.g. for a Retry-After."""
+        until = time.time() + seconds
+        connection = self._connection()
+        limits = limits_for(provider)
+        connection.execute(
+            "INSERT INTO bucket (name, level, updated, blocked_until) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET "
+            "blocked_until = MAX(blocked_until, excluded.blocked_until)",
+            (f"{provider}:requests", limits["rpm"], time.time(), until),
+        )
+
+
+_buckets = None
+_buckets_lock = threading.Lock()
+
+
+def get_buckets() -> SharedBuckets:
+    global _buckets
+    if _buckets is None:
+        with _buckets_lock:
+            if _buckets is None:
+                path = os.getenv("LLM_RATE_LIMIT_DB") or os.path.join(
+                    tempfile.gettempdir(), "llm_rate_limits.sqlite3"
+                )
+                _buckets = SharedBuckets(path)
+    return _buckets
+
+
+def _limited(request: httpx.Request) -> bool:
+    # Only completions count against the limits - not listing models for the warm up.
+    return request.method == "POST"
+
+
+def _retry_delay(provider: str, response, attempt: int, waited: float = 0.0):
+    """Seconds to wait before retrying response, or None if it should be returned as it is."""
+    if response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+        return None
+    server_wait = retry_after(response.headers)
+    if response.status_code == 429 and server_wait:
+        get_buckets().block(provider, server_wait)
+    delay = max(server_wait, backoff(attempt))
+    # Past MAX_WAIT the provider's own error goes back to the caller rather than keep it waiting.
+    return delay if waited + delay <= max_wait() else None
+
+
+def wait_for_slot(provider: str, tokens: int, waited: float = 0.0) -> float:
+    """Reserve and sleep until the call may be sent. Returns the seconds slept."""
+    buckets = get_buckets()
+    wait = buckets.reserve(provider, tokens, max_wait() - waited)
+    try:
+        time.sleep(wait)
+    except BaseException:
+        buckets.release(provider, tokens)
+        raise
+    return wait
+
+
+async def await_slot(provider: str, tokens: int, waited: float = 0.0) -> float:
+    """Async version of wait_for_slot - a cancelled caller gives its reservation back."""
+    buckets = get_buckets()
+    # The reservation may wait on SQLite's lock so it runs in a thread.
+    wait = await asyncio.to_thread(buckets.reserve, provider, tokens, max_wait() - waited)
+    try:
+        await asyncio.sleep(wait)
+    except BaseException:
+        buckets.release(provider, tokens)
+        raise
+    return wait
+
+
+def rate_limited_response(request: httpx.Request, error: RateLimitExceeded) -> httpx.Response:
+    """The 429 a provider would send, so the SDK raises openai.RateLimitError as usual."""
+    return httpx.Response(
+        429,
+        headers={"Retry-After": str(math.ceil(error.retry_after))},
+        json={"error": {"message": str(error), "type": "rate_limit_exceeded"}},
+        request=request,
+    )
+
+
+def rate_limit_wait(error: Exception):
+    """
+    Seconds until a rate limited call may be retried, or None if error is not a rate limit.
+
+    Covers RateLimitExceeded and a 429 from the SDK (openai.RateLimitError) or requests.
+    """
+    if isinstance(error, RateLimitExceeded):
+        return error.retry_after
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return retry_after(response.headers)
+    return None
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """An httpx transport that waits for the provider's buckets and retries 429/5xx responses."""
+
+    def __init__(self, transport: httpx.BaseTransport, provider: str) -> None:
+        self.transport = transport
+        self.provider = provider
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if not _limited(request):
+            return self.transport.handle_request(request)
+        tokens = estimate_tokens(json.loads(request.read() or b"{}"))
+        attempt = 0
+        waited = 0.0
+        while True:
+            try:
+                waited += wait_for_slot(self.provider, tokens, waited)
+            except RateLimitExceeded as error:
+                return rate_limited_response(request, error)
+            response = self.transport.handle_request(request)
+            delay = _retry_delay(self.provider, response, attempt, waited)
+            if delay is None:
+                return response
+            # Error bodies are small - reading them keeps the pooled connection reusable.
+            response.read()
+            response.close()
+            time.sleep(delay)
+            waited += delay
+            attempt += 1
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    """Async version of RateLimitedTransport - waiting does not block the event loop."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, provider: str) -> None:
+        self.transport = transport
+        self.provider = provider
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not _limited(request):
+            return await self.transport.handle_async_request(request)
+        tokens = estimate_tokens(json.loads(await request.aread() or b"{}"))
+        attempt = 0
+        waited = 0.0
+        while True:
+            try:
+                waited += await await_slot(self.provider, tokens, waited)
+            except RateLimitExceeded as error:
+                return rate_limited_response(request, error)
+            response = await self.transport.handle_async_request(request)
+            delay = await asyncio.to_thread(_retry_delay, self.provider, response, attempt, waited)
+            if delay is None:
+                return response
+            await response.aread()
+            await response.aclose()
+            await asyncio.sleep(delay)
+            waited += delay
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def post_with_retry(provider: str, url: str, headers: dict, body: dict, timeout: float = 60.0):
+    """
+    requests.post() with the same rate limiting and retries, for call sites not using the SDK.
+
+    Raises RateLimitExceeded when the limits would keep it waiting longer than MAX_WAIT.
+    """
+    import requests  # only the raw HTTP call sites need it
+
+    tokens = estimate_tokens(body)
+    attempt = 0
+    waited = 0.0
+    while True:
+        waited += wait_for_slot(provider, tokens, waited)
+        response = requests.post(url, headers=headers, json=body, timeout=timeout)
+        delay = _retry_delay(provider, response, attempt, waited)
+        if delay is None:
+            return response
+        time.sleep(delay)
+        waited += delay
+        attempt += 1
@@ -0,0 +1,202 @@
+"""
+The reflection pattern from 07_reflection.ipynb as a reusable engine.
+
+A round is: generate (or revise) the output, then have several critics review it at the same
+time - each with its own system prompt, e.g. correctness, readability and performance - and
+merge their critiques into one message for the next revision. Because the critics run
+concurrently a round takes about one critic's latency however many critics there are.
+
+Rounds repeat until the output has converged - every critic replied APPROVED, or the revision
+came back unchanged - or max_rounds or the token budget is reached.
+
+Each completion is memoized on disk under a hash of its model, messages and options, so running
+the same reflection again (after a crash, or with one more round) only calls the LLM for the
+stages that have not been done yet:
+
+    engine = Reflection(get_llm_client("groq"), "llama-3.3-70b-versatile", max_rounds=3)
+    result = engine.run("Generate a Python implementation of a ReAct agent")
+    result.output, result.rounds, result.converged, result.critiques[-1]
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from _instrument import track_llm_call
+
+GENERATOR_SYSTEM = (
+    "You are a Python programmer tasked with generating high quality Python code. "
+    "Your task is to Generate the best content possible for the user's request. If the user "
+    "provides critique, respond with a revised version of your previous attempt."
+)
+APPROVED = "APPROVED"
+# Each critic reviews one aspect and says APPROVED when it has nothing important left to add.
+CRITIC_INSTRUCTIONS = (
+    f"\nIf there is nothing important left to change, reply with the single word {APPROVED}."
+)
+CRITICS = {
+    "correctness": "You are an experienced Python reviewer. Critique the user's code for bugs, "
+    "unhandled edge cases and errors, with concrete fixes.",
+    "readability": "You are an experienced Python reviewer. Critique the user's code for "
+    "structure, naming, type hints and docstrings, with concrete recommendations.",
+    "performance": "You are an experienced Python reviewer. Critique the user's code for "
+    "unnecessary work, poor data structures and blocking calls, with concrete recommendations.",
+}
+
+
+@dataclass
+class ReflectionResult:
+    output: str
+    rounds: int = 0
+    converged: bool = False
+    critiques: list = field(default_factory=list)  # {critic: critique} for each round
+    tokens: int = 0  # tokens used by completions that were not already cached
+    cached: int = 0  # completions answered from the cache
+
+
+class StageCache:
+    """Completions stored as one JSON file each, named by the hash of the request."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, request: dict) -> str:
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str):
+        try:
+            with open(os.path.join(self.directory, f"{key}.json"), encoding="utf-8") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def set(self, key: str, value: dict) -> None:
+        # Written to a temporary file and renamed, so a crash never leaves half an entry.
+        path = os.path.join(self.directory, f"{key}.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(value, file)
+        os.replace(f"{path}.tmp", path)
+
+
+class Reflection:
+    def __init__(
+        self,
+        client,
+        model: str,
+        critics: dict = None,
+        generator_system: str = GENERATOR_SYSTEM,
+        max_rounds: int = 3,
+        token_budget: int = None,
+        cache_dir: str = os.path.join(tempfile.gettempdir(), "reflection_cache"),
+        provider: str = "groq",
+        converged=None,
+        **options,
+    ) -> None:
+        """
+        critics: {name: system prompt}. converged(critiques) -> bool replaces the default test of
+        every critique being APPROVED. The cache is kept in the temp directory unless cache_dir
+        says otherwise, and cache_dir=None turns it off. options are passed to every
+        chat.completions.create().
+        """
+        self.client = client
+        self.model = model
+        self.critics = critics or CRITICS
+        self.generator_system = generator_system
+        self.max_rounds = max_rounds
+        self.token_budget = token_budget
+        self.cache = StageCache(cache_dir) if cache_dir else None
+        self.provider = provider
+        self.converged = converged or all_approved
+        self.options = options
+        self._lock = threading.Lock()
+
+    def complete(self, messages: list, result: ReflectionResult) -> str:
+        request = {"model": self.model, "messages": messages, "options": self.options}
+        key = self.cache.key(request) if self.cache else None
+        cached = self.cache.get(key) if self.cache else None
+        if cached is not None:
+            with self._lock:
+                result.cached += 1
+            return cached["text"]
+        with track_llm_call(self.provider, self.model) as call:
+            response = self.client.chat.completions.create(
+                model=self.model, messages=messages, **self.options
+            )
+            call.usage(response.usage)
+        text = response.choices[0].message.content or ""
+        tokens = response.usage.total_tokens if response.usage else 0
+        with self._lock:
+            result.tokens += tokens
+        if self.cache:
+            self.cache.set(key, {"text": text, "tokens": tokens})
+        return text
+
+    def critique(self, output: str, result: ReflectionResult, executor) -> dict:
+        """{critic: critique} with every critic running at once on executor's threads."""
+        futures = {
+            name: executor.submit(
+                self.complete,
+                [
+                    {"role": "system", "content": system + CRITIC_INSTRUCTIONS},
+                    {"role": "user", "content": output},
+                ],
+                result,
+            )
+            for name, system in self.critics.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+    def run(self, task: str) -> ReflectionResult:
+        messages = [
+            {"role": "system", "content": self.generator_system},
+            {"role": "user", "content": task},
+        ]
+        result = ReflectionResult(output="")
+        # One thread per critic for this run only - nothing is left running once it returns.
+        with ThreadPoolExecutor(len(self.critics), thread_name_prefix="critic") as executor:
+            return self._run(messages, result, executor)
+
+    def _run(self, messages: list, result: ReflectionResult, executor) -> ReflectionResult:
+        result.output = self.complete(messages, result)
+        while result.rounds < self.max_rounds:
+            if self.token_budget is not None and result.tokens >= self.token_budget:
+                break
+            critiques = self.critique(result.output, result, executor)
+            result.critiques.append(critiques)
+            result.rounds += 1
+            if self.converged(critiques):
+                result.converged = True
+                break
+            messages = messages + [
+                {"role": "assistant", "content": result.output},
+                {"role": "user", "content": merge_critiques(critiques)},
+            ]
+            revision = self.complete(messages, result)
+            if revision.strip() == result.output.strip():
+                # A fixed point - another round would get the same critiques.
+                result.converged = True
+                break
+            result.output = revision
+        return result
+
+
+def approved(critique: str) -> bool:
+    return critique.strip().rstrip(".").upper() == APPROVED
+
+
+def all_approved(critiques: dict) -> bool:
+    return all(approved(critique) for critique in critiques.values())
+
+
+def merge_critiques(critiques: dict) -> str:
+    """One user message with a section per critic that still has something to say."""
+    return "\n\n".join(
+        f"## {name.title()} review\n{critique.strip()}"
+        for name, critique in critiques.items()
+        if not approved(critique)
+    )
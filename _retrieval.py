@@ -0,0 +1,104 @@
+"""
+Local retrieval over FAQ style documents.
+
+Instead of stuffing every FAQ entry into the system message, the entries are split into chunks
+and indexed once with BM25. Each question then only adds the top-k most relevant chunks to the
+prompt, so the prompt stays bounded however large the knowledge base grows.
+
+Everything runs in process with NumPy - no embeddings and no external service.
+
+    faq_index = BM25Index(chunk_documents(FAQ))
+    faq_index.search("Where is the venue?", k=3)
+"""
+
+import hashlib
+import re
+import textwrap
+
+import numpy as np
+
+STOP_WORDS = set(
+    """a an and are as at be but by can do does for from has have how i if in is it its me my
+    of on or our so that the their there this to was we what when where which who will with
+    you your""".split()
+)
+
+
+def tokenize(text: str) -> list:
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOP_WORDS]
+
+
+def chunk_documents(documents: list, max_words: int = 120, overlap: int = 20) -> list:
+    """
+    Split documents into chunks of at most max_words words.
+
+    Short documents (most FAQ entries) are kept whole. Long ones become overlapping windows so a
+    fact near a boundary is still retrievable with its context.
+    """
+    chunks = []
+    step = max_words - overlap
+    for document in documents:
+        words = textwrap.dedent(document).split()
+        if not words:
+            continue
+        if len(words) <= max_words:
+            chunks.append(" ".join(words))
+            continue
+        for start in range(0, len(words) - overlap, step):
+            chunks.append(" ".join(words[start : start + max_words]))
+    return chunks
+
+
+class BM25Index:
+    """
+    BM25 index stored as one posting array per term.
+
+    Scoring a query gathers the postings of its terms and accumulates all their scores in a
+    single vectorised pass, so the cost is proportional to the postings touched rather than to
+    a documents x vocabulary matrix.
+    """
+
+    def __init__(self, chunks: list, k1: float = 1.5, b: float = 0.75) -> None:
+        self.chunks = list(chunks)
+        self.fingerprint = hashlib.sha256("\n".join(self.chunks).encode()).hexdigest()[:16]
+
+        postings: dict = {}
+        lengths = np.zeros(len(self.chunks), dtype=np.float32)
+        for doc_id, chunk in enumerate(self.chunks):
+            tokens = tokenize(chunk)
+            lengths[doc_id] = len(tokens)
+            for term in tokens:
+                counts = postings.setdefault(term, {})
+                counts[doc_id] = counts.get(doc_id, 0) + 1
+
+        n_docs = len(self.chunks)
+        # 1.0 when no chunk has a token left after tokenizing, rather than dividing by zero.
+        avg_length = (lengths.mean() if n_docs else 0.0) or 1.0
+        # The length normalisation only depends on the document so it is computed once.
+        norm = k1 * (1 - b + b * lengths / avg_length)
+
+        self.postings = {}
+        for term, counts in postings.items():
+            doc_ids = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+            tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+            idf = np.log(1 + (n_docs - len(counts) + 0.5) / (len(counts) + 0.5))
+            # Store the finished per document score for the term - search is just a sum.
+            self.postings[term] = (doc_ids, idf * tf * (k1 + 1) / (tf + norm[doc_ids]))
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in tokenize(query):
+            posting = self.postings.get(term)
+            if posting is not None:
+                np.add.at(scores, posting[0], posting[1])
+        return scores
+
+    def search(self, query: str, k: int = 4) -> list:
+        """The k best matching chunks, best first. Chunks sharing no term with the query are skipped."""
+        scores = self.scores(query)
+        k = min(k, len(self.chunks))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.chunks[i] for i in top if scores[i] > 0]
@@ -0,0 +1,183 @@
+"""
+Intent routing with a local fast path.
+
+Picking a report in 04_router costs a full LLM round trip. Most questions are easy to route
+("what's the weather in Dublin?"), so IntentRouter first scores the question against each tool
+with TF-IDF cosine similarity over the tool descriptions plus a few labelled example questions.
+Only when the best match is weak, or too close to the runner up, is the LLM asked.
+
+    router = IntentRouter(parse_reports(REPORTS), EXAMPLES, llm=llm_router(client, MODEL, system_message))
+    router.route("Are there any sprints this year?")
+    # RouteDecision(tool='get_sprint', confidence=0.62, source='local', ...)
+
+Local decisions take microseconds and need no network access.
+"""
+
+import re
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from _instrument import track_llm_call
+from _retrieval import tokenize
+
+# |TOOL: **get_joke**| - the format the 04_router system message asks the LLM for.
+TOOL_PATTERN = re.compile(r"\|\s*TOOL:\s*\*\*(\w+)\*\*\s*\|")
+REPORT_PATTERN = re.compile(r"\*\*(\w+)\*\*")
+
+
+@dataclass
+class RouteDecision:
+    tool: str
+    confidence: float
+    source: str  # "local", "llm", "default" or "unconfident"
+    elapsed: float = 0.0
+    scores: dict = field(default_factory=dict, repr=False)
+
+
+def parse_reports(reports: list) -> dict:
+    """{tool: description} from REPORTS lines like "For weather use this tool => **get_weather**." """
+    tools: dict = {}
+    for report in reports:
+        match = REPORT_PATTERN.search(report)
+        if not match:
+            continue
+        description = REPORT_PATTERN.sub("", report).replace("=>", " ")
+        tools.setdefault(match.group(1), []).append(description)
+    return {tool: " ".join(descriptions) for tool, descriptions in tools.items()}
+
+
+def terms(text: str) -> list:
+    # A crude plural strip so "flights" matches "flight" - enough for short tool descriptions.
+    return [word[:-1] if len(word) > 3 and word.endswith("s") else word for word in tokenize(text)]
+
+
+class IntentRouter:
+    """
+    TF-IDF router over a fixed set of tools.
+
+    Each tool is the normalised sum of the TF-IDF vectors of its description and examples, so
+    routing a question is one sparse dot product per query term.
+    """
+
+    def __init__(
+        self,
+        tools: dict,
+        examples: list = (),
+        llm=None,
+        threshold: float = 0.3,
+        margin: float = 0.05,
+        default: str = None,
+    ) -> None:
+        """
+        tools maps tool names to descriptions, examples is a list of (question, tool) pairs and
+        llm an optional callable question -> tool name (or None) used when the local match is
+        below threshold or within margin of the second best tool.
+        """
+        self.tools = list(tools)
+        self.llm = llm
+        self.threshold = threshold
+        self.margin = margin
+        self.default = default
+
+        documents = [(tools[tool], tool) for tool in self.tools]
+        documents += [(question, tool) for question, tool in examples if tool in tools]
+        counts = [
+            (np.unique(terms(text), return_counts=True), self.tools.index(tool))
+            for text, tool in documents
+        ]
+        document_frequency: dict = {}
+        for (words, _), _ in counts:
+            for word in words:
+                document_frequency[word] = document_frequency.get(word, 0) + 1
+        self.vocabulary = {word: i for i, word in enumerate(document_frequency)}
+        frequency = np.fromiter(document_frequency.values(), float)
+        self.idf = np.log((1 + len(documents)) / (1 + frequency)) + 1
+
+        matrix = np.zeros((len(self.vocabulary), len(self.tools)))
+        for (words, tf), tool_id in counts:
+            if not len(words):
+                continue
+            rows = [self.vocabulary[word] for word in words]
+            vector = tf * self.idf[rows]
+            matrix[rows, tool_id] += vector / np.linalg.norm(vector)
+        norms = np.linalg.norm(matrix, axis=0)
+        self.matrix = matrix / np.where(norms == 0, 1, norms)
+
+    def scores(self, question: str) -> np.ndarray:
+        """Cosine similarity of the question with every tool, in self.tools order."""
+        rows: dict = {}
+        for word in terms(question):
+            row = self.vocabulary.get(word)
+            if row is not None:
+                rows[row] = rows.get(row, 0) + 1
+        if not rows:
+            return np.zeros(len(self.tools))
+        index = np.fromiter(rows.keys(), int)
+        query = np.fromiter(rows.values(), float) * self.idf[index]
+        return query @ self.matrix[index] / np.linalg.norm(query)
+
+    def classify(self, question: str) -> RouteDecision:
+        """The local decision alone, however weak."""
+        started = time.perf_counter()
+        scores = self.scores(question)
+        best = int(np.argmax(scores)) if len(scores) else 0
+        return RouteDecision(
+            tool=self.tools[best] if self.tools else self.default,
+            confidence=float(scores[best]) if len(scores) else 0.0,
+            source="local",
+            elapsed=time.perf_counter() - started,
+            scores=dict(zip(self.tools, scores.round(4).tolist())),
+        )
+
+    def confident(self, decision: RouteDecision) -> bool:
+        runner_up = sorted(decision.scores.values())[-2] if len(decision.scores) > 1 else 0.0
+        return (
+            decision.confidence >= self.threshold
+            and decision.confidence - runner_up >= self.margin
+        )
+
+    def route(self, question: str) -> RouteDecision:
+        """
+        The local decision if it is confident, otherwise the LLM's, otherwise the default tool.
+
+        Without a default the weak local guess is returned with source "unconfident", so callers
+        can tell it apart from a confident local decision.
+        """
+        started = time.perf_counter()
+        decision = self.classify(question)
+        if self.confident(decision):
+            return decision
+        if self.llm is not None:
+            tool = self.llm(question)
+            if tool in self.tools:
+                decision.tool, decision.source = tool, "llm"
+                decision.elapsed = time.perf_counter() - started
+                return decision
+        if self.default is not None:
+            decision.tool, decision.source = self.default, "default"
+        else:
+            decision.source = "unconfident"
+        decision.elapsed = time.perf_counter() - started
+        return decision
+
+
+def llm_router(client, model: str, system_message: str, provider: str = "groq"):
+    """A fallback for IntentRouter that asks the LLM and extracts |TOOL: **name**| from its answer."""
+
+    def ask(question: str):
+        with track_llm_call(provider, model) as call:
+            response = client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_message},
+                    {"role": "user", "content": question},
+                ],
+                temperature=0.0,
+            )
+            call.usage(response.usage)
+        match = TOOL_PATTERN.search(response.choices[0].message.content or "")
+        return match.group(1) if match else None
+
+    return ask
@@ -0,0 +1,364 @@
+"""
+Structured output from a streamed completion.
+
+10_groq_structured_output.ipynb and 05_tool_calling.ipynb wait for the whole reply and then parse
+it, so nothing is usable until the last token and a reply that was wrong from its first token is
+still generated (and paid for) to the end.
+
+StructuredParser is fed the streamed text and parses it as it arrives. Each top level field of the
+Pydantic model is validated and reported as soon as its value closes - and each item of a list
+field as soon as that item closes - so a long extraction can be used while it is still being
+generated. As soon as the reply can no longer become a valid instance (it does not start with a
+JSON object, a field holds the wrong kind of value or fails validation, an unknown key when the
+model forbids extras, broken JSON) SchemaViolation is raised and the stream can be closed.
+
+    parser = StructuredParser(UserInfo)
+    for text in deltas:
+        for path, value in parser.feed(text):
+            print(path, value)                 # ("name",) John Doe  /  ("facts", 0) FactSchema(...)
+    user_info = parser.close()
+
+stream_model() does this for a chat completion, closing the stream on a violation and re-asking
+with the error, like _extraction.extract_facts().
+"""
+
+import json
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from _instrument import track_llm_call
+
+WHITESPACE = " \t\r\n"
+LITERAL_START = "-0123456789tfn"
+# Which JSON values Pydantic accepts (in lax mode) for each JSON schema type.
+ACCEPTS = {
+    "string": {"string"},
+    "integer": {"number", "string", "boolean"},
+    "number": {"number", "string", "boolean"},
+    "boolean": {"boolean", "number", "string"},
+    "null": {"null"},
+    "array": {"array"},
+    "object": {"object"},
+}
+
+
+class SchemaViolation(ValueError):
+    """The streamed reply can no longer be a valid instance of the model."""
+
+
+def json_kind(first: str) -> str:
+    """The kind of JSON value that starts with the character first."""
+    if first == "{":
+        return "object"
+    if first == "[":
+        return "array"
+    if first == '"':
+        return "string"
+    if first in "tf":
+        return "boolean"
+    if first == "n":
+        return "null"
+    return "number"
+
+
+def accepted_kinds(schema: dict):
+    """The JSON value kinds a JSON schema can accept, or None when it accepts anything."""
+    if "$ref" in schema:
+        return {"object"}
+    if "type" in schema:
+        types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        return set().union(*(ACCEPTS.get(kind, set(ACCEPTS)) for kind in types))
+    options = schema.get("anyOf") or schema.get("oneOf") or schema.get("allOf")
+    if not options:
+        return None
+    kinds = set()
+    for option in options:
+        option_kinds = accepted_kinds(option)
+        if option_kinds is None:
+            return None
+        kinds |= option_kinds
+    return kinds
+
+
+class IncrementalJSON:
+    """
+    A push parser for one JSON value, fed text in pieces.
+
+    feed() returns the events the new text completed:
+    ("start", path, kind) when a value begins, ("key", path, key) when an object key has been read
+    and ("value", path, value) when a value closes. path is the tuple of keys and list indexes
+    leading to the value - () is the whole document. Values deeper than max_depth are not decoded
+    or reported. A leading ```json fence is skipped. Broken JSON raises SchemaViolation.
+    """
+
+    def __init__(self, max_depth: int = 2) -> None:
+        self.max_depth = max_depth
+        self.buffer = ""
+        self.stack = []  # [kind, key or index, start offset] of each open object or list
+        self.expect = "value"
+        self.string_start = None
+        self.string_is_key = False
+        self.escape = False
+        self.literal_start = None
+        self.in_fence = False
+        self.done = False
+
+    def path(self) -> tuple:
+        return tuple(frame[1] for frame in self.stack)
+
+    def feed(self, text: str) -> list:
+        events = []
+        start = len(self.buffer)
+        self.buffer += text
+        for position in range(start, len(self.buffer)):
+            self._char(position, self.buffer[position], events)
+        return events
+
+    def close(self) -> list:
+        """Events for a trailing number, which only ends at the end of the text."""
+        events = []
+        if self.literal_start is not None:
+            self._end_value(self.literal_start, len(self.buffer), events)
+            self.literal_start = None
+        if not self.done:
+            raise SchemaViolation("the reply ended before the JSON was complete")
+        return events
+
+    def _char(self, position: int, char: str, events: list) -> None:
+        if self.string_start is not None:
+            if self.escape:
+                self.escape = False
+            elif char == "\\":
+                self.escape = True
+            elif char == '"':
+                start, self.string_start = self.string_start, None
+                if self.string_is_key:
+                    self._end_key(start, position + 1, events)
+                else:
+                    self._end_value(start, position + 1, events)
+            return
+        if self.literal_start is not None:
+            if char not in WHITESPACE and char not in ",]}":
+                return
+            start, self.literal_start = self.literal_start, None
+            self._end_value(start, position, events)
+        if self.in_fence:
+            self.in_fence = char != "\n"
+            return
+        if char in WHITESPACE:
+            return
+
+        expect = self.expect
+        if self.done:
+            if char != "`":
+                raise SchemaViolation(f"unexpected {char!r} after the JSON")
+        elif expect == "value" and not self.stack and char == "`":
+            self.in_fence = True
+        elif expect in ("value", "value or end"):
+            if char == "]" and expect == "value or end":
+                self._end_container(position, events)
+            else:
+                self._start_value(position, char, events)
+        elif expect in ("key", "key or end"):
+            if char == "}" and expect == "key or end":
+                self._end_container(position, events)
+            elif char == '"':
+                self.string_start, self.string_is_key = position, True
+            else:
+                raise SchemaViolation(f"expected a key at {self.path()}, got {char!r}")
+        elif expect == "colon":
+            if char != ":":
+                raise SchemaViolation(f"expected ':' after {self.path()}, got {char!r}")
+            self.expect = "value"
+        elif expect == "comma or end":
+            kind = self.stack[-1][0]
+            if char == ",":
+                self.expect = "key" if kind == "{" else "value"
+            elif char == ("}" if kind == "{" else "]"):
+                self._end_container(position, events)
+            else:
+                raise SchemaViolation(f"expected ',' at {self.path()}, got {char!r}")
+
+    def _start_value(self, position: int, char: str, events: list) -> None:
+        if self.stack and self.stack[-1][0] == "[":
+            self.stack[-1][1] += 1
+        if char not in '{["' and char not in LITERAL_START:
+            raise SchemaViolation(f"expected a JSON value at {self.path()}, got {char!r}")
+        if len(self.stack) <= self.max_depth:
+            events.append(("start", self.path(), json_kind(char)))
+        if char == "{":
+            self.stack.append(["{", None, position])
+            self.expect = "key or end"
+        elif char == "[":
+            self.stack.append(["[", -1, position])
+            self.expect = "value or end"
+        elif char == '"':
+            self.string_start, self.string_is_key = position, False
+        else:
+            self.literal_start = position
+
+    def _end_key(self, start: int, end: int, events: list) -> None:
+        key = json.loads(self.buffer[start:end])
+        self.stack[-1][1] = key
+        if len(self.stack) <= self.max_depth:
+            events.append(("key", self.path(), key))
+        self.expect = "colon"
+
+    def _end_container(self, position: int, events: list) -> None:
+        start = self.stack.pop()[2]
+        self._end_value(start, position + 1, events)
+
+    def _end_value(self, start: int, end: int, events: list) -> None:
+        # Only the values that are reported are decoded, so each character is decoded at most
+        # max_depth + 1 times however long the reply is.
+        if len(self.stack) <= self.max_depth:
+            try:
+                value = json.loads(self.buffer[start:end])
+            except json.JSONDecodeError as error:
+                raise SchemaViolation(f"invalid JSON value at {self.path()}: {error}") from None
+            events.append(("value", self.path(), value))
+        if self.stack:
+            self.expect = "comma or end"
+        else:
+            self.done = True
+
+
+class StructuredParser:
+    """Parse a streamed reply into response_model, validating each field as soon as it closes."""
+
+    def __init__(self, response_model: type[BaseModel]) -> None:
+        self.response_model = response_model
+        self.json = IncrementalJSON(max_depth=2)
+        self.forbid_extra = response_model.model_config.get("extra") == "forbid"
+        self.fields = {}
+        for name, field in response_model.model_fields.items():
+            adapter = TypeAdapter(field.annotation)
+            item_type = getattr(field.annotation, "__args__", (None,))[0]
+            is_list = getattr(field.annotation, "__origin__", None) is list and item_type
+            self.fields[field.alias or name] = {
+                "name": name,
+                "adapter": adapter,
+                "kinds": accepted_kinds(adapter.json_schema()),
+                "items": TypeAdapter(item_type) if is_list else None,
+            }
+        self.values = {}
+        self.result = None
+
+    @property
+    def partial(self) -> BaseModel:
+        """The model with the fields validated so far - the others are not set yet."""
+        return self.response_model.model_construct(**self.values)
+
+    def feed(self, text: str) -> list:
+        """Parse the next piece of the reply and return the (path, value) pairs it completed."""
+        return self._handle(self.json.feed(text))
+
+    def close(self) -> BaseModel:
+        """The validated model, once the whole reply has been fed."""
+        self._handle(self.json.close())
+        return self.result
+
+    def _violation(self, path: tuple, error: ValidationError) -> SchemaViolation:
+        # Same "facts.2.category: Field required" form as _extraction.describe_errors().
+        problems = (
+            (".".join(str(part) for part in path + problem["loc"]) or "JSON", problem["msg"])
+            for problem in error.errors()
+        )
+        return SchemaViolation("; ".join(f"{where}: {message}" for where, message in problems))
+
+    def _handle(self, events: list) -> list:
+        updates = []
+        for event, path, value in events:
+            field = self.fields.get(path[0]) if path else None
+            if not path:
+                if event == "start" and value != "object":
+                    raise SchemaViolation(f"expected a JSON object, got a {value}")
+                if event == "value":
+                    try:
+                        self.result = self.response_model.model_validate(value)
+                    except ValidationError as error:
+                        raise self._violation(path, error) from None
+            elif field is None:
+                if event == "key" and self.forbid_extra:
+                    raise SchemaViolation(f"{path[0]}: unknown field")
+            elif len(path) == 1:
+                if event == "start" and field["kinds"] is not None and value not in field["kinds"]:
+                    expected = " or ".join(sorted(field["kinds"]))
+                    raise SchemaViolation(f"{path[0]}: expected {expected}, got {value}")
+                if event == "value":
+                    try:
+                        value = field["adapter"].validate_python(value)
+                    except ValidationError as error:
+                        raise self._violation(path, error) from None
+                    self.values[field["name"]] = value
+                    updates.append((path, value))
+            elif field["items"] is not None and event == "value":
+                try:
+                    value = field["items"].validate_python(value)
+                except ValidationError as error:
+                    raise self._violation(path, error) from None
+                self.values.setdefault(field["name"], []).append(value)
+                updates.append((path, value))
+        return updates
+
+
+def schema_instructions(response_model: type[BaseModel]) -> str:
+    """A system message paragraph asking for JSON matching the model."""
+    schema = json.dumps(response_model.model_json_schema())
+    return f"Reply with a single JSON object and nothing else, matching this JSON schema:\n{schema}"
+
+
+def stream_model(
+    client,
+    model: str,
+    messages: list,
+    response_model: type[BaseModel],
+    on_field=None,
+    max_reasks: int = 1,
+    provider: str = "groq",
+    **options,
+):
+    """
+    Stream a completion into response_model, calling on_field(path, value) as each field closes.
+
+    A violation closes the stream, so the rest of a doomed reply is not generated, and the model
+    is shown its reply so far and the problem. on_field may see a field again after a re-ask.
+    Raises SchemaViolation after max_reasks.
+    """
+    messages = list(messages)
+    for attempt in range(max_reasks + 1):
+        parser = StructuredParser(response_model)
+        reply = []
+        try:
+            with track_llm_call(provider, model) as call:
+                stream = client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    **options,
+                )
+                try:
+                    for chunk in stream:
+                        call.usage(chunk.usage)
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            call.first_token()
+                            reply.append(chunk.choices[0].delta.content)
+                            for path, value in parser.feed(reply[-1]):
+                                if on_field:
+                                    on_field(path, value)
+                finally:
+                    # Closing the stream drops the connection, which stops the generation.
+                    stream.close()
+            return parser.close()
+        except SchemaViolation as error:
+            if attempt == max_reasks:
+                raise
+            messages += [
+                {"role": "assistant", "content": "".join(reply)},
+                {
+                    "role": "user",
+                    "content": f"That reply does not match the schema - {error}.\n"
+                    "Reply with the corrected JSON only.",
+                },
+            ]
@@ -0,0 +1,180 @@
+"""
+A local OpenAI compatible stub server for benchmarks and offline runs.
+
+It answers /v1/chat/completions (streaming and non streaming) and /v1/models with generated text,
+so the apps and notebooks can be exercised without network access or API spend. Latency, token
+rate and error injection are configurable to mimic a real provider.
+
+Point a provider at it with the <PROVIDER>_BASE_URL environment variable read by _get_client.py:
+
+    python _stub_server.py --port 8001 --latency 0.3 --tokens-per-second 200
+    GROQ_BASE_URL=http://127.0.0.1:8001/v1 python manage.py runserver
+
+or start it in process:
+
+    server = start_stub_server(latency=0.3)
+    client = get_llm_client("groq", base_url=server.base_url, api_key="stub")
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = "the conference takes place in Dublin at the Talbot Hotel Stillorgan from 23rd to 27th April".split()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real providers
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "stub", "object": "model"}]})
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        config = self.server.config
+        with self.server.lock:
+            self.server.requests += 1
+        if random.random() < config["error_rate"]:
+            status = config["error_status"]
+            headers = [("Retry-After", "1")] if status == 429 else []
+            self.send_json(status, {"error": {"message": "Injected error", "type": "stub"}}, headers)
+            return
+
+        prompt = " ".join(str(message.get("content", "")) for message in body.get("messages", []))
+        tokens = [random.choice(WORDS) + " " for _ in range(config["completion_tokens"])]
+        usage = {
+            "prompt_tokens": len(prompt) // 4 + 1,
+            "completion_tokens": len(tokens),
+            "total_tokens": len(prompt) // 4 + 1 + len(tokens),
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        completion = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+        }
+        delay = 1 / config["tokens_per_second"]
+
+        if not body.get("stream"):
+            time.sleep(config["latency"] + delay * len(tokens))
+            message = {"role": "assistant", "content": "".join(tokens).strip()}
+            choice = {"index": 0, "message": message, "finish_reason": "stop"}
+            self.send_json(
+                200,
+                {**completion, "object": "chat.completion", "choices": [choice], "usage": usage},
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        # The headers go straight away and the first token after the latency, as a provider
+        # that has accepted the request and is generating.
+        self.wfile.flush()
+        time.sleep(config["latency"])
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(delay)
+            choice = {"index": 0, "delta": {"content": token}, "finish_reason": None}
+            chunk = {**completion, "object": "chat.completion.chunk", "choices": [choice]}
+            self.send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        choice = {"index": 0, "delta": {}, "finish_reason": "stop"}
+        chunk = {**completion, "object": "chat.completion.chunk", "choices": [choice]}
+        self.send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        # Like OpenAI and Groq, usage is only streamed when asked for, in a chunk without choices.
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk = {**completion, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+            self.send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class StubServer(ThreadingHTTPServer):
+    # The default backlog of 5 makes bursts of new connections wait for SYN retries.
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid stream, e.g. a cancelled hedged request, are expected.
+        pass
+
+
+def start_stub_server(
+    port: int = 0,
+    latency: float = 0.2,
+    tokens_per_second: float = 100.0,
+    completion_tokens: int = 30,
+    error_rate: float = 0.0,
+    error_status: int = 500,
+):
+    """
+    Start the stub on a background thread and return the server - its base_url attribute is the
+    URL to give the client, server.requests counts completions served. Call server.shutdown() to stop.
+    """
+    server = StubServer(("127.0.0.1", port), StubHandler)
+    server.daemon_threads = True
+    server.config = {
+        "latency": latency,
+        "tokens_per_second": tokens_per_second,
+        "completion_tokens": completion_tokens,
+        "error_rate": error_rate,
+        "error_status": error_status,
+    }
+    server.requests = 0
+    server.lock = threading.Lock()
+    server.base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI compatible stub server")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--completion-tokens", type=int, default=30)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    args = parser.parse_args()
+
+    server = start_stub_server(
+        args.port,
+        args.latency,
+        args.tokens_per_second,
+        args.completion_tokens,
+        args.error_rate,
+        args.error_status,
+    )
+    print(f"Stub server listening on {server.base_url} - Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
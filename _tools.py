@@ -0,0 +1,134 @@
+"""
+A tool registry for native tool calling.
+
+Tools are plain functions registered with a decorator. The registry builds the JSON schemas
+passed as tools= to chat.completions.create() from their signatures and docstrings, and runs the
+tool_calls the model returns - concurrently when it asks for several in one turn, each with its
+own timeout - instead of parsing free text and eval()ing it:
+
+    tools = ToolRegistry()
+
+    @tools.register(description="Price of a product before VAT.", timeout=5)
+    def get_product_price(product: str) -> int:
+        return PRICES[product]
+
+    completion = client.chat.completions.create(model=MODEL, messages=messages, tools=tools.schemas())
+    messages += tools.run(completion.choices[0].message.tool_calls)
+"""
+
+import inspect
+import json
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+JSON_TYPES = {
+    int: "integer",
+    float: "number",
+    str: "string",
+    bool: "boolean",
+    list: "array",
+    dict: "object",
+}
+
+
+def json_type(annotation) -> dict:
+    if typing.get_origin(annotation) is list or annotation is list:
+        # Providers reject arrays without an items schema - plain list means a list of strings.
+        items = (typing.get_args(annotation) or (str,))[0]
+        return {"type": "array", "items": json_type(items)}
+    return {"type": JSON_TYPES.get(annotation, "string")}
+
+
+def function_schema(function, description: str = "", parameters: dict = None) -> dict:
+    """The tools= entry for function, with parameters taken from its annotated signature unless given."""
+    if parameters is None:
+        properties = {}
+        required = []
+        for name, parameter in inspect.signature(function).parameters.items():
+            properties[name] = json_type(parameter.annotation)
+            if parameter.default is inspect.Parameter.empty:
+                required.append(name)
+        parameters = {"type": "object", "properties": properties, "required": required}
+    return {
+        "type": "function",
+        "function": {
+            "name": function.__name__,
+            "description": description or inspect.getdoc(function) or "",
+            "parameters": parameters,
+        },
+    }
+
+
+class ToolRegistry:
+    def __init__(self, max_workers: int = 8, timeout: float = 30.0) -> None:
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.tools: dict = {}
+        self._executor = None
+
+    def register(
+        self, function=None, *, description: str = "", parameters: dict = None, timeout: float = None
+    ):
+        """
+        Register a tool, as @tools.register or @tools.register(timeout=5). parameters is a JSON
+        schema for arguments the signature cannot describe, e.g. a list of objects.
+        """
+
+        def decorator(function):
+            self.tools[function.__name__] = {
+                "function": function,
+                "schema": function_schema(function, description, parameters),
+                "timeout": timeout or self.timeout,
+            }
+            return function
+
+        return decorator(function) if function else decorator
+
+    def schemas(self) -> list:
+        return [tool["schema"] for tool in self.tools.values()]
+
+    def call(self, name: str, arguments: str):
+        """Run one tool with the JSON arguments the model sent."""
+        if name not in self.tools:
+            raise LookupError(f"Tool not found: {name}")
+        return self.tools[name]["function"](**json.loads(arguments or "{}"))
+
+    def run(self, tool_calls) -> list:
+        """
+        Run every tool call of one assistant turn and return the role="tool" messages answering them,
+        in the same order. Calls run concurrently on a thread pool; a call that raises or takes
+        longer than its tool's timeout is answered with an error the model can react to.
+        """
+        if not tool_calls:
+            return []
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="tool")
+        started = time.monotonic()
+        futures = [
+            (
+                tool_call,
+                self._executor.submit(self.call, tool_call.function.name, tool_call.function.arguments),
+            )
+            for tool_call in tool_calls
+        ]
+
+        messages = []
+        for tool_call, future in futures:
+            tool = self.tools.get(tool_call.function.name)
+            timeout = tool["timeout"] if tool else self.timeout
+            try:
+                result = {"result": future.result(timeout=max(0, started + timeout - time.monotonic()))}
+            except Exception as exc:
+                # On Python 3.11+ FutureTimeoutError is the builtin TimeoutError, which a tool may
+                # raise itself - only a future that is still running has timed out.
+                if isinstance(exc, FutureTimeoutError) and not future.done():
+                    # The thread cannot be stopped but the agent does not wait for it.
+                    result = {"error": f"{tool_call.function.name} timed out after {timeout}s"}
+                else:
+                    result = {"error": f"{type(exc).__name__}: {exc}"}
+            messages.append(
+                {"role": "tool", "tool_call_id": tool_call.id, "content": json.dumps(result, default=str)}
+            )
+        return messages
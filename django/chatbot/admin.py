@@ -1,6 +1,10 @@
 from django.contrib import admin
-from .models import Chat
+from .models import Chat, ChatJob, Fact, FactSource, LLMCall
 
 # Register your models here.
 
-admin.site.register(Chat)
\ No newline at end of file
+admin.site.register(Chat)
+admin.site.register(ChatJob)
+admin.site.register(LLMCall)
+admin.site.register(FactSource)
+admin.site.register(Fact)
@@ -4,3 +4,22 @@ from django.apps import AppConfig
 class ChatbotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatbot'
+
+    def ready(self):
+        from django.conf import settings
+        from django.db.backends.signals import connection_created
+        from _instrument import add_recorder
+        from django_chatbot.sqlite import apply_pragmas
+        from .metrics import record
+
+        # Every tracked LLM call feeds the metrics endpoint and the LLMCall table.
+        add_recorder(record)
+
+        # WAL and the other SQLite pragmas on every new connection (see django_chatbot/sqlite.py).
+        connection_created.connect(apply_pragmas, dispatch_uid="django_chatbot.sqlite")
+
+        # Open the provider connections now rather than on the first chat message.
+        if settings.LLM_WARM_UP:
+            from _get_client import warm_up_llm_clients
+
+            warm_up_llm_clients(settings.LLM_WARM_UP)
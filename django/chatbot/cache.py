@@ -0,0 +1,241 @@
+"""
+Response cache for the FAQ bot.
+
+Conference questions repeat a lot ("where is the venue", "what are the dates"), so answers are
+cached on the normalised question, the provider and model that answered and a hash of the system
+prompt - changing the FAQ or the model never serves a stale answer, and an answer from the
+failover provider is not served as the primary's. Empty answers are not cached. Concurrent
+identical questions are coalesced into one upstream call, and hits/misses are counted.
+
+Configured with the FAQ_CACHE setting:
+
+FAQ_CACHE = {
+    "BACKEND": "local",   # "local" (in process LRU) or "django" (the Django cache framework)
+    "TTL": 3600,          # seconds an answer is kept
+    "MAX_ENTRIES": 1000,  # LRU bound for "local" - for "django" configure the bound on the cache itself
+    "ALIAS": "default",   # cache alias for "django"
+}
+"""
+
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.core.cache import caches
+
+DEFAULTS = {"BACKEND": "local", "TTL": 3600, "MAX_ENTRIES": 1000, "ALIAS": "default"}
+
+
+def normalize_question(question: str) -> str:
+    """Lower case, collapse whitespace and drop trailing punctuation so near-identical questions match."""
+    question = re.sub(r"\s+", " ", question.lower()).strip()
+    return question.rstrip("?!. ")
+
+
+class LocalMemoryBackend:
+    """Thread safe in process LRU with a TTL."""
+
+    def __init__(self, ttl: int, max_entries: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoCacheBackend:
+    """Stores answers in a Django cache so they are shared between worker processes."""
+
+    def __init__(self, ttl: int, alias: str) -> None:
+        self.ttl = ttl
+        self.cache = caches[alias]
+
+    def get(self, key: str):
+        return self.cache.get(key)
+
+    def set(self, key: str, value: str) -> None:
+        self.cache.set(key, value, timeout=self.ttl)
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+
+def answered(result, provider: str, model: str) -> tuple:
+    """
+    (text, provider, model) of a call's result - a str is the requested model's answer, a
+    HedgedResult (_failover.py) may have come from another provider.
+    """
+    if isinstance(result, str):
+        return result, provider, model
+    return result.text, result.provider, result.model
+
+
+class ResponseCache:
+    def __init__(self, backend) -> None:
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._inflight: dict = {}
+        self._ainflight: dict = {}
+        self._lock = threading.Lock()
+
+    def key(self, provider: str, model: str, system_message: str, question: str) -> str:
+        system_hash = hashlib.sha256(system_message.encode()).hexdigest()[:16]
+        question_hash = hashlib.sha256(normalize_question(question).encode()).hexdigest()
+        return f"faq:{provider}:{model}:{system_hash}:{question_hash}"
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _store(self, result, provider, model, system_message, question) -> str:
+        # Filed under the provider that answered, so a failover answer is not served as the
+        # primary's. An empty answer is not kept - it would be served as a hit until the TTL.
+        text, provider, model = answered(result, provider, model)
+        if text.strip():
+            self.backend.set(self.key(provider, model, system_message, question), text)
+        return text
+
+    def get_or_call(self, provider: str, model: str, system_message: str, question: str, call):
+        """Return the cached answer, or call() once for all threads asking the same question."""
+        key = self.key(provider, model, system_message, question)
+        answer = self.backend.get(key)
+        if answer is not None:
+            self._count("hits")
+            return answer
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            answer = self._store(call(), provider, model, system_message, question)
+            future.set_result(answer)
+            return answer
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    async def aget_or_call(
+        self, provider: str, model: str, system_message: str, question: str, call
+    ):
+        """Async version of get_or_call - call is a coroutine function."""
+        key = self.key(provider, model, system_message, question)
+        answer = self.backend.get(key)
+        if answer is not None:
+            self._count("hits")
+            return answer
+
+        loop = asyncio.get_running_loop()
+        future = self._ainflight.get((loop, key))
+        if future is not None:
+            self._count("coalesced")
+            return await asyncio.shield(future)
+
+        self._count("misses")
+        future = self._ainflight[(loop, key)] = loop.create_future()
+        try:
+            answer = self._store(await call(), provider, model, system_message, question)
+            future.set_result(answer)
+            return answer
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()  # mark as retrieved when nobody else is waiting
+            raise
+        finally:
+            del self._ainflight[(loop, key)]
+
+    def stream(self, provider: str, model: str, system_message: str, question: str, deltas):
+        """Yield a cached answer in one piece, or pass the deltas through and cache the assembled answer."""
+        key = self.key(provider, model, system_message, question)
+        answer = self.backend.get(key)
+        if answer is not None:
+            self._count("hits")
+            yield answer
+            return
+
+        self._count("misses")
+        parts = []
+        for delta in deltas():
+            parts.append(delta)
+            yield delta
+        self._store("".join(parts).strip(), provider, model, system_message, question)
+
+    async def astream(self, provider: str, model: str, system_message: str, question: str, deltas):
+        """Async version of stream - deltas returns an async iterator."""
+        key = self.key(provider, model, system_message, question)
+        answer = self.backend.get(key)
+        if answer is not None:
+            self._count("hits")
+            yield answer
+            return
+
+        self._count("misses")
+        parts = []
+        async for delta in deltas():
+            parts.append(delta)
+            yield delta
+        self._store("".join(parts).strip(), provider, model, system_message, question)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+
+_faq_cache = None
+_faq_cache_lock = threading.Lock()
+
+
+def get_faq_cache() -> ResponseCache:
+    """The process wide FAQ cache, built from the FAQ_CACHE setting on first use."""
+    global _faq_cache
+    if _faq_cache is None:
+        with _faq_cache_lock:
+            if _faq_cache is None:
+                config = {**DEFAULTS, **getattr(settings, "FAQ_CACHE", {})}
+                if config["BACKEND"] == "django":
+                    backend = DjangoCacheBackend(config["TTL"], config["ALIAS"])
+                elif config["BACKEND"] == "local":
+                    backend = LocalMemoryBackend(config["TTL"], config["MAX_ENTRIES"])
+                else:
+                    raise ValueError("Invalid FAQ_CACHE BACKEND. Please choose 'local' or 'django'.")
+                _faq_cache = ResponseCache(backend)
+    return _faq_cache
@@ -0,0 +1,74 @@
+"""
+Keyset (cursor) pagination of a user's chat history.
+
+The page only renders the latest CHAT_PAGE_SIZE chats; older ones are fetched from the chat_history
+endpoint as the user scrolls up. Each page continues from the (created_at, id) of the oldest chat
+already shown, which the (user, created_at) index on Chat serves directly - unlike OFFSET, the cost
+of a page does not grow with how far back the user has scrolled.
+"""
+
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+from django_chatbot import write_behind
+from .models import Chat
+
+# Only the columns the templates need.
+FIELDS = ("id", "message", "response", "created_at")
+
+
+def encode_cursor(chat: dict) -> str:
+    return f"{chat['created_at'].isoformat()}|{chat['id']}"
+
+
+def decode_cursor(cursor: str) -> tuple:
+    created_at, id = cursor.rsplit("|", 1)
+    return datetime.fromisoformat(created_at), int(id)
+
+
+def page_queryset(user, cursor: str = "", limit: int = 0):
+    """Newest first, one more row than the page so we know whether there is another page."""
+    queryset = Chat.objects.filter(user=user)
+    if cursor:
+        created_at, id = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=id)
+        )
+    limit = limit or settings.CHAT_PAGE_SIZE
+    return queryset.order_by("-created_at", "-id").values(*FIELDS)[: limit + 1], limit
+
+
+def pending_chats(user, cursor: str) -> list:
+    # The newest chats may still be waiting in the write-behind buffer. Taken before the query
+    # so a chat flushed in between is not missed.
+    return [] if cursor else write_behind.pending(Chat, user_id=user.id)
+
+
+def make_page(chats: list, limit: int, pending: list) -> tuple:
+    next_cursor = encode_cursor(chats[limit - 1]) if len(chats) > limit else ""
+    chats = chats[:limit]
+    chats.reverse()
+    chats += [
+        {"id": None, "message": chat.message, "response": chat.response, "created_at": None}
+        for chat in write_behind.unsaved(pending, (chat["id"] for chat in chats))
+    ]
+    return chats, next_cursor
+
+
+def chat_page(user, cursor: str = "", limit: int = 0) -> tuple:
+    """
+    Return (chats, next_cursor): one page of chats older than cursor, oldest first,
+    and the cursor of the next (older) page or "" when there is none.
+    """
+    pending = pending_chats(user, cursor)
+    queryset, limit = page_queryset(user, cursor, limit)
+    return make_page(list(queryset), limit, pending)
+
+
+async def achat_page(user, cursor: str = "", limit: int = 0) -> tuple:
+    """Async version of chat_page."""
+    pending = pending_chats(user, cursor)
+    queryset, limit = page_queryset(user, cursor, limit)
+    return make_page([chat async for chat in queryset], limit, pending)
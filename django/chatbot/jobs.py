@@ -0,0 +1,247 @@
+"""
+Durable background jobs for chat answers - a queue in the database, no broker.
+
+A POST to the chatbot views holds its worker until the provider has finished the whole answer,
+so web capacity is tied to LLM latency, and an answer is lost if the process restarts while
+waiting. With JOB_QUEUE["ENABLED"] the view saves a ChatJob row and answers 202 with the job id
+straight away. The page polls chat_job (JSON, or an htmx fragment that polls itself) until the
+job is done.
+
+Workers claim the oldest available job with a conditional UPDATE on its status and attempt
+count, so two workers never run the same job. The claim gives the worker a lease of LEASE
+seconds - longer than the LLM timeout. A job whose worker died (restart, crash) is taken over
+once its lease expires. A failed attempt is retried after RETRY_DELAY seconds, doubling each
+time, and the job fails after MAX_ATTEMPTS - including attempts whose worker died, so a job that
+keeps killing its worker is not taken over forever. The answer and its Chat row are saved in one
+transaction.
+
+Jobs are run by:
+
+- LOCAL_WORKERS threads in the web process, started on the first enqueue or poll
+- python manage.py run_chat_jobs --workers 8, as a separate process (set LOCAL_WORKERS to 0)
+
+Either way the number of workers bounds how many LLM calls run at once.
+
+JOB_QUEUE = {"ENABLED": False, "LOCAL_WORKERS": 4, "LEASE": 120, "MAX_ATTEMPTS": 3,
+             "RETRY_DELAY": 2.0, "POLL_INTERVAL": 1.0}
+"""
+
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from _llm_config import get_llm_config
+from .models import Chat, ChatJob
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": False,
+    "LOCAL_WORKERS": 4,
+    "LEASE": 120,  # seconds
+    "MAX_ATTEMPTS": 3,
+    "RETRY_DELAY": 2.0,  # seconds before the first retry
+    "POLL_INTERVAL": 1.0,  # seconds an idle worker waits before looking again
+}
+
+
+def config() -> dict:
+    return {**DEFAULTS, **getattr(settings, "JOB_QUEUE", {})}
+
+
+def enabled() -> bool:
+    return config()["ENABLED"]
+
+
+def enqueue(user, message: str, view: str) -> ChatJob:
+    job = ChatJob.objects.create(
+        user=user, view=view, message=message, available_at=timezone.now()
+    )
+    start_local_workers().wake()
+    return job
+
+
+async def aenqueue(user, message: str, view: str) -> ChatJob:
+    job = await ChatJob.objects.acreate(
+        user=user, view=view, message=message, available_at=timezone.now()
+    )
+    start_local_workers().wake()
+    return job
+
+
+def available(now, max_attempts: int):
+    # Queued jobs that are due, and running jobs whose worker has let the lease expire.
+    return Q(
+        status__in=[ChatJob.Status.QUEUED, ChatJob.Status.RUNNING],
+        available_at__lte=now,
+        attempts__lt=max_attempts,
+    )
+
+
+def fail_expired(now, max_attempts: int) -> int:
+    """Fail the jobs whose lease expired on their last attempt - they are not taken over again."""
+    expired = ChatJob.objects.filter(
+        status=ChatJob.Status.RUNNING, available_at__lte=now, attempts__gte=max_attempts
+    )
+    # Checked with a read first, so idle workers polling do not take SQLite's write lock.
+    if not expired.exists():
+        return 0
+    return expired.update(
+        status=ChatJob.Status.FAILED,
+        error=f"The lease expired on attempt {max_attempts} of {max_attempts}",
+        finished_at=now,
+    )
+
+
+def claim(lease: float, max_attempts: int):
+    """Take the oldest available job, or return None when there is nothing to do."""
+    now = timezone.now()
+    fail_expired(now, max_attempts)
+    candidates = (
+        ChatJob.objects.filter(available(now, max_attempts))
+        .order_by("available_at", "id")
+        .values_list("id", "attempts")[:10]
+    )
+    for job_id, attempts in candidates:
+        # Only one worker's UPDATE matches - the others see the attempt count has moved on.
+        claimed = ChatJob.objects.filter(
+            available(now, max_attempts), pk=job_id, attempts=attempts
+        ).update(
+            status=ChatJob.Status.RUNNING,
+            available_at=now + timedelta(seconds=lease),
+            attempts=attempts + 1,
+        )
+        if claimed:
+            return ChatJob.objects.select_related("user").get(pk=job_id)
+    return None
+
+
+def answer(job: ChatJob) -> str:
+    # The same cached FAQ answer as a direct POST - imported here as the views import this module.
+    from .views import ask
+
+    return ask(get_llm_config(view=job.view), job.message)
+
+
+def run(job: ChatJob, max_attempts: int, retry_delay: float) -> None:
+    # Updates are conditional on the attempt, so a worker that outlived its lease - the job has
+    # been taken over - cannot overwrite the newer attempt or save the Chat twice.
+    current = ChatJob.objects.filter(
+        pk=job.pk, status=ChatJob.Status.RUNNING, attempts=job.attempts
+    )
+    try:
+        response = answer(job)
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"[:200]
+        now = timezone.now()
+        if job.attempts >= max_attempts:
+            current.update(status=ChatJob.Status.FAILED, error=error, finished_at=now)
+        else:
+            delay = retry_delay * 2 ** (job.attempts - 1)
+            current.update(
+                status=ChatJob.Status.QUEUED,
+                error=error,
+                available_at=now + timedelta(seconds=delay),
+            )
+        return
+    with transaction.atomic():
+        finished = current.update(
+            status=ChatJob.Status.DONE, response=response, error="", finished_at=timezone.now()
+        )
+        if finished:
+            Chat.objects.create(user=job.user, message=job.message, response=response)
+
+
+def run_next(options: dict = None) -> bool:
+    """Claim and run one job. False when the queue had nothing available."""
+    options = options or config()
+    job = claim(options["LEASE"], options["MAX_ATTEMPTS"])
+    if job is None:
+        return False
+    run(job, options["MAX_ATTEMPTS"], options["RETRY_DELAY"])
+    return True
+
+
+class JobWorkerPool:
+    """workers threads, each claiming and running one job at a time."""
+
+    def __init__(self, workers: int, options: dict = None) -> None:
+        self.options = options or config()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"chat-job-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self) -> "JobWorkerPool":
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def wake(self) -> None:
+        """A job was queued - idle workers look now rather than at their next poll."""
+        self._wake.set()
+
+    def _run(self) -> None:
+        try:
+            while not self._stopped.is_set():
+                close_old_connections()
+                try:
+                    found = run_next(self.options)
+                except Exception:
+                    # e.g. the database is briefly locked - the job is still in the queue.
+                    logger.exception("Chat job worker failed")
+                    found = False
+                if not found:
+                    self._wake.wait(self.options["POLL_INTERVAL"])
+                    self._wake.clear()
+        finally:
+            connection.close()
+
+    def stop(self) -> None:
+        """Let the running jobs finish and stop. Jobs still queued stay in the database."""
+        self._stopped.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+
+
+class _NoWorkers:
+    def wake(self) -> None:
+        pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def start_local_workers():
+    """The web process's pool, started on first use. A no-op with LOCAL_WORKERS 0."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                workers = config()["LOCAL_WORKERS"]
+                if workers:
+                    # Daemon threads - a job interrupted by the process exiting is taken over
+                    # by the next worker once its lease expires.
+                    _pool = JobWorkerPool(workers).start()
+                else:
+                    _pool = _NoWorkers()
+    return _pool
+
+
+def job_data(job: ChatJob) -> dict:
+    return {
+        "job": job.pk,
+        "status": job.status,
+        "message": job.message,
+        "response": job.response,
+        "error": job.error,
+    }
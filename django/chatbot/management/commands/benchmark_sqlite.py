@@ -0,0 +1,152 @@
+"""
+Benchmark concurrent chat reads and writes on SQLite with the default and the tuned profile.
+
+    python manage.py benchmark_sqlite --threads 16 --seconds 5 --write-ratio 0.25
+
+Each thread plays a worker serving chat requests against a throwaway database file. A request
+reads a conversation's latest 20 messages and, for --write-ratio of them, also looks up the
+conversation and appends a message. Like the views (ATOMIC_REQUESTS is off) every statement
+runs in autocommit - the INSERT is its own implicit transaction:
+
+- default: a new connection per request (CONN_MAX_AGE=0) and a rollback journal - Django's
+  defaults
+- tuned: one connection per thread with the pragmas from django_chatbot/sqlite.py - the
+  profile in settings.py (WAL, busy_timeout)
+
+Reports requests per second, "database is locked" errors and latency percentiles per profile.
+"""
+
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_chatbot.sqlite import pragma_statements, pragmas
+from .loadtest import percentile
+
+SCHEMA = [
+    "CREATE TABLE message (id INTEGER PRIMARY KEY, conversation_id INTEGER NOT NULL, "
+    "user_message TEXT NOT NULL, bot_message TEXT NOT NULL, timestamp REAL NOT NULL)",
+    "CREATE INDEX message_conv_time_idx ON message (conversation_id, timestamp)",
+]
+TEXT = "How do I get to the Talbot Hotel Stillorgan from Dublin airport? " * 4
+
+
+class Command(BaseCommand):
+    help = "Compare concurrent SQLite throughput with Django's defaults and the tuned profile."
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--profiles", nargs="+", choices=("default", "tuned"), default=["default", "tuned"]
+        )
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--seconds", type=float, default=5.0, help="duration per profile")
+        parser.add_argument("--write-ratio", type=float, default=0.25)
+        parser.add_argument("--conversations", type=int, default=200)
+        parser.add_argument("--rows", type=int, default=20_000, help="messages to start with")
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{options['threads']} threads for {options['seconds']}s each, "
+            f"write ratio {options['write_ratio']}, {options['rows']} messages\n"
+        )
+        self.stdout.write(
+            f"{'profile':<8} {'requests':>8} {'errors':>6} {'req/s':>8} {'writes/s':>8} "
+            f"{'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7}"
+        )
+        for profile in options["profiles"]:
+            with tempfile.TemporaryDirectory(prefix="benchmark_sqlite") as directory:
+                path = os.path.join(directory, "benchmark.sqlite3")
+                self.seed(path, options)
+                self.report(profile, self.run(profile, path, options), options["seconds"])
+
+    def seed(self, path, options):
+        connection = sqlite3.connect(path, isolation_level=None)
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.execute("BEGIN")
+        connection.executemany(
+            "INSERT INTO message (conversation_id, user_message, bot_message, timestamp) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                (i % options["conversations"], TEXT, TEXT, time.time())
+                for i in range(options["rows"])
+            ),
+        )
+        connection.execute("COMMIT")
+        connection.close()
+
+    def connect(self, profile, path):
+        # Django's sqlite3 backend: autocommit, with sqlite3's default 5 second busy timeout.
+        connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        if profile == "tuned":
+            for statement in pragma_statements(pragmas()):
+                connection.execute(statement)
+        return connection
+
+    def request(self, connection, conversation_id, write):
+        if write:
+            # get_conversation() - the conversation is looked up before the LLM is asked.
+            connection.execute(
+                "SELECT COUNT(*) FROM message WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+            # Message.save() outside a transaction.
+            connection.execute(
+                "INSERT INTO message (conversation_id, user_message, bot_message, timestamp) "
+                "VALUES (?, ?, ?, ?)",
+                (conversation_id, TEXT, TEXT, time.time()),
+            )
+        connection.execute(
+            "SELECT user_message, bot_message FROM message WHERE conversation_id = ? "
+            "ORDER BY timestamp DESC LIMIT 20",
+            (conversation_id,),
+        ).fetchall()
+
+    def run(self, profile, path, options):
+        deadline = time.perf_counter() + options["seconds"]
+        results = []
+        lock = threading.Lock()
+
+        def worker():
+            local = []
+            persistent = self.connect(profile, path) if profile == "tuned" else None
+            while time.perf_counter() < deadline:
+                write = random.random() < options["write_ratio"]
+                conversation_id = random.randrange(options["conversations"])
+                started = time.perf_counter()
+                connection = persistent or self.connect(profile, path)
+                try:
+                    self.request(connection, conversation_id, write)
+                    error = False
+                except sqlite3.OperationalError:
+                    error = True
+                finally:
+                    if persistent is None:
+                        connection.close()
+                local.append((time.perf_counter() - started, write, error))
+            if persistent is not None:
+                persistent.close()
+            with lock:
+                results.extend(local)
+
+        threads = [threading.Thread(target=worker) for _ in range(options["threads"])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def report(self, profile, results, seconds):
+        latencies = sorted(latency * 1000 for latency, _, _ in results)
+        errors = sum(1 for _, _, error in results if error)
+        writes = sum(1 for _, write, error in results if write and not error)
+        self.stdout.write(
+            f"{profile:<8} {len(results):>8} {errors:>6} {len(results) / seconds:>8.0f} "
+            f"{writes / seconds:>8.0f} {percentile(latencies, 50):>7.1f} "
+            f"{percentile(latencies, 95):>7.1f} {percentile(latencies, 99):>7.1f}"
+        )
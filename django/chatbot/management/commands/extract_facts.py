@@ -0,0 +1,66 @@
+"""
+Extract teachability facts from the transcript archive (see chatbot/teachability.py).
+
+    python manage.py extract_facts --source conversations
+    python manage.py extract_facts --source jsonl --file archive.jsonl --concurrency 16
+
+Rerunning the same command resumes - conversations already extracted are skipped.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.models import FactSource
+from chatbot.teachability import (
+    chat_sources,
+    conversation_sources,
+    jsonl_sources,
+    run_extraction,
+)
+from _llm_config import PROVIDERS, get_llm_config
+
+
+class Command(BaseCommand):
+    help = "Extract summaries and facts from stored conversations into Fact rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--source", choices=("conversations", "chats", "jsonl"), default="conversations"
+        )
+        parser.add_argument("--file", help="JSONL file for --source jsonl")
+        parser.add_argument("--provider", choices=PROVIDERS, help="defaults to settings.LLM")
+        parser.add_argument("--model", help="defaults to the provider's model in settings.LLM")
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--batch-size", type=int, default=100, help="sources per bulk insert")
+        parser.add_argument("--max-reasks", type=int, default=2, help="re-asks for invalid JSON")
+
+    def handle(self, *args, **options):
+        done = set(FactSource.objects.values_list("key", flat=True).iterator())
+        if options["source"] == "conversations":
+            sources = conversation_sources(done)
+        elif options["source"] == "chats":
+            sources = chat_sources(done)
+        else:
+            if not options["file"]:
+                raise CommandError("--source jsonl needs --file")
+            sources = jsonl_sources(done, options["file"])
+
+        self.stdout.write(f"{len(done)} sources already extracted")
+        config = get_llm_config(
+            view="extract_facts", provider=options["provider"], model=options["model"]
+        )
+        started = time.perf_counter()
+        summary = run_extraction(
+            sources,
+            config.provider,
+            config.model,
+            concurrency=options["concurrency"],
+            batch_size=options["batch_size"],
+            max_reasks=options["max_reasks"],
+            on_error=lambda key, error: self.stderr.write(f"{key}: {type(error).__name__}: {error}"),
+        )
+        self.stdout.write(
+            f"{summary['sources']} sources, {summary['facts']} facts, {summary['errors']} errors "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
@@ -0,0 +1,176 @@
+"""
+Load test the chat views against a local OpenAI compatible stub server.
+
+    python manage.py loadtest --users 20 --requests 10 --latency 0.5
+    python manage.py loadtest --mode async --stream --views chatbot groq
+
+No network access or API key is needed: both providers are pointed at _stub_server.py and a
+throwaway test database is created and destroyed around the run. Reports throughput and
+p50/p95/p99 latency per view so changes to the request path can be compared.
+"""
+
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from _stub_server import start_stub_server
+from chatbot import metrics
+
+# name: (sync path, async path, needs a logged in user)
+VIEWS = {
+    "chatbot": ("/", "/async/", True),
+    "groq": ("/groq/", "/groq/async/", True),
+    "chat_view": ("/chatbot-app/", "/chatbot-app/async/", False),
+}
+
+
+def percentile(sorted_values: list, percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    help = "Drive the chat views with concurrent simulated users against a local LLM stub server."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--views", nargs="+", choices=VIEWS, default=list(VIEWS))
+        parser.add_argument("--users", type=int, default=10, help="concurrent simulated users")
+        parser.add_argument("--requests", type=int, default=5, help="messages sent by each user")
+        parser.add_argument("--mode", choices=("sync", "async"), default="sync")
+        parser.add_argument("--stream", action="store_true", help="ask for Server-Sent Events")
+        parser.add_argument(
+            "--questions",
+            type=int,
+            default=0,
+            help="number of distinct questions to draw from (0 = every message is unique)",
+        )
+        parser.add_argument("--latency", type=float, default=0.2, help="stub seconds to first token")
+        parser.add_argument("--tokens-per-second", type=float, default=100.0)
+        parser.add_argument("--completion-tokens", type=int, default=30)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+        parser.add_argument("--error-status", type=int, default=500)
+
+    def handle(self, *args, **options):
+        server = start_stub_server(
+            latency=options["latency"],
+            tokens_per_second=options["tokens_per_second"],
+            completion_tokens=options["completion_tokens"],
+            error_rate=options["error_rate"],
+            error_status=options["error_status"],
+        )
+        for provider in ("OPENAI", "GROQ"):
+            os.environ[f"{provider}_BASE_URL"] = server.base_url
+            os.environ.setdefault(f"{provider}_API_KEY", "stub-api-key")
+            # The stub has no rate limits - set <PROVIDER>_RPM/_TPM to load test the limiter itself.
+            os.environ.setdefault(f"{provider}_RPM", "1000000")
+            os.environ.setdefault(f"{provider}_TPM", "1000000000")
+        # Separate buckets so a run does not use up the real providers' limits (see _ratelimit.py).
+        limits_dir = tempfile.mkdtemp(prefix="loadtest")
+        os.environ["LLM_RATE_LIMIT_DB"] = os.path.join(limits_dir, "limits.sqlite3")
+        # Failed requests are counted in the report, not logged with a traceback each.
+        logging.getLogger("django.request").setLevel(logging.CRITICAL)
+
+        setup_test_environment()
+        if connection.vendor == "sqlite":
+            # A file, not the shared in-memory database, which locks whole tables under concurrent writers.
+            test_dir = tempfile.mkdtemp(prefix="loadtest")
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(test_dir, "loadtest.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            users = [
+                User.objects.create_user(f"loadtest{i}", password="loadtest")
+                for i in range(options["users"])
+            ]
+            self.stdout.write(
+                f"{options['users']} users x {options['requests']} requests, mode={options['mode']}, "
+                f"stream={options['stream']}, stub latency={options['latency']}s, "
+                f"{options['tokens_per_second']} tokens/s, error rate={options['error_rate']}\n"
+            )
+            self.stdout.write(
+                f"{'view':<10} {'requests':>8} {'errors':>6} {'req/s':>7} "
+                f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'llm calls':>9}"
+            )
+            for name in options["views"]:
+                stub_requests = server.requests
+                started = time.perf_counter()
+                if options["mode"] == "sync":
+                    results = self.run_sync(name, users, options)
+                else:
+                    results = asyncio.run(self.run_async(name, users, options))
+                elapsed = time.perf_counter() - started
+                self.report(name, results, elapsed, server.requests - stub_requests)
+        finally:
+            metrics.flush_calls()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            server.shutdown()
+
+    def question(self, name, options, user_index, request_index):
+        # Per view, so one view's answers are not served from the FAQ cache to the next.
+        if options["questions"]:
+            number = (user_index * options["requests"] + request_index) % options["questions"]
+            return f"{name} question {number}"
+        return f"{name} question {request_index} from user {user_index}"
+
+    def headers(self, options):
+        return {"Accept": "text/event-stream"} if options["stream"] else {}
+
+    def run_sync(self, name, users, options):
+        path, _, needs_login = VIEWS[name]
+
+        def simulate(user_index):
+            client = Client(raise_request_exception=False, headers=self.headers(options))
+            if needs_login:
+                client.force_login(users[user_index])
+            results = []
+            for request_index in range(options["requests"]):
+                started = time.perf_counter()
+                message = self.question(name, options, user_index, request_index)
+                response = client.post(path, {"message": message})
+                if response.streaming:
+                    b"".join(response.streaming_content)
+                results.append((time.perf_counter() - started, response.status_code))
+            return results
+
+        with ThreadPoolExecutor(max_workers=len(users)) as executor:
+            return [result for results in executor.map(simulate, range(len(users))) for result in results]
+
+    async def run_async(self, name, users, options):
+        _, path, needs_login = VIEWS[name]
+
+        async def simulate(user_index):
+            client = AsyncClient(raise_request_exception=False, headers=self.headers(options))
+            if needs_login:
+                await client.aforce_login(users[user_index])
+            results = []
+            for request_index in range(options["requests"]):
+                started = time.perf_counter()
+                message = self.question(name, options, user_index, request_index)
+                response = await client.post(path, {"message": message})
+                if response.streaming:
+                    [chunk async for chunk in response.streaming_content]
+                results.append((time.perf_counter() - started, response.status_code))
+            return results
+
+        all_results = await asyncio.gather(*(simulate(i) for i in range(len(users))))
+        return [result for results in all_results for result in results]
+
+    def report(self, name, results, elapsed, llm_calls):
+        latencies = sorted(latency * 1000 for latency, _ in results)
+        errors = sum(1 for _, status in results if status >= 400)
+        self.stdout.write(
+            f"{name:<10} {len(results):>8} {errors:>6} {len(results) / elapsed:>7.1f} "
+            f"{percentile(latencies, 50):>8.0f} {percentile(latencies, 95):>8.0f} "
+            f"{percentile(latencies, 99):>8.0f} {llm_calls:>9}"
+        )
@@ -0,0 +1,42 @@
+"""
+Run queued chat jobs (see chatbot/jobs.py) in their own process.
+
+    python manage.py run_chat_jobs --workers 8
+    python manage.py run_chat_jobs --burst      # stop when the queue is empty
+
+--workers bounds the number of LLM calls in flight. Several of these processes can share one
+queue. Ctrl-C lets the running jobs finish - jobs still queued stay in the database.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatbot import jobs
+from chatbot.models import ChatJob
+
+
+class Command(BaseCommand):
+    help = "Run the chat jobs queued by the chatbot views when JOB_QUEUE is enabled."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="jobs run at once")
+        parser.add_argument("--burst", action="store_true", help="exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        pool = jobs.JobWorkerPool(options["workers"]).start()
+        self.stdout.write(f"Running chat jobs with {options['workers']} workers")
+        try:
+            while not (options["burst"] and not self.remaining()):
+                time.sleep(jobs.config()["POLL_INTERVAL"])
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping - waiting for the running jobs")
+        pool.stop()
+        done = ChatJob.objects.filter(status=ChatJob.Status.DONE).count()
+        failed = ChatJob.objects.filter(status=ChatJob.Status.FAILED).count()
+        self.stdout.write(f"{done} jobs done, {failed} failed, {self.remaining()} pending")
+
+    def remaining(self):
+        return ChatJob.objects.filter(
+            status__in=[ChatJob.Status.QUEUED, ChatJob.Status.RUNNING]
+        ).count()
@@ -0,0 +1,159 @@
+"""
+LLM call metrics.
+
+record() is registered with _instrument.add_recorder in ChatbotConfig.ready. Each call is kept
+in this process's counters and histograms, served in the Prometheus text exposition format by
+the metrics view, and stored as an LLMCall row (written in batches off the request path, see
+django_chatbot/write_behind.py) unless LLM_METRICS["STORE_CALLS"] is False.
+"""
+
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+
+from _get_client import llm_pool_stats
+from _prompt import prefix_cache_stats
+from django_chatbot.write_behind import WriteBehindBuffer
+from .cache import get_faq_cache
+from .models import LLMCall
+
+# Histogram buckets in seconds - LLM calls take from a few hundred ms to tens of seconds.
+BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_requests: dict = {}
+_tokens: dict = {}
+_latency: dict = {}
+_ttft: dict = {}
+_call_buffer = None
+
+
+def store_calls() -> bool:
+    return getattr(settings, "LLM_METRICS", {}).get("STORE_CALLS", True)
+
+
+def observe(histograms: dict, labels: tuple, value: float) -> None:
+    histogram = histograms.setdefault(labels, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+    for i, bound in enumerate(BUCKETS):
+        if value <= bound:
+            histogram["buckets"][i] += 1
+    histogram["sum"] += value
+    histogram["count"] += 1
+
+
+def record(call) -> None:
+    global _call_buffer
+    labels = (call.provider, call.model)
+    with _lock:
+        status = (*labels, call.error or "ok")
+        _requests[status] = _requests.get(status, 0) + 1
+        for kind in ("prompt", "completion", "cached"):
+            key = (*labels, kind)
+            _tokens[key] = _tokens.get(key, 0) + getattr(call, f"{kind}_tokens")
+        observe(_latency, labels, call.latency)
+        if call.time_to_first_token is not None:
+            observe(_ttft, labels, call.time_to_first_token)
+        if store_calls() and _call_buffer is None:
+            _call_buffer = WriteBehindBuffer(max_rows=100, max_delay=2.0)
+            atexit.register(_call_buffer.close)
+
+    if store_calls():
+        # Always buffered - record() runs inside async views too, where the ORM cannot be called directly.
+        stored = _call_buffer.add(
+            LLMCall(
+                provider=call.provider,
+                model=call.model,
+                prompt_tokens=call.prompt_tokens,
+                completion_tokens=call.completion_tokens,
+                cached_tokens=call.cached_tokens,
+                latency=call.latency,
+                time_to_first_token=call.time_to_first_token,
+                error=call.error,
+            )
+        )
+        if not stored:
+            logger.warning("LLMCall buffer is full - call to %s/%s not stored", *labels)
+
+
+def flush_calls() -> None:
+    """Write the buffered LLMCall rows now, e.g. before the database goes away."""
+    if _call_buffer is not None:
+        _call_buffer.flush()
+
+
+def format_labels(**labels) -> str:
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def format_histogram(lines: list, name: str, histograms: dict) -> None:
+    for (provider, model), histogram in histograms.items():
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            labels = format_labels(provider=provider, model=model, le=bound)
+            lines.append(f"{name}_bucket{labels} {count}")
+        labels = format_labels(provider=provider, model=model, le="+Inf")
+        lines.append(f"{name}_bucket{labels} {histogram['count']}")
+        labels = format_labels(provider=provider, model=model)
+        lines.append(f"{name}_sum{labels} {histogram['sum']}")
+        lines.append(f"{name}_count{labels} {histogram['count']}")
+
+
+def render_metrics() -> str:
+    """This process's metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        lines.append("# HELP llm_requests_total LLM calls by provider, model and status.")
+        lines.append("# TYPE llm_requests_total counter")
+        for (provider, model, status), count in _requests.items():
+            labels = format_labels(provider=provider, model=model, status=status)
+            lines.append(f"llm_requests_total{labels} {count}")
+
+        lines.append("# HELP llm_tokens_total Tokens used by provider, model and type.")
+        lines.append("# TYPE llm_tokens_total counter")
+        for (provider, model, kind), count in _tokens.items():
+            labels = format_labels(provider=provider, model=model, type=kind)
+            lines.append(f"llm_tokens_total{labels} {count}")
+
+        lines.append("# HELP llm_request_duration_seconds Total LLM call latency.")
+        lines.append("# TYPE llm_request_duration_seconds histogram")
+        format_histogram(lines, "llm_request_duration_seconds", _latency)
+
+        lines.append("# HELP llm_time_to_first_token_seconds Time to the first streamed token.")
+        lines.append("# TYPE llm_time_to_first_token_seconds histogram")
+        format_histogram(lines, "llm_time_to_first_token_seconds", _ttft)
+
+    cache_stats = get_faq_cache().stats()
+    lines.append("# HELP llm_faq_cache_total FAQ answer cache lookups by result.")
+    lines.append("# TYPE llm_faq_cache_total counter")
+    for result, count in cache_stats.items():
+        lines.append(f"llm_faq_cache_total{format_labels(result=result)} {count}")
+
+    # Per static prompt prefix (see _prompt.py) - cached / prompt tokens is the provider's hit rate.
+    prefixes = prefix_cache_stats()
+    lines.append("# HELP llm_prompt_prefix_tokens_total Prompt tokens per prompt prefix by type.")
+    lines.append("# TYPE llm_prompt_prefix_tokens_total counter")
+    for fingerprint, stats in prefixes.items():
+        for kind in ("prompt", "cached"):
+            labels = format_labels(prefix=fingerprint, type=kind)
+            lines.append(f"llm_prompt_prefix_tokens_total{labels} {stats[kind + '_tokens']}")
+    lines.append("# HELP llm_prompt_prefix_requests_total Requests per prompt prefix.")
+    lines.append("# TYPE llm_prompt_prefix_requests_total counter")
+    for fingerprint, stats in prefixes.items():
+        labels = format_labels(prefix=fingerprint)
+        lines.append(f"llm_prompt_prefix_requests_total{labels} {stats['requests']}")
+
+    lines.append("# HELP llm_pool_connections Pooled HTTP connections per provider client.")
+    lines.append("# TYPE llm_pool_connections gauge")
+    for pool in llm_pool_stats():
+        for state in ("open", "idle"):
+            labels = format_labels(provider=pool["provider"], base_url=pool["base_url"], state=state)
+            lines.append(f"llm_pool_connections{labels} {pool[state + '_connections']}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['user', 'created_at'], name='chat_user_created_idx'),
+        ),
+    ]
@@ -9,5 +9,89 @@ class Chat(models.Model):
     response = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # History is always read per user, newest first (see history.py).
+        # SQLite appends the id to every index so it also serves the (created_at, id) tie break.
+        indexes = [models.Index(fields=["user", "created_at"], name="chat_user_created_idx")]
+
+    def __str__(self):
+        return f'{self.user.username}: {self.message}'
+
+class LLMCall(models.Model):
+    """One provider call, recorded by chatbot/metrics.py."""
+
+    provider = models.CharField(max_length=20)
+    model = models.CharField(max_length=100)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    cached_tokens = models.PositiveIntegerField(default=0)
+    latency = models.FloatField(help_text="Seconds")
+    time_to_first_token = models.FloatField(null=True, blank=True, help_text="Seconds")
+    error = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.provider}/{self.model}: {self.latency:.2f}s"
+
+
+class FactSource(models.Model):
+    """
+    A conversation the teachability facts were extracted from (see chatbot/teachability.py).
+    One row per source key is also the checkpoint - sources already here are skipped on resume.
+    """
+
+    key = models.CharField(max_length=200, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    summary = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.key
+
+
+class Fact(models.Model):
+    source = models.ForeignKey(FactSource, on_delete=models.CASCADE, related_name="facts")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    fact = models.TextField()
+    category = models.CharField(max_length=100, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.category}: {self.fact}"
+
+
+class ChatJob(models.Model):
+    """
+    A chat message waiting for, or given, its answer from the LLM (see chatbot/jobs.py).
+    The row is the queue entry, so queued and interrupted jobs survive a restart.
+    """
+
+    class Status(models.TextChoices):
+        QUEUED = "queued"
+        RUNNING = "running"
+        DONE = "done"
+        FAILED = "failed"
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    view = models.CharField(max_length=50, help_text="The view whose settings.LLM entry is used")
+    message = models.TextField()
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.QUEUED)
+    # When a queued job may run (retries back off), or when a running job's lease expires and
+    # another worker may take it over.
+    available_at = models.DateTimeField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    response = models.TextField(blank=True)
+    error = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # Workers claim the oldest available queued or expired running job.
+        indexes = [models.Index(fields=["status", "available_at"], name="chatjob_status_available_idx")]
+
+    @property
+    def pending(self):
+        return self.status in (self.Status.QUEUED, self.Status.RUNNING)
+
     def __str__(self):
-        return f'{self.user.username}: {self.message}'
\ No newline at end of file
+        return f"{self.user.username}: {self.message} ({self.status})"
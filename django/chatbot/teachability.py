@@ -0,0 +1,127 @@
+"""
+Bulk teachability extraction into Fact rows.
+
+Conversations are streamed from the chatbot_app Conversation/Message tables, the chatbot Chat
+table or a JSONL file, run through _extraction.extract_facts with bounded concurrency, and the
+facts are written with bulk_create in batches. Every extracted conversation gets a FactSource row
+keyed by its source, which is the checkpoint: a rerun skips the keys already stored, so an
+interrupted run resumes where it stopped. Failed conversations are not stored and are retried
+on the next run.
+
+    python manage.py extract_facts --source conversations --concurrency 16
+"""
+
+from itertools import groupby
+
+from django.db import transaction
+from django.db.models import Prefetch
+
+from _extraction import extract_facts, extract_stream, read_jsonl
+from _get_client import get_llm_client
+from chatbot_app.models import Conversation, Message
+from .models import Chat, Fact, FactSource
+
+# Chats are not grouped into conversations, so each user's chats are taken in blocks of this size.
+# Only full blocks are extracted - the last one is picked up by a later run once it is full.
+CHATS_PER_SOURCE = 20
+
+
+def conversation_sources(done: set):
+    conversations = Conversation.objects.order_by("id").prefetch_related(
+        Prefetch("messages", queryset=Message.objects.order_by("timestamp", "id"))
+    )
+    for conversation in conversations.iterator(chunk_size=200):
+        key = f"conversation:{conversation.id}"
+        messages = list(conversation.messages.all())
+        if key in done or not messages:
+            continue
+        text = "\n".join(
+            f"user: {message.user_message}\nassistant: {message.bot_message}" for message in messages
+        )
+        yield (key, conversation.user_id), text
+
+
+def chat_sources(done: set):
+    chats = Chat.objects.order_by("user_id", "id").values_list(
+        "id", "user_id", "message", "response"
+    )
+    for user_id, user_chats in groupby(chats.iterator(chunk_size=2000), key=lambda chat: chat[1]):
+        block = []
+        for chat in user_chats:
+            block.append(chat)
+            if len(block) == CHATS_PER_SOURCE:
+                key = f"chats:{user_id}:{block[0][0]}"
+                if key not in done:
+                    text = "\n".join(f"user: {c[2]}\nassistant: {c[3]}" for c in block)
+                    yield (key, user_id), text
+                block = []
+
+
+def jsonl_sources(done: set, path: str):
+    for source_id, text in read_jsonl(path):
+        key = f"jsonl:{source_id}"
+        if key not in done and text:
+            yield (key, None), text
+
+
+def save_batch(results: list) -> tuple:
+    """
+    Store one batch of ((key, user_id), ExtractionSchema) results and return the number of sources
+    and facts written. Keys repeated in the batch or already stored (by an earlier or a concurrent
+    run) are skipped.
+    """
+    with transaction.atomic():
+        # transaction_mode=IMMEDIATE holds the write lock from here, so no other run can insert
+        # one of these keys between the check and the insert.
+        keys = {key for (key, _), _ in results}
+        stored = set(FactSource.objects.filter(key__in=keys).values_list("key", flat=True))
+        new = []
+        for (key, user_id), result in results:
+            if key not in stored:
+                stored.add(key)
+                new.append((FactSource(key=key, user_id=user_id, summary=result.summary), result))
+        sources = FactSource.objects.bulk_create([source for source, _ in new])
+        facts = Fact.objects.bulk_create(
+            [
+                Fact(source=source, user_id=source.user_id, fact=fact.fact, category=fact.category)
+                for source, (_, result) in zip(sources, new)
+                for fact in result.facts
+            ]
+        )
+    return len(sources), len(facts)
+
+
+def run_extraction(
+    sources,
+    provider: str,
+    model: str,
+    concurrency: int = 8,
+    batch_size: int = 100,
+    max_reasks: int = 2,
+    on_error=None,
+) -> dict:
+    client = get_llm_client(provider)
+    summary = {"sources": 0, "facts": 0, "errors": 0}
+    batch = []
+
+    def extract(text):
+        return extract_facts(client, model, text, max_reasks=max_reasks, provider=provider)
+
+    def save(batch):
+        sources, facts = save_batch(batch)
+        summary["sources"] += sources
+        summary["facts"] += facts
+
+    for key, result, error in extract_stream(sources, extract, concurrency):
+        if error is not None:
+            summary["errors"] += 1
+            if on_error:
+                on_error(key[0], error)
+            continue
+        batch.append((key, result))
+        if len(batch) >= batch_size:
+            save(batch)
+            batch = []
+    if batch:
+        save(batch)
+    return summary
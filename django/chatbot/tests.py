@@ -1,3 +1,1271 @@
-from django.test import TestCase
+import asyncio
+import email.utils
+import json
+import os
+import threading
+import tempfile
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth.models import User
+from django.db import IntegrityError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+from openai import RateLimitError
+from openai.types import CompletionUsage
+from pydantic import BaseModel, ConfigDict
+
+import _failover
+import _instrument
+import _ratelimit
+from _batch import read_checkpoint, run_batch
+from _catalog import Catalog
+from _extraction import ExtractionSchema, FactSchema
+from _structured import SchemaViolation, StructuredParser, stream_model
+from _failover import CircuitOpen, HedgedDispatcher, HedgedResult
+from _get_client import get_llm_client
+from _llm_config import get_llm_config
+from _prompt import record_usage
+from _reflection import GENERATOR_SYSTEM, Reflection
+from _ratelimit import RateLimitExceeded, SharedBuckets, retry_after
+from _retrieval import BM25Index, chunk_documents
+from _router import IntentRouter, RouteDecision, parse_reports
+from _tools import ToolRegistry
+from _stub_server import start_stub_server
+from django_chatbot import write_behind
+from django_chatbot.write_behind import WriteBehindBuffer
+from . import cache, history, jobs, teachability
+from .cache import LocalMemoryBackend, ResponseCache
+from .models import Chat, ChatJob, Fact, FactSource, LLMCall
+from .views import acomplete_stream, astream_chat, complete_stream, prompt_prefix, stream_chat
+
+
+class StubLLMMixin:
+    """Both providers pointed at a local _stub_server, with their own rate limit buckets."""
+
+    stub_options = {"latency": 0, "tokens_per_second": 10_000, "completion_tokens": 5}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = start_stub_server(**cls.stub_options)
+        cls.rate_limit_dir = tempfile.TemporaryDirectory()
+        environ = {"LLM_RATE_LIMIT_DB": os.path.join(cls.rate_limit_dir.name, "buckets.sqlite3")}
+        for provider in ("GROQ", "OPENAI"):
+            environ.update(
+                {
+                    f"{provider}_BASE_URL": cls.stub.base_url,
+                    f"{provider}_API_KEY": "test-key",
+                    f"{provider}_RPM": "100000",
+                    f"{provider}_TPM": "100000000",
+                }
+            )
+        cls.patches = [
+            mock.patch.dict(os.environ, environ),
+            mock.patch.object(_ratelimit, "_buckets", None),
+        ]
+        for patch in cls.patches:
+            patch.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        for patch in reversed(cls.patches):
+            patch.stop()
+        cls.stub.shutdown()
+        cls.stub.server_close()
+        cls.rate_limit_dir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        recorders = mock.patch.object(_instrument, "_recorders", [self.calls.append])
+        recorders.start()
+        self.addCleanup(recorders.stop)
+
+
+def deltas(fail=False):
+    yield "The venue is "
+    yield "the Talbot Hotel"
+    if fail:
+        raise ConnectionError("provider went away")
+
+
+async def adeltas(fail=False):
+    for delta in deltas(fail):
+        yield delta
+
+
+class StreamChatTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("alice", password="secret")
+
+    def test_done_event_carries_and_saves_the_answer(self):
+        body = b"".join(stream_chat(self.user, "Where?", deltas()).streaming_content).decode()
+        self.assertEqual(body.count("event: delta"), 2)
+        self.assertIn("event: done", body)
+        self.assertEqual(Chat.objects.get().response, "The venue is the Talbot Hotel")
+
+    def test_provider_failure_mid_stream_sends_an_error_event(self):
+        with self.assertLogs("chatbot.views", "ERROR"):
+            body = b"".join(
+                stream_chat(self.user, "Where?", deltas(fail=True)).streaming_content
+            ).decode()
+        self.assertIn("event: error", body)
+        self.assertNotIn("event: done", body)
+        self.assertFalse(Chat.objects.exists())
+
+    async def test_async_provider_failure_mid_stream_sends_an_error_event(self):
+        response = astream_chat(self.user, "Where?", adeltas(fail=True))
+        with self.assertLogs("chatbot.views", "ERROR"):
+            body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertIn("event: error", body)
+        self.assertNotIn("event: done", body)
+        self.assertFalse(await Chat.objects.aexists())
+
+
+class MetricsTests(TestCase):
+    def test_prompt_prefix_cache_tokens_are_reported(self):
+        usage = {"prompt_tokens": 400, "prompt_tokens_details": {"cached_tokens": 256}}
+        record_usage(prompt_prefix, usage)
+        body = self.client.get("/metrics/").content.decode()
+        labels = f'prefix="{prompt_prefix.fingerprint}"'
+        self.assertRegex(body, rf'llm_prompt_prefix_tokens_total{{{labels},type="cached"}} \d+')
+        self.assertIn(f"llm_prompt_prefix_requests_total{{{labels}}}", body)
+
+
+class ChatHistoryTests(TestCase):
+    def test_anonymous_users_get_401(self):
+        response = self.client.get("/history/")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json(), {"error": "Login required"})
+
+    def test_logged_in_users_get_their_chats(self):
+        user = User.objects.create_user("alice", password="secret")
+        Chat.objects.create(user=user, message="Where?", response="Dublin")
+        self.client.force_login(user)
+        chats = self.client.get("/history/").json()["chats"]
+        self.assertEqual([chat["message"] for chat in chats], ["Where?"])
+
+
+def llm_call(**fields):
+    return LLMCall(provider="groq", model="llama-3.3-70b-versatile", latency=0.5, **fields)
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("alice", password="secret")
+        # Only flushed when a test says so.
+        self.buffer = WriteBehindBuffer(max_rows=1000, max_delay=60, max_pending=3, max_retries=3)
+
+    def tearDown(self):
+        # Rows a test left behind belong to its rolled back transaction - do not write them.
+        with mock.patch.object(self.buffer, "flush"):
+            self.buffer.close()
+
+    def test_a_failed_flush_writes_nothing_and_keeps_the_rows(self):
+        self.buffer.add(llm_call())
+        self.buffer.add(Chat(user=self.user, message=None, response="no message"))
+        with self.assertRaises(IntegrityError):
+            self.buffer.flush()
+        # The LLMCall insert was rolled back with the Chat insert, so a retry cannot duplicate it.
+        self.assertFalse(LLMCall.objects.exists())
+        self.assertEqual(len(self.buffer.pending(LLMCall)), 1)
+        self.assertIsNone(self.buffer.pending(LLMCall)[0].pk)
+
+    def test_a_bad_row_is_set_aside_after_max_retries(self):
+        bad = Chat(user=self.user, message=None, response="no message")
+        self.buffer.add(llm_call())
+        self.buffer.add(bad)
+        for _ in range(2):
+            with self.assertRaises(IntegrityError):
+                self.buffer.flush()
+        with self.assertLogs("django_chatbot.write_behind", "ERROR"):
+            self.buffer.flush()
+        self.assertEqual(LLMCall.objects.count(), 1)
+        self.assertEqual(list(self.buffer.failed), [bad])
+        self.assertEqual(self.buffer.pending(Chat), [])
+        # The buffer is unwedged.
+        self.buffer.add(Chat(user=self.user, message="Where?", response="Dublin"))
+        self.buffer.flush()
+        self.assertEqual(Chat.objects.count(), 1)
+
+    def test_a_full_buffer_saves_directly(self):
+        for _ in range(3):
+            self.assertTrue(self.buffer.add(llm_call()))
+        self.assertFalse(self.buffer.add(llm_call()))
+        with mock.patch.object(write_behind, "get_buffer", return_value=self.buffer):
+            write_behind.save(llm_call(error="direct"))
+        self.assertEqual(list(LLMCall.objects.values_list("error", flat=True)), ["direct"])
+        self.buffer.flush()
+        self.assertEqual(LLMCall.objects.count(), 4)
+
+    def test_a_chat_flushed_during_the_history_query_is_shown_once(self):
+        self.buffer.add(Chat(user=self.user, message="Where?", response="Dublin"))
+        page_queryset = history.page_queryset
+
+        def flush_then_query(*args, **kwargs):
+            self.buffer.flush()
+            return page_queryset(*args, **kwargs)
+
+        with mock.patch.object(write_behind, "get_buffer", return_value=self.buffer):
+            with mock.patch.object(history, "page_queryset", flush_then_query):
+                chats, _ = history.chat_page(self.user)
+        self.assertEqual([chat["message"] for chat in chats], ["Where?"])
+        self.assertIsNotNone(chats[0]["id"])
+
+
+class WriteBehindShutdownTests(TransactionTestCase):
+    def test_close_writes_the_buffered_rows(self):
+        buffer = WriteBehindBuffer(max_rows=1000, max_delay=60)
+        for _ in range(5):
+            buffer.add(llm_call())
+        buffer.close()
+        self.assertEqual(LLMCall.objects.count(), 5)
+        with self.assertRaises(RuntimeError):
+            buffer.add(llm_call())
+
+
+class StreamUsageTests(StubLLMMixin, TestCase):
+    def test_streamed_calls_record_token_usage(self):
+        answer = "".join(complete_stream(get_llm_config(provider="groq"), "Where is it?"))
+        self.assertTrue(answer)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.calls[0].completion_tokens, 5)
+        self.assertGreater(self.calls[0].prompt_tokens, 0)
+
+    async def test_async_streamed_calls_record_token_usage(self):
+        deltas = acomplete_stream(get_llm_config(provider="openai"), "Where is it?")
+        self.assertTrue([delta async for delta in deltas])
+        self.assertEqual(self.calls[0].completion_tokens, 5)
+
+
+@mock.patch.dict(os.environ, {"GROQ_RPM": "60", "GROQ_TPM": "6000"})
+class SharedBucketsTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.buckets = SharedBuckets(os.path.join(directory.name, "buckets.sqlite3"))
+        # The clock stands still unless a test moves it, so the refill is exact.
+        self.now = 1_000_000.0
+        clock = mock.patch.object(_ratelimit.time, "time", lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def fill(self):
+        # A minute's worth of requests at 60 rpm - the next one waits about a second.
+        for _ in range(60):
+            self.assertEqual(self.buckets.reserve("groq", 10), 0)
+
+    def test_requests_past_the_limit_wait_for_the_refill(self):
+        self.fill()
+        self.assertEqual(self.buckets.reserve("groq", 10), 1)
+        self.assertEqual(self.buckets.reserve("groq", 10), 2)
+        self.now += 2
+        self.assertEqual(self.buckets.reserve("groq", 10), 1)
+
+    def test_tokens_past_the_limit_wait_for_the_refill(self):
+        self.assertEqual(self.buckets.reserve("groq", 6000), 0)
+        # 6000 tpm refills 100 tokens a second.
+        self.assertEqual(self.buckets.reserve("groq", 300), 3)
+
+    def test_a_wait_past_max_wait_raises_and_takes_nothing(self):
+        self.fill()
+        with self.assertRaises(RateLimitExceeded) as raised:
+            self.buckets.reserve("groq", 10, max_wait=0.5)
+        self.assertEqual(raised.exception.retry_after, 1)
+        self.assertEqual(self.buckets.reserve("groq", 10), 1)
+
+    def test_a_released_reservation_is_given_back(self):
+        self.fill()
+        self.buckets.reserve("groq", 10)
+        self.buckets.release("groq", 10)
+        self.assertEqual(self.buckets.reserve("groq", 10), 1)
+
+    def test_block_pauses_every_caller(self):
+        self.buckets.block("groq", 5)
+        self.assertEqual(self.buckets.reserve("groq", 10), 5)
+
+    def test_retry_after_headers(self):
+        self.assertEqual(retry_after({"retry-after": "3"}), 3)
+        self.assertEqual(retry_after({"retry-after-ms": "1500", "retry-after": "3"}), 1.5)
+        date = email.utils.formatdate(self.now + 30, usegmt=True)
+        self.assertEqual(retry_after({"retry-after": date}), 30)
+        self.assertEqual(retry_after({}), 0)
+
+
+class RateLimitedCallTests(StubLLMMixin, TestCase):
+    # Every call is answered 429 with Retry-After: 1, more than the 0.5s a caller may wait.
+    stub_options = {**StubLLMMixin.stub_options, "error_rate": 1.0, "error_status": 429}
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        environ = {
+            "LLM_RATE_LIMIT_DB": os.path.join(directory.name, "buckets.sqlite3"),
+            "LLM_RATE_LIMIT_MAX_WAIT": "0.5",
+        }
+        for patch in (
+            mock.patch.dict(os.environ, environ),
+            mock.patch.object(_ratelimit, "_buckets", None),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def create(self):
+        client = get_llm_client("groq")
+        return client.chat.completions.create(
+            model="llama-3.3-70b-versatile", messages=[{"role": "user", "content": "Where?"}]
+        )
+
+    def test_a_retry_after_past_max_wait_fails_at_once(self):
+        started = time.monotonic()
+        with self.assertRaises(RateLimitError):
+            self.create()
+        self.assertLess(time.monotonic() - started, 0.5)
+        # The Retry-After paused the provider, so the next call fails without being sent.
+        requests = self.stub.requests
+        with self.assertRaises(RateLimitError) as raised:
+            self.create()
+        self.assertEqual(self.stub.requests, requests)
+        self.assertEqual(raised.exception.response.headers["Retry-After"], "1")
+
+    def test_the_view_answers_429(self):
+        response = self.client.post("/", {"message": "Where is it?"})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        self.assertIn("error", response.json())
+
+
+class HedgedDispatcherTests(TestCase):
+    """Groq is the primary and OpenAI the secondary, each on its own stub."""
+
+    routes = [("groq", "llama-3.3-70b-versatile"), ("openai", "gpt-4o-mini")]
+    messages = [{"role": "user", "content": "Where is it?"}]
+
+    def setUp(self):
+        self.calls = []
+        self.stubs = {}
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        environ = {"LLM_RATE_LIMIT_DB": os.path.join(directory.name, "buckets.sqlite3")}
+        for provider in ("GROQ", "OPENAI"):
+            environ.update({f"{provider}_API_KEY": "test-key", f"{provider}_RPM": "100000"})
+        self.environ = environ
+        for patch in (
+            mock.patch.object(_ratelimit, "_buckets", None),
+            # A 500 fails the attempt at once rather than being retried by the transport.
+            mock.patch.object(_ratelimit, "MAX_RETRIES", 0),
+            mock.patch.object(_instrument, "_recorders", [self.calls.append]),
+            # Breakers and latencies are per process - each test starts with healthy providers.
+            mock.patch.object(_failover, "_breakers", {}),
+            mock.patch.object(_failover, "_latencies", {}),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def start_stubs(self, groq=None, openai=None):
+        fast = {"latency": 0, "tokens_per_second": 10_000, "completion_tokens": 5}
+        for provider, options in (("groq", groq), ("openai", openai)):
+            stub = start_stub_server(**{**fast, **(options or {})})
+            self.addCleanup(stub.server_close)
+            self.addCleanup(stub.shutdown)
+            self.stubs[provider] = stub
+            self.environ[f"{provider.upper()}_BASE_URL"] = stub.base_url
+        patch = mock.patch.dict(os.environ, self.environ)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def dispatcher(self, **options):
+        dispatcher = HedgedDispatcher(self.routes, **{"default_delay": 0.2, **options})
+        self.addCleanup(lambda: dispatcher._executor and dispatcher._executor.shutdown())
+        return dispatcher
+
+    def test_a_healthy_primary_is_not_hedged(self):
+        self.start_stubs()
+        dispatcher = self.dispatcher()
+        result = dispatcher.complete(self.messages)
+        self.assertEqual((result.provider, result.hedged), ("groq", False))
+        self.assertEqual(result.usage["completion_tokens"], 5)
+        self.assertEqual(self.stubs["openai"].requests, 0)
+
+    def test_a_slow_primary_is_hedged_and_its_connection_closed(self):
+        self.start_stubs(groq={"latency": 30})
+        dispatcher = self.dispatcher()
+        result = dispatcher.complete(self.messages)
+        self.assertEqual((result.provider, result.hedged), ("openai", True))
+        self.assertEqual(dispatcher.stats["secondary_wins"], 1)
+        # The loser's read is broken off rather than left waiting 30s for its first token.
+        started = time.monotonic()
+        dispatcher._executor.shutdown(wait=True)
+        self.assertLess(time.monotonic() - started, 5)
+        # Losing the race is not a failure, and the winner's tokens were recorded.
+        self.assertEqual(dispatcher.breaker("groq").failures, 0)
+        self.assertIn(5, [call.completion_tokens for call in self.calls])
+
+    async def test_async_a_slow_primary_is_hedged(self):
+        self.start_stubs(groq={"latency": 30})
+        result = await self.dispatcher().acomplete(self.messages)
+        self.assertEqual((result.provider, result.hedged), ("openai", True))
+        self.assertEqual(result.usage["completion_tokens"], 5)
+
+    def test_a_failed_primary_fails_over(self):
+        self.start_stubs(groq={"error_rate": 1.0})
+        # Long enough that only the failure can start the second request.
+        dispatcher = self.dispatcher(default_delay=10)
+        result = dispatcher.complete(self.messages)
+        self.assertEqual(result.provider, "openai")
+        self.assertEqual(dispatcher.stats["failovers"], 1)
+        self.assertEqual(dispatcher.breaker("groq").failures, 1)
+
+    def test_the_circuit_breaker_skips_a_failing_provider_until_reset(self):
+        self.start_stubs(groq={"error_rate": 1.0})
+        dispatcher = self.dispatcher(default_delay=10, failure_threshold=2, reset_timeout=0.5)
+        for _ in range(2):
+            dispatcher.complete(self.messages)
+        self.assertEqual(dispatcher.breaker("groq").state, "open")
+        dispatcher.complete(self.messages)
+        self.assertEqual(self.stubs["groq"].requests, 2)
+        time.sleep(0.5)
+        self.assertEqual(dispatcher.breaker("groq").state, "half-open")
+        # The trial request fails, so the breaker opens again at once.
+        dispatcher.complete(self.messages)
+        self.assertEqual(self.stubs["groq"].requests, 3)
+        self.assertEqual(dispatcher.breaker("groq").state, "open")
+
+    def test_a_half_open_breaker_lets_a_single_trial_through(self):
+        self.start_stubs()
+        dispatcher = self.dispatcher(default_delay=10, reset_timeout=30)
+        breaker = dispatcher.breaker("groq")
+        breaker.opened_at = time.monotonic() - 30
+        self.assertEqual(breaker.acquire(), "half-open")
+
+        # While the trial is in flight the other requests skip groq.
+        self.assertFalse(breaker.allow())
+        self.assertIsNone(breaker.acquire())
+        self.assertEqual(dispatcher.complete(self.messages).provider, "openai")
+        self.assertEqual(self.stubs["groq"].requests, 0)
+        # A trial that never reports back is given up after reset_timeout.
+        with mock.patch.object(breaker, "probing_since", time.monotonic() - 30):
+            self.assertTrue(breaker.allow())
+
+        # A trial that lost a hedge race gives the next request its turn, which closes the breaker.
+        breaker.release()
+        self.assertEqual(dispatcher.complete(self.messages).provider, "groq")
+        self.assertEqual(breaker.state, "closed")
+
+    def test_a_request_refused_by_its_breaker_fails_over_at_once(self):
+        self.start_stubs()
+        dispatcher = self.dispatcher(default_delay=10)
+        dispatcher.breaker("groq").opened_at = time.monotonic() - 60
+        # Another request takes the trial between available_routes() and the attempt starting.
+        with mock.patch.object(dispatcher, "available_routes", return_value=self.routes):
+            dispatcher.breaker("groq").acquire()
+            started = time.monotonic()
+            result = dispatcher.complete(self.messages)
+        self.assertEqual(result.provider, "openai")
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(self.stubs["groq"].requests, 0)
+        self.assertEqual(dispatcher.breaker("groq").failures, 0)
+
+    def test_every_breaker_open_raises(self):
+        self.start_stubs(groq={"error_rate": 1.0}, openai={"error_rate": 1.0})
+        dispatcher = self.dispatcher(failure_threshold=1)
+        with self.assertRaises(Exception):
+            dispatcher.complete(self.messages)
+        with self.assertRaises(CircuitOpen):
+            dispatcher.complete(self.messages)
+
+
+class JobQueueTests(TestCase):
+    options = {**jobs.DEFAULTS, "LEASE": 120, "MAX_ATTEMPTS": 3, "RETRY_DELAY": 0}
+
+    def setUp(self):
+        self.user = User.objects.create_user("alice", password="secret")
+        self.job = ChatJob.objects.create(
+            user=self.user, view="chatbot", message="Where?", available_at=timezone.now()
+        )
+
+    def claim(self):
+        return jobs.claim(self.options["LEASE"], self.options["MAX_ATTEMPTS"])
+
+    def expire_lease(self):
+        ChatJob.objects.update(available_at=timezone.now() - timedelta(seconds=1))
+
+    def test_a_claimed_job_is_not_claimed_again(self):
+        self.assertEqual(self.claim().attempts, 1)
+        self.assertIsNone(self.claim())
+
+    def test_a_job_claimed_by_another_worker_meanwhile_is_skipped(self):
+        available = jobs.available
+        calls = []
+
+        def other_worker_claims_first(*args):
+            calls.append(args)
+            # Between this worker's candidate query and its UPDATE.
+            if len(calls) == 2:
+                with mock.patch.object(jobs, "available", available):
+                    self.assertEqual(self.claim().pk, self.job.pk)
+            return available(*args)
+
+        with mock.patch.object(jobs, "available", other_worker_claims_first):
+            self.assertIsNone(self.claim())
+        self.assertEqual(ChatJob.objects.get().attempts, 1)
+
+    def test_an_expired_lease_is_taken_over_and_the_old_worker_cannot_finish(self):
+        stale = self.claim()
+        self.expire_lease()
+        self.assertEqual(self.claim().attempts, 2)
+        with mock.patch.object(jobs, "answer", return_value="Dublin"):
+            jobs.run(stale, self.options["MAX_ATTEMPTS"], self.options["RETRY_DELAY"])
+        job = ChatJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (ChatJob.Status.RUNNING, 2))
+        self.assertFalse(Chat.objects.exists())
+
+    def test_a_done_job_saves_its_chat(self):
+        with mock.patch.object(jobs, "answer", return_value="Dublin"):
+            self.assertTrue(jobs.run_next(self.options))
+        job = ChatJob.objects.get()
+        self.assertEqual((job.status, job.response), (ChatJob.Status.DONE, "Dublin"))
+        self.assertEqual(Chat.objects.get().response, "Dublin")
+        self.assertFalse(jobs.run_next(self.options))
+
+    def test_a_failing_job_is_retried_then_failed(self):
+        with mock.patch.object(jobs, "answer", side_effect=ConnectionError("provider down")):
+            jobs.run_next(self.options)
+            job = ChatJob.objects.get()
+            self.assertEqual((job.status, job.attempts), (ChatJob.Status.QUEUED, 1))
+            self.assertIn("provider down", job.error)
+            while jobs.run_next(self.options):
+                pass
+        job = ChatJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (ChatJob.Status.FAILED, 3))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_a_job_whose_last_lease_expired_fails(self):
+        for _ in range(self.options["MAX_ATTEMPTS"]):
+            self.assertIsNotNone(self.claim())
+            self.expire_lease()
+        self.assertIsNone(self.claim())
+        job = ChatJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (ChatJob.Status.FAILED, 3))
+        self.assertIn("lease expired", job.error)
+
+
+@mock.patch.object(jobs, "start_local_workers", jobs._NoWorkers)
+class ChatJobViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("alice", password="secret")
+        self.job = ChatJob.objects.create(
+            user=self.user, view="chatbot", message="Where?", available_at=timezone.now()
+        )
+        self.url = f"/jobs/{self.job.pk}/"
+
+    def test_anonymous_users_get_404(self):
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_other_users_get_404(self):
+        self.client.force_login(User.objects.create_user("bob", password="secret"))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_json_for_fetch_and_a_fragment_for_htmx(self):
+        self.client.force_login(self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()["status"], "queued")
+        self.assertIn("HX-Request", response["Vary"])
+        response = self.client.get(self.url, headers={"HX-Request": "true"})
+        self.assertContains(response, "Thinking...")
+        self.assertContains(response, 'hx-trigger="every 1s"')
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = ResponseCache(LocalMemoryBackend(ttl=60, max_entries=2))
+        self.calls = []
+
+    def answer(self, text="Dublin"):
+        def call():
+            self.calls.append(text)
+            return text
+
+        return call
+
+    def ask(self, question="Where is it?", call=None, provider="groq"):
+        return self.cache.get_or_call(provider, "llama", "system", question, call or self.answer())
+
+    def test_a_repeated_question_is_a_hit(self):
+        self.assertEqual(self.ask(), "Dublin")
+        self.assertEqual(self.ask("  where IS it"), "Dublin")
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1, "coalesced": 0})
+
+    def test_another_question_provider_or_prompt_is_a_miss(self):
+        self.ask()
+        self.ask("When is it?")
+        self.ask(provider="openai")
+        self.cache.get_or_call("groq", "llama", "new system", "Where is it?", self.answer())
+        self.assertEqual(len(self.calls), 4)
+
+    def test_an_answer_expires_after_the_ttl(self):
+        now = time.monotonic()
+        with mock.patch.object(cache.time, "monotonic", lambda: now):
+            self.ask()
+            now += 59
+            self.ask()
+            now += 2
+            self.ask()
+        self.assertEqual(len(self.calls), 2)
+
+    def test_the_least_recently_used_answer_is_evicted(self):
+        self.ask("a")
+        self.ask("b")
+        self.ask("a")
+        self.ask("c")  # evicts b - a was used more recently
+        self.ask("a")
+        self.assertEqual(self.calls, ["Dublin"] * 3)
+        self.ask("b")
+        self.assertEqual(len(self.calls), 4)
+
+    def test_an_empty_answer_is_not_cached(self):
+        self.ask(call=self.answer("  "))
+        self.ask()
+        self.assertEqual(self.calls, ["  ", "Dublin"])
+        answer = "".join(self.cache.stream("groq", "llama", "system", "When?", lambda: iter([" "])))
+        self.assertEqual(answer, " ")
+        streamed = self.cache.stream("groq", "llama", "system", "When?", lambda: iter(["April"]))
+        self.assertEqual("".join(streamed), "April")
+
+    def test_a_failover_answer_is_kept_under_the_provider_that_gave_it(self):
+        result = HedgedResult("openai", "gpt-4o-mini", "Dublin")
+        self.assertEqual(self.ask(call=lambda: result), "Dublin")
+        self.assertEqual(
+            self.cache.get_or_call("openai", "gpt-4o-mini", "system", "Where is it?", None),
+            "Dublin",
+        )
+        self.ask()
+        self.assertEqual(self.calls, ["Dublin"])
+
+    def test_concurrent_identical_questions_make_one_call(self):
+        release = threading.Event()
+
+        def slow_call():
+            release.wait(5)
+            self.calls.append("Dublin")
+            return "Dublin"
+
+        answers = []
+        threads = [
+            threading.Thread(target=lambda: answers.append(self.ask(call=slow_call)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while self.cache.stats()["coalesced"] < 7 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(answers, ["Dublin"] * 8)
+        self.assertEqual(self.calls, ["Dublin"])
+
+    async def test_concurrent_identical_async_questions_make_one_call(self):
+        async def slow_call():
+            await asyncio.sleep(0.05)
+            self.calls.append("Dublin")
+            return "Dublin"
+
+        answers = await asyncio.gather(
+            *(
+                self.cache.aget_or_call("groq", "llama", "system", "Where?", slow_call)
+                for _ in range(8)
+            )
+        )
+        self.assertEqual(answers, ["Dublin"] * 8)
+        self.assertEqual(self.calls, ["Dublin"])
+
+
+class BM25IndexTests(SimpleTestCase):
+    chunks = [
+        "The venue is the Talbot Hotel Stillorgan in Dublin",
+        "The dates are 23rd-27th April 2025",
+        "Sprints take place at the venue on Saturday and Sunday",
+        "Opportunity grants cover travel, hotel and registration",
+    ]
+
+    def setUp(self):
+        self.index = BM25Index(self.chunks)
+
+    def test_the_best_match_comes_first(self):
+        self.assertEqual(self.index.search("Which hotel is the venue?", k=1), [self.chunks[0]])
+        self.assertEqual(self.index.search("When are the dates?", k=1), [self.chunks[1]])
+
+    def test_a_rare_term_outweighs_a_common_one(self):
+        # "venue" is in two chunks, "sprints" in one.
+        scores = self.index.scores("venue sprints")
+        self.assertGreater(scores[2], scores[0])
+
+    def test_chunks_sharing_no_term_are_skipped(self):
+        self.assertEqual(self.index.search("parking", k=4), [])
+        self.assertEqual(self.index.search("what is the", k=4), [])
+        self.assertEqual(len(self.index.search("venue", k=10)), 2)
+
+    def test_chunks_with_only_stop_words_score_zero(self):
+        index = BM25Index(["the and", "is it"])
+        scores = index.scores("the")
+        self.assertTrue(np.isfinite(scores).all())
+        self.assertEqual(index.search("anything"), [])
+        self.assertEqual(BM25Index([]).search("venue"), [])
+
+    def test_long_documents_are_split_into_overlapping_windows(self):
+        words = [f"w{i}" for i in range(250)]
+        chunks = chunk_documents(["short faq", " ".join(words), "   "], max_words=100, overlap=20)
+        self.assertEqual(chunks[0], "short faq")
+        windows = [chunk.split() for chunk in chunks[1:]]
+        self.assertEqual([window[0] for window in windows], ["w0", "w80", "w160"])
+        self.assertEqual(windows[0][-20:], windows[1][:20])
+        self.assertEqual(windows[-1][-1], "w249")
+
+
+class TrackLLMCallTests(SimpleTestCase):
+    def test_a_failing_recorder_is_logged_and_the_others_still_run(self):
+        calls = []
+
+        def broken(call):
+            raise ValueError("boom")
+
+        with mock.patch.object(_instrument, "_recorders", [broken, calls.append]):
+            with self.assertLogs("_instrument", level="ERROR") as logs:
+                with _instrument.track_llm_call("groq", "llama"):
+                    pass
+        self.assertEqual(len(calls), 1)
+        self.assertIn("ValueError: boom", logs.output[0])
+
+
+class IntentRouterTests(SimpleTestCase):
+    tools = {
+        "get_weather": "For the weather forecast and temperature use this tool",
+        "get_flight": "For booking a flight or plane ticket use this tool",
+        "get_joke": "For a funny joke use this tool",
+    }
+    examples = [("Is it sunny in Dublin?", "get_weather"), ("I want a plane to Rome", "get_flight")]
+
+    def router(self, **kwargs):
+        return IntentRouter(self.tools, self.examples, **kwargs)
+
+    def test_parse_reports_reads_the_tool_names(self):
+        reports = ["For weather use this tool => **get_weather**.", "No tool here"]
+        self.assertEqual(list(parse_reports(reports)), ["get_weather"])
+
+    def test_classify_scores_every_tool(self):
+        decision = self.router().classify("What is the weather forecast?")
+        self.assertEqual((decision.tool, decision.source), ("get_weather", "local"))
+        self.assertEqual(list(decision.scores), list(self.tools))
+        self.assertAlmostEqual(decision.confidence, max(decision.scores.values()), places=4)
+
+    def test_confident_needs_threshold_and_margin(self):
+        router = self.router(threshold=0.3, margin=0.1)
+        decision = RouteDecision("get_weather", 0.5, "local", scores={"a": 0.5, "b": 0.1})
+        self.assertTrue(router.confident(decision))
+        decision.scores["b"] = 0.45
+        self.assertFalse(router.confident(decision))
+        self.assertFalse(router.confident(RouteDecision("a", 0.2, "local", scores={"a": 0.2})))
+
+    def test_a_confident_local_decision_skips_the_llm(self):
+        llm = mock.Mock()
+        decision = self.router(llm=llm).route("Will the temperature drop? weather forecast")
+        self.assertEqual((decision.tool, decision.source), ("get_weather", "local"))
+        llm.assert_not_called()
+
+    def test_an_unsure_router_asks_the_llm(self):
+        llm = mock.Mock(return_value="get_joke")
+        decision = self.router(llm=llm, default="support").route("My parcel has not arrived")
+        self.assertEqual((decision.tool, decision.source), ("get_joke", "llm"))
+        llm.assert_called_once_with("My parcel has not arrived")
+
+    def test_an_unknown_llm_answer_falls_back_to_the_default(self):
+        router = self.router(llm=mock.Mock(return_value="get_pizza"), default="support")
+        decision = router.route("My parcel has not arrived")
+        self.assertEqual((decision.tool, decision.source), ("support", "default"))
+
+    def test_without_a_default_the_weak_guess_is_marked_unconfident(self):
+        decision = self.router(llm=mock.Mock(return_value=None)).route("My parcel has not arrived")
+        self.assertEqual(decision.source, "unconfident")
+        self.assertIn(decision.tool, self.tools)
+
+
+def tool_call(id, name, arguments="{}"):
+    return SimpleNamespace(id=id, function=SimpleNamespace(name=name, arguments=arguments))
+
+
+class ToolRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.tools = ToolRegistry(max_workers=4, timeout=5)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.addCleanup(lambda: self.tools._executor and self.tools._executor.shutdown(wait=False))
+
+    def results(self, messages):
+        return [json.loads(message["content"]) for message in messages]
+
+    def test_schemas_come_from_the_signature(self):
+        @self.tools.register(description="Add two numbers.")
+        def add(a: int, b: int = 0, tags: list = None) -> int:
+            return a + b
+
+        schema = self.tools.schemas()[0]["function"]
+        self.assertEqual(schema["description"], "Add two numbers.")
+        self.assertEqual(schema["parameters"]["required"], ["a"])
+        self.assertEqual(schema["parameters"]["properties"]["tags"]["items"], {"type": "string"})
+
+    def test_calls_in_one_turn_run_concurrently_and_answer_in_order(self):
+        barrier = threading.Barrier(2, timeout=2)
+
+        @self.tools.register
+        def wait_for_the_other(name: str) -> str:
+            # Only returns if both calls are running at the same time.
+            barrier.wait()
+            return name
+
+        messages = self.tools.run(
+            [
+                tool_call("1", "wait_for_the_other", '{"name": "first"}'),
+                tool_call("2", "wait_for_the_other", '{"name": "second"}'),
+            ]
+        )
+        self.assertEqual([message["tool_call_id"] for message in messages], ["1", "2"])
+        self.assertEqual(self.results(messages), [{"result": "first"}, {"result": "second"}])
+
+    def test_a_slow_tool_times_out_without_holding_up_the_others(self):
+        @self.tools.register(timeout=0.1)
+        def slow() -> str:
+            self.release.wait(5)
+            return "late"
+
+        @self.tools.register
+        def fast() -> str:
+            return "quick"
+
+        started = time.monotonic()
+        messages = self.tools.run([tool_call("1", "slow"), tool_call("2", "fast")])
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(
+            self.results(messages), [{"error": "slow timed out after 0.1s"}, {"result": "quick"}]
+        )
+
+    def test_errors_are_answered_to_the_model(self):
+        @self.tools.register
+        def divide(a: int, b: int) -> float:
+            return a / b
+
+        @self.tools.register
+        def connect() -> None:
+            raise TimeoutError("upstream did not answer")
+
+        messages = self.tools.run(
+            [
+                tool_call("1", "divide", '{"a": 1, "b": 0}'),
+                tool_call("2", "missing"),
+                tool_call("3", "divide", "{not json"),
+                tool_call("4", "connect"),
+            ]
+        )
+        errors = [result["error"] for result in self.results(messages)]
+        self.assertEqual(errors[0], "ZeroDivisionError: division by zero")
+        self.assertEqual(errors[1], "LookupError: Tool not found: missing")
+        self.assertTrue(errors[2].startswith("JSONDecodeError"))
+        # A tool raising TimeoutError itself is an error, not a timeout of the call.
+        self.assertEqual(errors[3], "TimeoutError: upstream did not answer")
+
+
+class CatalogTests(SimpleTestCase):
+    def setUp(self):
+        self.catalog = Catalog()
+        self.catalog.upsert([("BIKE-001", "bike", 100), ("TV-001", "Smart  TV", 200, 0.1)])
+
+    def test_products_are_found_by_name_sku_or_plural(self):
+        self.assertEqual(
+            self.catalog.prices(["bike", "smart tv", "tv-001", "bikes", "boat"]),
+            {"bike": 100.0, "smart tv": 200.0, "tv-001": 200.0, "bikes": 100.0, "boat": None},
+        )
+
+    def test_totals_include_vat_and_list_missing_products(self):
+        totals = self.catalog.totals(
+            [{"product": "bike", "quantity": 2}, {"product": "boat"}, {"product": "TV-001"}]
+        )
+        self.assertEqual([item["total"] for item in totals["items"]], [240.0, 220.0])
+        self.assertEqual(totals["missing"], ["boat"])
+        self.assertEqual(totals["total"], 460.0)
+
+    def test_upsert_updates_existing_skus(self):
+        self.catalog.upsert([("BIKE-001", "e-bike", 150)])
+        self.assertEqual(len(self.catalog), 2)
+        self.assertEqual(self.catalog.prices(["e-bike", "bike"]), {"e-bike": 150.0, "bike": None})
+
+    def test_changes_from_another_connection_are_picked_up(self):
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        path = os.path.join(directory, "catalog.sqlite3")
+        reader, writer = Catalog(path), Catalog(path)
+        self.addCleanup(reader._connection.close)
+        self.addCleanup(writer._connection.close)
+        self.assertEqual(len(reader), 0)
+
+        writer.upsert([("BIKE-001", "bike", 100)])
+        self.assertEqual(reader.prices(["bike"]), {"bike": 100.0})
+
+        # An unchanged database is not reloaded.
+        with mock.patch.object(reader, "_load") as load:
+            reader.prices(["bike"])
+        load.assert_not_called()
+
+
+class RunBatchTests(SimpleTestCase):
+    def setUp(self):
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.input = os.path.join(directory, "questions.jsonl")
+        self.output = os.path.join(directory, "results.jsonl")
+        with open(self.input, "w", encoding="utf-8") as file:
+            file.write('{"id": "a", "question": "one"}\n"two"\n\n{"id": "c", "question": "three"}\n')
+        self.asked = []
+        self.failing = {"two"}
+
+    def answer(self, question):
+        self.asked.append(question)
+        if question in self.failing:
+            raise ValueError("upstream down")
+        return question.upper()
+
+    def run_batch(self, **kwargs):
+        return asyncio.run(run_batch(self.input, self.output, self.answer, concurrency=2, **kwargs))
+
+    def rows(self):
+        with open(self.output, encoding="utf-8") as file:
+            return [json.loads(line) for line in file]
+
+    def test_a_second_run_skips_every_answered_question(self):
+        summary = self.run_batch()
+        self.assertEqual((summary["skipped"], summary["answered"], summary["errors"]), (0, 2, 1))
+
+        self.asked.clear()
+        summary = self.run_batch()
+        self.assertEqual((summary["skipped"], summary["answered"], summary["errors"]), (3, 0, 0))
+        self.assertEqual(self.asked, [])
+        self.assertEqual(len(self.rows()), 3)
+
+    def test_retried_errors_keep_one_row_per_id(self):
+        self.run_batch()
+        self.failing.clear()
+        self.asked.clear()
+
+        summary = self.run_batch(retry_errors=True)
+        self.assertEqual((summary["skipped"], summary["answered"], summary["errors"]), (2, 1, 0))
+        self.assertEqual(self.asked, ["two"])
+        self.assertCountEqual([row["id"] for row in self.rows()], ["a", 2, "c"])
+        self.assertEqual(read_checkpoint(self.output)[2]["answer"], "TWO")
+
+    def test_a_line_cut_short_is_dropped_and_answered_again(self):
+        with open(self.output, "w", encoding="utf-8") as file:
+            file.write('{"id": "a", "question": "one", "answer": "ONE", "error": null}\n')
+            file.write('{"id": "old", "question": "gone", "answer": "GONE", "error": null}\n')
+            file.write('{"id": "c", "quest')
+
+        summary = self.run_batch()
+        # Only ids of the input count as skipped.
+        self.assertEqual((summary["skipped"], summary["answered"], summary["errors"]), (1, 1, 1))
+        self.assertEqual(sorted(self.asked), ["three", "two"])
+        self.assertCountEqual(read_checkpoint(self.output), ["a", "old", 2, "c"])
+        self.assertEqual(len(self.rows()), 4)
+
+
+class TeachabilityTests(TestCase):
+    def setUp(self):
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.path = os.path.join(directory, "archive.jsonl")
+        with open(self.path, "w", encoding="utf-8") as file:
+            for id, text in ((1, "I live in Dublin"), (2, "I like tea"), (1, "I live in Dublin")):
+                file.write(json.dumps({"id": id, "text": text}) + "\n")
+        self.failing = set()
+        for patch in (
+            mock.patch.object(teachability, "get_llm_client"),
+            mock.patch.object(teachability, "extract_facts", side_effect=self.extract),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def extract(self, client, model, text, **options):
+        if text in self.failing:
+            raise ValueError("invalid JSON")
+        return ExtractionSchema(
+            summary=text, number_of_facts=1, facts=[FactSchema(fact=text, category="personal")]
+        )
+
+    def run_extraction(self, done=()):
+        sources = teachability.jsonl_sources(set(done), self.path)
+        return teachability.run_extraction(sources, "groq", "llama", concurrency=2, batch_size=10)
+
+    def test_a_key_repeated_in_the_input_is_stored_once(self):
+        summary = self.run_extraction()
+        self.assertEqual((summary["sources"], summary["facts"], summary["errors"]), (2, 2, 0))
+        self.assertEqual(
+            sorted(FactSource.objects.values_list("key", flat=True)), ["jsonl:1", "jsonl:2"]
+        )
+
+    def test_a_rerun_skips_stored_keys_even_if_it_did_not_know_them(self):
+        self.failing = {"I like tea"}
+        summary = self.run_extraction()
+        self.assertEqual((summary["sources"], summary["errors"]), (1, 1))
+
+        # The resume skips the stored source and retries the failed one.
+        self.failing.clear()
+        done = FactSource.objects.values_list("key", flat=True)
+        summary = self.run_extraction(done)
+        self.assertEqual((summary["sources"], summary["facts"]), (1, 1))
+
+        # A run that read the checkpoint before another one stored these keys.
+        summary = self.run_extraction()
+        self.assertEqual((summary["sources"], summary["facts"], summary["errors"]), (0, 0, 0))
+        self.assertEqual(FactSource.objects.count(), 2)
+        self.assertEqual(Fact.objects.count(), 2)
+
+
+class ProfileFact(BaseModel):
+    fact: str
+    category: str
+
+
+class Profile(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    name: str
+    age: int
+    facts: list[ProfileFact]
+
+
+class FakeStream:
+    """A streamed completion of the given text pieces that records how far it was read."""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.read = 0
+        self.closed = False
+
+    def __iter__(self):
+        for piece in self.pieces:
+            self.read += 1
+            delta = SimpleNamespace(content=piece)
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+
+    def close(self):
+        self.closed = True
+
+
+class StructuredOutputTests(SimpleTestCase):
+    reply = (
+        '{"name": "Ada \\"the\\" Countess", "age": 36, "facts": ['
+        '{"fact": "wrote the first program", "category": "work"}, '
+        '{"fact": "likes {braces} and [brackets]", "category": "misc"}]}'
+    )
+
+    def setUp(self):
+        patch = mock.patch.object(_instrument, "_recorders", [])
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def parse(self, pieces):
+        parser = StructuredParser(Profile)
+        updates = []
+        for piece in pieces:
+            updates += parser.feed(piece)
+        return parser, updates, parser.close()
+
+    def test_any_split_of_the_reply_gives_the_same_fields(self):
+        _, expected, profile = self.parse([self.reply])
+        self.assertEqual(profile.name, 'Ada "the" Countess')
+        self.assertEqual(profile.facts[1].fact, "likes {braces} and [brackets]")
+        for size in (1, 2, 3, 7, 16):
+            pieces = [self.reply[i : i + size] for i in range(0, len(self.reply), size)]
+            self.assertEqual(self.parse(pieces)[1:], (expected, profile))
+
+    def test_fields_and_list_items_are_reported_as_they_close(self):
+        parser = StructuredParser(Profile)
+        self.assertEqual(parser.feed('{"name": "Ada", "age": 3'), [(("name",), "Ada")])
+        # A number only ends at the next delimiter.
+        self.assertEqual(
+            parser.feed('6, "facts": [{"fact": "a", "category": "b"}'),
+            [(("age",), 36), (("facts", 0), ProfileFact(fact="a", category="b"))],
+        )
+        self.assertEqual(parser.partial.facts, [ProfileFact(fact="a", category="b")])
+        updates = parser.feed("]}")
+        self.assertEqual([path for path, _ in updates], [("facts",)])
+        self.assertEqual(parser.close().age, 36)
+
+    def test_a_fenced_reply_is_parsed(self):
+        profile = self.parse(["```json\n", self.reply, "\n```"])[2]
+        self.assertEqual(profile.age, 36)
+
+    def test_a_doomed_reply_fails_as_soon_as_it_is_wrong(self):
+        for reply, message in (
+            ("Sure! Here it is", "expected a JSON value"),
+            ("[1, 2]", "expected a JSON object"),
+            ('{"name": "Ada" "age"', "expected ','"),
+            ('{"name": "Ada", "age": [', "age: expected"),
+            ('{"name": "Ada", "nickname": ', "nickname: unknown field"),
+            ('{"age": "old", ', "age: Input should be a valid integer"),
+            ('{"facts": [{"fact": "a"}, ', "facts.0.category: Field required"),
+            ('{"age": 3x, ', "invalid JSON value"),
+            ('{"name": "Ada"} trailing', "after the JSON"),
+        ):
+            with self.subTest(reply=reply):
+                with self.assertRaisesMessage(SchemaViolation, message):
+                    StructuredParser(Profile).feed(reply)
+
+    def test_a_reply_cut_short_or_missing_fields_fails(self):
+        parser = StructuredParser(Profile)
+        parser.feed('{"name": "Ada"')
+        with self.assertRaisesMessage(SchemaViolation, "ended before the JSON was complete"):
+            parser.close()
+        # The whole object is validated as soon as it closes.
+        with self.assertRaisesMessage(SchemaViolation, "age: Field required; facts: Field required"):
+            StructuredParser(Profile).feed('{"name": "Ada"}')
+
+    def fake_client(self, *replies):
+        client = mock.Mock()
+        self.streams = [FakeStream(pieces) for pieces in replies]
+        client.chat.completions.create.side_effect = self.streams
+        return client
+
+    def test_stream_model_calls_on_field_and_returns_the_model(self):
+        client = self.fake_client([self.reply[:20], self.reply[20:]])
+        fields = []
+        profile = stream_model(
+            client, "llama", [], Profile, on_field=lambda *field: fields.append(field)
+        )
+        self.assertEqual(profile.age, 36)
+        self.assertEqual(
+            [path for path, _ in fields],
+            [("name",), ("age",), ("facts", 0), ("facts", 1), ("facts",)],
+        )
+        self.assertTrue(self.streams[0].closed)
+
+    def test_a_violation_closes_the_stream_and_re_asks(self):
+        client = self.fake_client(['{"name": "Ada", ', '"age": "old", ', '"facts": []}'], [self.reply])
+        profile = stream_model(client, "llama", [{"role": "user", "content": "Who?"}], Profile)
+        self.assertEqual(profile.name, 'Ada "the" Countess')
+        # The rest of the doomed reply was not read.
+        self.assertEqual((self.streams[0].read, self.streams[0].closed), (2, True))
+        messages = client.chat.completions.create.call_args.kwargs["messages"]
+        self.assertEqual(messages[1]["content"], '{"name": "Ada", "age": "old", ')
+        self.assertIn("age: Input should be a valid integer", messages[2]["content"])
+
+    def test_schema_violation_is_raised_after_max_reasks(self):
+        client = self.fake_client(["not json"], ["still not json"], ["never json"])
+        with self.assertRaises(SchemaViolation):
+            stream_model(client, "llama", [], Profile, max_reasks=1)
+        self.assertEqual(client.chat.completions.create.call_count, 2)
+
+
+class FakeReflectionClient:
+    """
+    Generator drafts are "draft 1", "draft 2", ... by the number of critiques received, and each
+    critic approves once the draft number reaches approve_at. Every completion costs 100 tokens.
+    """
+
+    def __init__(self, approve_at: int = 2, barrier=None) -> None:
+        self.approve_at = approve_at
+        self.barrier = barrier
+        self.calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, **options):
+        self.calls.append(messages)
+        if messages[0]["content"] == GENERATOR_SYSTEM:
+            text = f"draft {len(messages) // 2}"
+        else:
+            if self.barrier:
+                self.barrier.wait()
+            draft = int(messages[1]["content"].split()[-1])
+            text = "APPROVED" if draft >= self.approve_at else f"improve draft {draft}"
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+            usage=CompletionUsage(total_tokens=100, prompt_tokens=60, completion_tokens=40),
+        )
+
+
+class ReflectionTests(SimpleTestCase):
+    critics = {"correctness": "Find bugs.", "readability": "Check names.", "speed": "Profile."}
+
+    def setUp(self):
+        self.cache_dir = self.enterContext(tempfile.TemporaryDirectory())
+        patch = mock.patch.object(_instrument, "_recorders", [])
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def reflection(self, client, **options):
+        return Reflection(
+            client, "llama", **{"critics": self.critics, "cache_dir": self.cache_dir, **options}
+        )
+
+    def test_the_critics_of_a_round_run_at_the_same_time(self):
+        # Each critic only returns once all three are waiting.
+        client = FakeReflectionClient(approve_at=1, barrier=threading.Barrier(3, timeout=2))
+        result = self.reflection(client).run("Write a parser")
+        self.assertEqual((result.output, result.rounds, result.converged), ("draft 1", 1, True))
+        self.assertEqual(set(result.critiques[0]), set(self.critics))
+
+    def test_it_stops_as_soon_as_every_critic_approves(self):
+        client = FakeReflectionClient(approve_at=2)
+        result = self.reflection(client, max_rounds=5).run("Write a parser")
+        self.assertEqual((result.output, result.rounds, result.converged), ("draft 2", 2, True))
+        self.assertEqual(result.critiques[0]["speed"], "improve draft 1")
+        # draft, 3 critics, revision, 3 critics
+        self.assertEqual((len(client.calls), result.tokens), (8, 800))
+        revision = client.calls[4]
+        self.assertIn("## Correctness review\nimprove draft 1", revision[-1]["content"])
+
+    def test_max_rounds_and_the_token_budget_stop_it_unconverged(self):
+        result = self.reflection(FakeReflectionClient(approve_at=9), max_rounds=2).run("Parse")
+        self.assertEqual((result.output, result.rounds, result.converged), ("draft 3", 2, False))
+
+        # 100 for the draft, 300 for the critics and 100 for the revision reach the budget.
+        client = FakeReflectionClient(approve_at=9)
+        result = self.reflection(client, max_rounds=5, token_budget=450, cache_dir=None).run("Lex")
+        self.assertEqual((result.rounds, result.tokens, result.converged), (1, 500, False))
+        self.assertEqual(len(client.calls), 5)
+
+    def test_an_unchanged_revision_has_converged(self):
+        client = FakeReflectionClient(approve_at=9)
+        create = client.create
+
+        def same_draft(model, messages, **options):
+            response = create(model, messages, **options)
+            if messages[0]["content"] == GENERATOR_SYSTEM:
+                response.choices[0].message.content = "draft 1"
+            return response
+
+        client.chat.completions.create = same_draft
+        result = self.reflection(client, max_rounds=5).run("Parse")
+        self.assertEqual((result.output, result.rounds, result.converged), ("draft 1", 1, True))
+
+    def test_a_second_run_is_served_from_the_disk_cache(self):
+        first = self.reflection(FakeReflectionClient(approve_at=3), max_rounds=1).run("Parse")
+        self.assertEqual((first.rounds, first.cached, first.tokens), (1, 0, 500))
+
+        client = FakeReflectionClient(approve_at=3)
+        again = self.reflection(client, max_rounds=1).run("Parse")
+        self.assertEqual(client.calls, [])
+        self.assertEqual((again.output, again.cached, again.tokens), (first.output, 5, 0))
+
+        # One more round only calls the LLM for the stages not done yet.
+        more = self.reflection(client, max_rounds=2).run("Parse")
+        self.assertEqual((more.output, more.rounds, more.cached), ("draft 3", 2, 5))
+        self.assertEqual(len(client.calls), 4)
+
+    def test_no_cache_dir_turns_the_cache_off(self):
+        client = FakeReflectionClient(approve_at=1)
+        for _ in range(2):
+            self.reflection(client, cache_dir=None).run("Parse")
+        self.assertEqual(len(client.calls), 8)
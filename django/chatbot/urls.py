@@ -4,6 +4,11 @@ from . import views
 urlpatterns = [
     path("", views.chatbot, name="chatbot"),
     path("groq/", views.chatbot_groq, name="groq"),
+    path("async/", views.chatbot_async, name="chatbot_async"),
+    path("groq/async/", views.chatbot_groq_async, name="groq_async"),
+    path("history/", views.chat_history, name="chat_history"),
+    path("jobs/<int:job_id>/", views.chat_job, name="chat_job"),
+    path("metrics/", views.metrics, name="metrics"),
     path("login/", views.login, name="login"),
     path("register/", views.register, name="register"),
     path("logout/", views.logout, name="logout"),
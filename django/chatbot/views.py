@@ -1,35 +1,40 @@
-# The FAQ example from 03_faq.ipynb using either OpenAI or Groq.
-# Refactoring so that can have the LLM choice as a config variable has not been done.
+# The FAQ example from 03_faq.ipynb using either OpenAI or Groq - set per view in settings.LLM.
 
 # SYSTEM
-import os
+import functools
+import inspect
+import json
+import logging
+import math
 
 # DJANGO
+from django.conf import settings
 from django.contrib import auth
 from django.utils import timezone
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.models import User
-from django.shortcuts import render, redirect
-from .models import Chat
+from django.shortcuts import get_object_or_404, render, redirect
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from asgiref.sync import sync_to_async
+from .models import Chat, ChatJob
+from . import jobs
+from .cache import get_faq_cache
+from .history import chat_page, achat_page
+from .metrics import render_metrics
+from django_chatbot import write_behind
+from django_chatbot.htmx import is_htmx
 
 # LLM
-from openai import OpenAI
-import openai
+from _get_client import get_llm_client, get_async_llm_client
+from _retrieval import BM25Index, chunk_documents
+from _prompt import PromptPrefix, assemble_messages, record_usage
+from _instrument import track_llm_call
+from _failover import HedgedDispatcher
+from _ratelimit import rate_limit_wait
+from _llm_config import PROVIDERS, get_llm_config
 
-# OTHER
-from dotenv import load_dotenv, find_dotenv
-from rich.console import Console
-
-console = Console()
-
-# Load in our API keys
-load_dotenv(find_dotenv())
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-console.print(f"[dark_orange]OPENAI_API_KEY: {OPENAI_API_KEY[:14]}...[/]")
-print()
-console.print(f"[cyan]GROQ_API_KEY: {GROQ_API_KEY[:14]}...[/cyan]")
+logger = logging.getLogger(__name__)
 
 # We add in our own system message
 system_message = (
@@ -82,54 +87,306 @@ FAQ = [
 ]
 
 
-# Create the base system message
-system_message += "\n" + "\n".join(FAQ)
+# RETRIEVAL
+# Rather than adding the whole FAQ to the system message, the FAQ is indexed once (BM25, see _retrieval.py)
+# and only the FAQ_TOP_K chunks most relevant to the question are sent with each request.
+faq_index = BM25Index(chunk_documents(FAQ))
+
+# The system message is the static start of every prompt so the provider can cache it (see _prompt.py).
+prompt_prefix = PromptPrefix(system_message)
 
+# Cached answers depend on the instructions and the indexed FAQ, so both go into the cache key.
+cache_prompt = prompt_prefix.fingerprint + faq_index.fingerprint
 
-# Helper function for OpenAI calls
-def ask_openai(message):
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": message},
-        ],
+
+def faq_messages(message):
+    return assemble_messages(
+        prompt_prefix,
+        message,
+        context=faq_index.search(message, k=settings.FAQ_TOP_K),
     )
+
+
+# Answers are cached on the normalised question, provider, model and system prompt so repeated
+# questions return without calling the LLM - see cache.py and the FAQ_CACHE setting.
+# Each view's provider, model and timeout come from settings.LLM (see _llm_config.py).
+_dispatchers = {}
+
+
+def failover_enabled():
+    return getattr(settings, "LLM_FAILOVER", {}).get("ENABLED", False)
+
+
+def get_dispatcher(config):
+    """The view's provider first, then the others - hedged and failed over, see _failover.py."""
+    if config not in _dispatchers:
+        failover = settings.LLM_FAILOVER
+        routes = [(config.provider, config.model)]
+        routes += [
+            (provider, get_llm_config(provider=provider).model)
+            for provider in PROVIDERS
+            if provider != config.provider
+        ]
+        _dispatchers[config] = HedgedDispatcher(
+            routes,
+            percentile=failover.get("PERCENTILE", 95),
+            default_delay=failover.get("DEFAULT_DELAY", 2.0),
+            failure_threshold=failover.get("FAILURE_THRESHOLD", 5),
+            reset_timeout=failover.get("RESET_TIMEOUT", 30),
+        )
+    return _dispatchers[config]
+
+
+def complete(config, message):
+    if failover_enabled():
+        result = get_dispatcher(config).complete(faq_messages(message), timeout=config.timeout)
+        record_usage(prompt_prefix, result.usage)
+        # The cache files the answer under the provider that gave it.
+        return result
+
+    # The client is shared so its connection pool is reused between requests
+    client = get_llm_client(config.provider)
+    with track_llm_call(config.provider, config.model) as call:
+        response = client.chat.completions.create(
+            model=config.model,
+            messages=faq_messages(message),
+            timeout=config.timeout,
+        )
+        call.usage(response.usage)
+    record_usage(prompt_prefix, response.usage)
     answer = response.choices[0].message.content.strip()
     return answer
 
 
-# Helper function for GROQ calls
-def ask_groq(message):
-    # GROQ
-    client = openai.OpenAI(
-        base_url="https://api.groq.com/openai/v1",
-        api_key=GROQ_API_KEY,
+def ask(config, message):
+    return get_faq_cache().get_or_call(
+        config.provider, config.model, cache_prompt, message, lambda: complete(config, message)
     )
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": message},
-        ],
+
+
+# Streaming versions of the helpers - yield the answer a few tokens at a time as the LLM generates it.
+def complete_stream(config, message):
+    client = get_llm_client(config.provider)
+    with track_llm_call(config.provider, config.model) as call:
+        stream = client.chat.completions.create(
+            model=config.model,
+            messages=faq_messages(message),
+            stream=True,
+            # Without this streamed responses carry no usage and the call is recorded as 0 tokens.
+            stream_options={"include_usage": True},
+            timeout=config.timeout,
+        )
+        for chunk in stream:
+            call.usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                call.first_token()
+                yield chunk.choices[0].delta.content
+
+
+def stream(config, message):
+    return get_faq_cache().stream(
+        config.provider,
+        config.model,
+        cache_prompt,
+        message,
+        lambda: complete_stream(config, message),
     )
+
+
+# Async versions of the helpers - awaiting the LLM frees the event loop for other conversations.
+async def acomplete(config, message):
+    if failover_enabled():
+        result = await get_dispatcher(config).acomplete(
+            faq_messages(message), timeout=config.timeout
+        )
+        record_usage(prompt_prefix, result.usage)
+        return result
+
+    client = get_async_llm_client(config.provider)
+    with track_llm_call(config.provider, config.model) as call:
+        response = await client.chat.completions.create(
+            model=config.model,
+            messages=faq_messages(message),
+            timeout=config.timeout,
+        )
+        call.usage(response.usage)
+    record_usage(prompt_prefix, response.usage)
     answer = response.choices[0].message.content.strip()
     return answer
 
 
+async def aask(config, message):
+    return await get_faq_cache().aget_or_call(
+        config.provider, config.model, cache_prompt, message, lambda: acomplete(config, message)
+    )
+
+
+async def acomplete_stream(config, message):
+    client = get_async_llm_client(config.provider)
+    with track_llm_call(config.provider, config.model) as call:
+        stream = await client.chat.completions.create(
+            model=config.model,
+            messages=faq_messages(message),
+            stream=True,
+            # Without this streamed responses carry no usage and the call is recorded as 0 tokens.
+            stream_options={"include_usage": True},
+            timeout=config.timeout,
+        )
+        async for chunk in stream:
+            call.usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                call.first_token()
+                yield chunk.choices[0].delta.content
+
+
+def astream(config, message):
+    return get_faq_cache().astream(
+        config.provider,
+        config.model,
+        cache_prompt,
+        message,
+        lambda: acomplete_stream(config, message),
+    )
+
+
+# STREAMING
+# The templates ask for Server-Sent Events with an Accept: text/event-stream header.
+# Each token is sent as a "delta" event and a final "done" event carries the full response
+# once the Chat row has been saved. Otherwise the views return one JsonResponse as before.
+def wants_stream(request):
+    return "text/event-stream" in request.headers.get("Accept", "")
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_response(events):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # stop nginx buffering the stream
+    return response
+
+
+# Sent instead of done when the provider fails part way through - the partial answer is not saved.
+STREAM_ERROR = "Sorry, the answer could not be completed. Please try again."
+# Sent when the provider's rate limit would keep the user waiting longer than MAX_WAIT.
+RATE_LIMITED = "The assistant is busy right now. Please try again in a few seconds."
+
+
+def stream_error(exc):
+    return RATE_LIMITED if rate_limit_wait(exc) is not None else STREAM_ERROR
+
+
+def rate_limited_response(wait):
+    response = JsonResponse({"error": RATE_LIMITED}, status=429)
+    response["Retry-After"] = str(math.ceil(wait))
+    return response
+
+
+def handle_rate_limits(view):
+    """Answer 429 with Retry-After, rather than 500, when the call to the LLM was rate limited."""
+    if inspect.iscoroutinefunction(view):
+
+        @functools.wraps(view)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await view(*args, **kwargs)
+            except Exception as exc:
+                wait = rate_limit_wait(exc)
+                if wait is None:
+                    raise
+                return rate_limited_response(wait)
+
+        return wrapper
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        except Exception as exc:
+            wait = rate_limit_wait(exc)
+            if wait is None:
+                raise
+            return rate_limited_response(wait)
+
+    return wrapper
+
+
+def stream_chat(user, message, deltas):
+    def events():
+        parts = []
+        try:
+            for delta in deltas:
+                parts.append(delta)
+                yield sse_event("delta", {"delta": delta})
+        except Exception as exc:
+            logger.exception("Streaming the answer failed")
+            yield sse_event("error", {"message": message, "error": stream_error(exc)})
+            return
+        # Only a completed answer is saved - a dropped connection stops the generator before here.
+        response = "".join(parts).strip()
+        write_behind.save(Chat(user=user, message=message, response=response))
+        yield sse_event("done", {"message": message, "response": response})
+
+    return sse_response(events())
+
+
+def astream_chat(user, message, deltas):
+    async def events():
+        parts = []
+        try:
+            async for delta in deltas:
+                parts.append(delta)
+                yield sse_event("delta", {"delta": delta})
+        except Exception as exc:
+            logger.exception("Streaming the answer failed")
+            yield sse_event("error", {"message": message, "error": stream_error(exc)})
+            return
+        response = "".join(parts).strip()
+        await write_behind.asave(Chat(user=user, message=message, response=response))
+        yield sse_event("done", {"message": message, "response": response})
+
+    return sse_response(events())
+
+
+# With JOB_QUEUE enabled a POST is answered at once with a job to poll, and a worker asks the LLM
+# (see jobs.py) - the web worker is not held for the LLM round trip and the job survives a restart.
+def job_response(request, job, status=200):
+    if is_htmx(request):
+        response = render(request, "chat_job.html", {"job": job}, status=status)
+    else:
+        data = {**jobs.job_data(job), "url": reverse("chat_job", args=[job.pk])}
+        response = JsonResponse(data, status=status)
+    patch_vary_headers(response, ["HX-Request"])
+    return response
+
+
+def chat_job(request, job_id):
+    # Jobs belong to a user - an anonymous poll is answered like a job that does not exist.
+    if not request.user.is_authenticated:
+        raise Http404
+    job = get_object_or_404(ChatJob, pk=job_id, user=request.user)
+    if job.pending:
+        # After a restart the first poll starts this process's workers again.
+        jobs.start_local_workers()
+    return job_response(request, job)
+
+
 # Here is the Chatbot
+@handle_rate_limits
 def chatbot(request):
-    chats = Chat.objects.filter(user=request.user)
 
     if request.method == "POST":
         message = request.POST.get("message")
-        # REFACTORING better so that we can set choice of LLM once in a config file but not done for this demo.
-        ################################
-        # SELECT LLM
-        # response = ask_openai(message)
-        response = ask_groq(message)
-        ################################
+        if jobs.enabled():
+            job = jobs.enqueue(request.user, message, "chatbot")
+            return job_response(request, job, status=202)
+        # The LLM is chosen in settings.LLM - LLM["VIEWS"]["chatbot"] overrides the default.
+        config = get_llm_config(view="chatbot")
+        if wants_stream(request):
+            return stream_chat(request.user, message, stream(config, message))
+        response = ask(config, message)
 
         chat = Chat(
             user=request.user,
@@ -137,18 +394,26 @@ def chatbot(request):
             response=response,
             created_at=timezone.now,
         )
-        chat.save()
+        # Saved now, or batched with other chats when WRITE_BEHIND is enabled
+        write_behind.save(chat)
         return JsonResponse({"message": message, "response": response})
-    return render(request, "chatbot.html", {"chats": chats})
+    chats, next_cursor = chat_page(request.user)
+    return render(request, "chatbot.html", {"chats": chats, "next_cursor": next_cursor})
 
 
 # This uses a different template with a ChatGPT look.
+@handle_rate_limits
 def chatbot_groq(request):
-    chats = Chat.objects.filter(user=request.user)
 
     if request.method == "POST":
         message = request.POST.get("message")
-        response = ask_groq(message)
+        if jobs.enabled():
+            job = jobs.enqueue(request.user, message, "chatbot_groq")
+            return job_response(request, job, status=202)
+        config = get_llm_config(view="chatbot_groq")
+        if wants_stream(request):
+            return stream_chat(request.user, message, stream(config, message))
+        response = ask(config, message)
 
         chat = Chat(
             user=request.user,
@@ -156,9 +421,61 @@ def chatbot_groq(request):
             response=response,
             created_at=timezone.now,
         )
-        chat.save()
+        # Saved now, or batched with other chats when WRITE_BEHIND is enabled
+        write_behind.save(chat)
         return JsonResponse({"message": message, "response": response})
-    return render(request, "chatbot_groq.html", {"chats": chats})
+    chats, next_cursor = chat_page(request.user)
+    return render(request, "chatbot_groq.html", {"chats": chats, "next_cursor": next_cursor})
+
+
+# Async versions of the chatbot views, served by django_chatbot/asgi.py (e.g. uvicorn django_chatbot.asgi:application).
+# A worker is not held for the LLM round trip so one process can serve many conversations at once.
+@handle_rate_limits
+async def _chatbot_async(request, template_name, view):
+    user = await request.auser()
+
+    if request.method == "POST":
+        message = request.POST.get("message")
+        if jobs.enabled():
+            job = await jobs.aenqueue(user, message, view)
+            return await sync_to_async(job_response)(request, job, status=202)
+        config = get_llm_config(view=view)
+        if wants_stream(request):
+            return astream_chat(user, message, astream(config, message))
+        response = await aask(config, message)
+
+        await write_behind.asave(Chat(user=user, message=message, response=response))
+        return JsonResponse({"message": message, "response": response})
+
+    chats, next_cursor = await achat_page(user)
+    # The auth context processor reads request.user lazily so the template is rendered in a thread.
+    return await sync_to_async(render)(
+        request, template_name, {"chats": chats, "next_cursor": next_cursor}
+    )
+
+
+async def chatbot_async(request):
+    return await _chatbot_async(request, "chatbot.html", "chatbot")
+
+
+async def chatbot_groq_async(request):
+    return await _chatbot_async(request, "chatbot_groq.html", "chatbot_groq")
+
+
+# Older chats for the history the templates lazy load as the user scrolls up (see history.py).
+def chat_history(request):
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Login required"}, status=401)
+    try:
+        chats, next_cursor = chat_page(request.user, request.GET.get("cursor", ""))
+    except ValueError:
+        return JsonResponse({"error": "Invalid cursor"}, status=400)
+    return JsonResponse({"chats": chats, "next_cursor": next_cursor})
+
+
+# LLM call metrics for this process in the Prometheus text format (see metrics.py).
+def metrics(request):
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4")
 
 
 def login(request):
@@ -1,6 +1,8 @@
 from django.contrib import admin
-from .models import Message
+from .models import Conversation, HistorySummary, Message
 
 # Register your models here.
 
+admin.site.register(Conversation)
 admin.site.register(Message)
+admin.site.register(HistorySummary)
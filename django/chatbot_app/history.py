@@ -0,0 +1,139 @@
+"""
+Conversation history for the LLM payload.
+
+Rather than sending every Message on every request we send a window of the most recent turns
+that fits a token budget. Turns that fall out of the window are folded into a rolling summary
+stored in HistorySummary, so the model still knows what was said earlier but each request only
+reads and sends O(window) rows.
+
+Settings (all optional):
+- CHAT_HISTORY_MAX_TURNS: most recent turns sent verbatim (default 10)
+- CHAT_HISTORY_TOKEN_BUDGET: estimated tokens the verbatim turns may use (default 2000)
+- CHAT_HISTORY_SUMMARY_BATCH: evicted turns folded into the summary per LLM call (default 4)
+"""
+
+from django.conf import settings
+
+from _get_client import get_llm_client
+from _instrument import track_llm_call
+from _llm_config import get_llm_config
+from django_chatbot import write_behind
+from .models import HistorySummary, Message
+
+summary_prompt = """You maintain a running summary of a conversation between a user and an assistant.
+Update the summary with the new turns below. Keep every fact, name, preference and open question
+that could matter later. Be CONCISE - no more than 200 words. Reply with the summary only."""
+
+
+def max_turns():
+    return getattr(settings, "CHAT_HISTORY_MAX_TURNS", 10)
+
+
+def token_budget():
+    return getattr(settings, "CHAT_HISTORY_TOKEN_BUDGET", 2000)
+
+
+def summary_batch():
+    return getattr(settings, "CHAT_HISTORY_SUMMARY_BATCH", 4)
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English - close enough for budgeting without a tokenizer.
+    return len(text) // 4 + 1
+
+
+def turn_tokens(turn: dict) -> int:
+    return estimate_tokens(turn["user_message"]) + estimate_tokens(turn["bot_message"])
+
+
+def format_turns(turns: list) -> list:
+    formatted_messages = []
+    for turn in turns:
+        formatted_messages.append({"role": "user", "content": turn["user_message"]})
+        formatted_messages.append({"role": "assistant", "content": turn["bot_message"]})
+    return formatted_messages
+
+
+def split_window(turns: list) -> tuple:
+    """
+    Split turns (newest first) into the ones kept verbatim and the older ones that overflow.
+    The newest turn is always kept, even if it alone is over budget.
+    """
+    kept = []
+    tokens = 0
+    for turn in turns:
+        tokens += turn_tokens(turn)
+        if kept and (len(kept) >= max_turns() or tokens > token_budget()):
+            break
+        kept.append(turn)
+    return kept, turns[len(kept) :]
+
+
+def summarize(summary: str, turns: list) -> str:
+    """Fold turns (oldest first) into the existing summary with one LLM call."""
+    transcript = "\n".join(
+        f"User: {turn['user_message']}\nAssistant: {turn['bot_message']}" for turn in turns
+    )
+    # The summarizer's provider and model are settings.LLM["VIEWS"]["history_summary"].
+    config = get_llm_config(view="history_summary")
+    client = get_llm_client(config.provider)
+    with track_llm_call(config.provider, config.model) as call:
+        response = client.chat.completions.create(
+            model=config.model,
+            timeout=config.timeout,
+            messages=[
+                {"role": "system", "content": summary_prompt},
+                {
+                    "role": "user",
+                    "content": f"CURRENT SUMMARY:\n{summary or '(none)'}\n\nNEW TURNS:\n{transcript}",
+                },
+            ],
+            temperature=0,
+        )
+        call.usage(response.usage)
+    return response.choices[0].message.content.strip()
+
+
+def build_history(conversation) -> list:
+    """
+    Return the conversation's rolling summary (as a system message) followed by its recent turns, ready for the API.
+
+    Only turns newer than the summary are read, and at most one window plus one summary batch of them.
+    Once a full batch has overflowed the window it is summarised and the summary cursor moves past it.
+    Turns older than that (e.g. a table that predates the summary) are never read again.
+    """
+    history_summary, _ = HistorySummary.objects.get_or_create(conversation=conversation)
+
+    # The newest turns may still be waiting in the write-behind buffer. The snapshot is taken
+    # before the query so a turn flushed in between is not missed.
+    pending_messages = write_behind.pending(Message, conversation_id=conversation.id)
+    turns = list(
+        Message.objects.filter(conversation=conversation, id__gt=history_summary.summarized_until)
+        .order_by("-timestamp", "-id")
+        .values("id", "user_message", "bot_message")[: max_turns() + summary_batch()]
+    )
+    pending = [
+        {"id": None, "user_message": message.user_message, "bot_message": message.bot_message}
+        for message in write_behind.unsaved(pending_messages, (turn["id"] for turn in turns))
+    ]
+    pending.reverse()
+    kept, overflow = split_window(pending + turns)
+    overflow = [turn for turn in overflow if turn["id"]]
+
+    if len(overflow) >= summary_batch():
+        overflow.reverse()
+        history_summary.summary = summarize(history_summary.summary, overflow)
+        history_summary.summarized_until = overflow[-1]["id"]
+        history_summary.save(update_fields=["summary", "summarized_until", "updated_at"])
+
+    messages = []
+    if history_summary.summary:
+        messages.append(
+            {
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{history_summary.summary}",
+            }
+        )
+    kept.reverse()
+    messages.extend(format_turns(kept))
+    return messages
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistorySummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('summary', models.TextField(blank=True)),
+                ('summarized_until', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -1,8 +1,39 @@
 from django.db import models
+from django.contrib.auth.models import User
 
 
 # Create your models here.
+class Conversation(models.Model):
+    """One chat thread, owned by a logged in user or else by the visitor's session."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    session_key = models.CharField(max_length=40, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
 class Message(models.Model):
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.CASCADE, related_name="messages", null=True
+    )
     user_message = models.TextField()
     bot_message = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # Messages are only ever read for one conversation in order, so history reads
+        # do not slow down as other conversations grow.
+        indexes = [
+            models.Index(fields=["conversation", "timestamp"], name="message_conv_time_idx")
+        ]
+
+
+class HistorySummary(models.Model):
+    """Rolling summary of the turns that have fallen out of the history window (see history.py)."""
+
+    conversation = models.OneToOneField(
+        Conversation, on_delete=models.CASCADE, related_name="history_summary", null=True
+    )
+    summary = models.TextField(blank=True)
+    # id of the newest Message folded into the summary
+    summarized_until = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -1,3 +1,79 @@
-from django.test import TestCase
+import re
+from unittest import mock
 
-# Create your tests here.
+from django.test import AsyncClient, Client, TestCase, override_settings
+
+from . import views
+from .models import Message
+
+CSRF_INPUT = re.compile(r'<input type="hidden" name="csrfmiddlewaretoken" value="([^"]+)">')
+
+
+class ChatViewTests(TestCase):
+    def setUp(self):
+        views._page_shell.cache_clear()
+        for patch in (
+            mock.patch.object(views, "get_ai_response", return_value="In Dublin."),
+            mock.patch.object(views, "get_ai_response_async", return_value="In Dublin."),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def csrf_token(self, response) -> str:
+        return CSRF_INPUT.search(response.content.decode()).group(1)
+
+    def test_a_post_renders_the_whole_page_with_the_conversation(self):
+        self.client.post("/chatbot-app/", {"message": "Where is it?"})
+        response = self.client.post("/chatbot-app/", {"message": "And when?"})
+        html = response.content.decode()
+        self.assertTrue(html.startswith("<!DOCTYPE html>"))
+        self.assertEqual(html.count('class="user-message"'), 2)
+        self.assertLess(html.index("Where is it?"), html.index("And when?"))
+        self.assertNotIn(views.MESSAGES_SLOT, html)
+        self.assertNotIn(views.CSRF_SLOT, html)
+        self.assertIn("HX-Request", response["Vary"])
+
+    def test_an_htmx_post_gets_only_the_new_exchange(self):
+        self.client.post("/chatbot-app/", {"message": "Where is it?"})
+        response = self.client.post(
+            "/chatbot-app/", {"message": "And when?"}, headers={"HX-Request": "true"}
+        )
+        html = response.content.decode()
+        self.assertNotIn("<html", html)
+        self.assertNotIn("Where is it?", html)
+        self.assertIn("And when?", html)
+        self.assertIn("In Dublin.", html)
+        self.assertIn("HX-Request", response["Vary"])
+        self.assertEqual(Message.objects.count(), 2)
+
+    async def test_an_htmx_post_to_the_async_view_gets_only_the_new_exchange(self):
+        response = await AsyncClient().post(
+            "/chatbot-app/async/", {"message": "Where is it?"}, headers={"HX-Request": "true"}
+        )
+        html = response.content.decode()
+        self.assertNotIn("<html", html)
+        self.assertIn("Where is it?", html)
+
+    def test_each_request_gets_its_own_csrf_token_in_the_cached_shell(self):
+        alice, bob = Client(enforce_csrf_checks=True), Client(enforce_csrf_checks=True)
+        alice_token = self.csrf_token(alice.get("/chatbot-app/"))
+        bob_token = self.csrf_token(bob.get("/chatbot-app/"))
+        # Both pages came from one rendering of chat.html.
+        self.assertEqual(views._page_shell.cache_info().misses, 1)
+        self.assertEqual(views._page_shell.cache_info().hits, 1)
+
+        # A token only works with the cookie of the visitor it was rendered for.
+        for client, token, status in (
+            (bob, alice_token, 403),
+            (alice, alice_token, 200),
+            (bob, bob_token, 200),
+        ):
+            response = client.post("/chatbot-app/", {"message": "Hi", "csrfmiddlewaretoken": token})
+            self.assertEqual(response.status_code, status)
+
+    @override_settings(DEBUG=True)
+    def test_debug_renders_the_shell_on_every_request(self):
+        for _ in range(2):
+            response = self.client.get("/chatbot-app/")
+            self.assertTrue(CSRF_INPUT.search(response.content.decode()))
+        self.assertEqual(views._page_shell.cache_info().currsize, 0)
@@ -1,6 +1,7 @@
 from django.urls import path
-from .views import chat_view
+from .views import chat_view, chat_view_async
 
 urlpatterns = [
     path("", chat_view, name="chat_view"),
+    path("async/", chat_view_async, name="chat_view_async"),
 ]
@@ -1,16 +1,23 @@
-import os
-from django.shortcuts import render
-from .models import Message
-import requests
-from dotenv import load_dotenv, find_dotenv
-from rich.console import Console
-
-console = Console()
-# Load in our API keys
-load_dotenv(find_dotenv())
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-console.print(f"[dark_orange]OPENAI_API_KEY: {OPENAI_API_KEY[:14]}...[/]")
+import math
+from functools import lru_cache
+from django.conf import settings
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.utils.cache import patch_vary_headers
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+from asgiref.sync import sync_to_async
+from .models import Conversation, Message
+from .history import build_history
+from django_chatbot import write_behind
+from django_chatbot.htmx import is_htmx
+from _ratelimit import post_with_retry, rate_limit_wait
+from _get_client import get_async_llm_client, get_base_url
+from _retrieval import BM25Index, chunk_documents
+from _prompt import PromptPrefix, assemble_messages, record_usage
+from _instrument import track_llm_call
+from _llm_config import get_llm_config
 
 
 # We add in our own system message
@@ -66,55 +73,210 @@ We will be hosting our sprints at Talbot Hotel Stillorgan. Get ready for an amaz
 Check the map to the venue""",
 ]
 
-# Create the base system message
-system_message += "\n" + "\n".join(FAQ)
+# Only the FAQ chunks relevant to the question are added to the prompt (see _retrieval.py).
+faq_index = BM25Index(chunk_documents(FAQ))
+
+# The system message is the static start of every prompt so the provider can cache it (see _prompt.py).
+prompt_prefix = PromptPrefix(system_message)
+
+
+def get_payload_messages(user_input: str, history: list) -> list:
+    return assemble_messages(
+        prompt_prefix,
+        user_input,
+        history=history,
+        context=faq_index.search(user_input, k=settings.FAQ_TOP_K),
+    )
+
+
+def get_conversation(request, create: bool = False):
+    """
+    The visitor's conversation, remembered in their session.
+    A new one is only created (create=True) when they send their first message.
+    """
+    conversation_id = request.session.get("conversation_id")
+    conversation = None
+    if conversation_id:
+        conversation = Conversation.objects.filter(id=conversation_id).first()
+    if conversation is None and create:
+        if not request.session.session_key:
+            request.session.create()
+        conversation = Conversation.objects.create(
+            user=request.user if request.user.is_authenticated else None,
+            session_key=request.session.session_key,
+        )
+        request.session["conversation_id"] = conversation.id
+    return conversation
+
+
+# Where the per-request parts go in the cached page shell.
+MESSAGES_SLOT = "<!-- chat messages -->"
+CSRF_SLOT = "<!-- csrf input -->"
+
+
+@lru_cache(maxsize=8)
+def _page_shell(path: str) -> tuple:
+    html = render_to_string(
+        "chat.html",
+        {
+            "path": path,
+            "messages_html": mark_safe(MESSAGES_SLOT),
+            "csrf_input": mark_safe(CSRF_SLOT),
+        },
+    )
+    before, rest = html.split(MESSAGES_SLOT)
+    between, after = rest.split(CSRF_SLOT)
+    return before, between, after
+
+
+def page_shell(path: str) -> tuple:
+    """
+    chat.html rendered once per URL and split around the chat messages and the CSRF input,
+    the only parts that change between requests. In DEBUG it is rendered every time so template
+    edits show up without a restart.
+    """
+    if settings.DEBUG:
+        return _page_shell.__wrapped__(path)
+    return _page_shell(path)
+
+
+def render_page(request, messages: list) -> HttpResponse:
+    before, between, after = page_shell(request.path)
+    csrf_input = format_html(
+        '<input type="hidden" name="csrfmiddlewaretoken" value="{}">', get_token(request)
+    )
+    messages_html = render_to_string("chat_messages.html", {"messages": messages})
+    response = HttpResponse(before + messages_html + between + csrf_input + after)
+    patch_vary_headers(response, ["HX-Request"])
+    return response
+
+
+def render_exchange(request, message) -> HttpResponse:
+    """
+    For htmx only the new exchange, which the form appends to #chatbox - a few hundred bytes
+    however long the conversation is, and no history query.
+    """
+    response = HttpResponse(render_to_string("chat_messages.html", {"messages": [message]}))
+    patch_vary_headers(response, ["HX-Request"])
+    return response
+
+
+def rate_limited_response(wait) -> HttpResponse:
+    """The provider's rate limit would keep the user waiting - ask them to try again."""
+    response = HttpResponse(
+        "The assistant is busy right now. Please try again in a few seconds.", status=429
+    )
+    response["Retry-After"] = str(math.ceil(wait))
+    return response
 
 
 def chat_view(request):
+    conversation = get_conversation(request, create=request.method == "POST")
     if request.method == "POST":
         user_message = request.POST.get("message")
-        bot_message = get_ai_response(user_message)
-        Message.objects.create(user_message=user_message, bot_message=bot_message)
-    messages = Message.objects.all()
-    return render(request, "chat.html", {"messages": messages})
+        try:
+            bot_message = get_ai_response(user_message, conversation)
+        except Exception as exc:
+            wait = rate_limit_wait(exc)
+            if wait is None:
+                raise
+            return rate_limited_response(wait)
+        message = Message(
+            conversation=conversation, user_message=user_message, bot_message=bot_message
+        )
+        # Saved now, or batched with other messages when WRITE_BEHIND is enabled
+        write_behind.save(message)
+        if is_htmx(request):
+            return render_exchange(request, message)
+    messages = []
+    if conversation:
+        # Snapshot the buffer first so a row flushed during the query is not missed.
+        pending = write_behind.pending(Message, conversation_id=conversation.id)
+        messages = list(conversation.messages.order_by("timestamp"))
+        messages += write_behind.unsaved(pending, (message.pk for message in messages))
+    return render_page(request, messages)
 
 
-def get_ai_response(user_input: str) -> str:
+# Async version of chat_view for django_chatbot/asgi.py - the LLM call and the ORM are awaited.
+async def chat_view_async(request):
+    conversation = await sync_to_async(get_conversation)(
+        request, create=request.method == "POST"
+    )
+    if request.method == "POST":
+        user_message = request.POST.get("message")
+        try:
+            bot_message = await get_ai_response_async(user_message, conversation)
+        except Exception as exc:
+            wait = rate_limit_wait(exc)
+            if wait is None:
+                raise
+            return rate_limited_response(wait)
+        message = Message(
+            conversation=conversation, user_message=user_message, bot_message=bot_message
+        )
+        await write_behind.asave(message)
+        if is_htmx(request):
+            return render_exchange(request, message)
+    messages = []
+    if conversation:
+        pending = write_behind.pending(Message, conversation_id=conversation.id)
+        messages = [message async for message in conversation.messages.order_by("timestamp")]
+        messages += write_behind.unsaved(pending, (message.pk for message in messages))
+    return render_page(request, messages)
+
+
+def get_ai_response(user_input: str, conversation) -> str:
+    # Provider, model and timeout for this view come from settings.LLM (see _llm_config.py)
+    config = get_llm_config(view="chat_view")
     # Set up the API endpoint and headers for LLM query
-    endpoint = "https://api.openai.com/v1/chat/completions"
+    endpoint = f"{get_base_url(config.provider)}/chat/completions"
     headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Authorization": f"Bearer {config.api_key}",
         "Content-Type": "application/json",
     }
 
-    # Data payload - We get all existing messages from the database
-    messages = get_existing_messages()
-    messages.append(
-        {"role": "user", "content": f"{user_input}"},
-    )
-    messages.append(
-        {"role": "system", "content": system_message},
-    )
-    data = {"model": "gpt-3.5-turbo", "messages": messages, "temperature": 0.7}
+    # Data payload - the static system prefix, then the conversation's recent messages, then the user input
+    messages = get_payload_messages(user_input, get_existing_messages(conversation))
+    data = {"model": config.model, "messages": messages, "temperature": 0.7}
     # Here is our LLM query
-    response = requests.post(endpoint, headers=headers, json=data)
-    response_data = response.json()
+    with track_llm_call(config.provider, data["model"]) as call:
+        # Waits for the provider's shared rate limit and retries 429/5xx, see _ratelimit.py
+        response = post_with_retry(config.provider, endpoint, headers, data, config.timeout)
+        response.raise_for_status()
+        response_data = response.json()
+        call.usage(response_data.get("usage"))
     print(f"{response_data = }")
+    record_usage(prompt_prefix, response_data.get("usage"))
     # We can extract the response
     ai_message = response_data["choices"][0]["message"]["content"]
     return ai_message
 
 
-def get_existing_messages() -> list:
+async def get_ai_response_async(user_input: str, conversation) -> str:
+    # Same payload as get_ai_response, sent with the shared async client.
+    config = get_llm_config(view="chat_view")
+    messages = get_payload_messages(user_input, await aget_existing_messages(conversation))
+    client = get_async_llm_client(config.provider)
+    with track_llm_call(config.provider, config.model) as call:
+        response = await client.chat.completions.create(
+            model=config.model, messages=messages, temperature=0.7, timeout=config.timeout
+        )
+        call.usage(response.usage)
+    record_usage(prompt_prefix, response.usage)
+    ai_message = response.choices[0].message.content
+    return ai_message
+
+
+def get_existing_messages(conversation) -> list:
     """
-    Get all messages from the database and format them for the API in terms of user and assistant messages.
+    Get the conversation's recent messages from the database, plus a rolling summary of older ones, and format them for the API in terms of user and assistant messages.
+    See history.py for the window and budget settings.
     """
-    formatted_messages = []
+    return build_history(conversation)
 
-    for message in Message.objects.values("user_message", "bot_message"):
-        formatted_messages.append({"role": "user", "content": message["user_message"]})
-        formatted_messages.append(
-            {"role": "assistant", "content": message["bot_message"]}
-        )
 
-    return formatted_messages
+async def aget_existing_messages(conversation) -> list:
+    """
+    Async version of get_existing_messages.
+    """
+    return await sync_to_async(build_history)(conversation)
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_chatbot.settings')
+# Persistent connections are for WSGI workers only (see DATABASES in settings.py).
+os.environ.setdefault('DJANGO_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
@@ -0,0 +1,10 @@
+"""
+htmx helpers shared by the chatbot and chatbot_app views.
+
+htmx sends HX-Request: true with every request it makes, so one URL can answer a page for the
+browser and a fragment for htmx. Such responses also need Vary: HX-Request.
+"""
+
+
+def is_htmx(request) -> bool:
+    return request.headers.get("HX-Request") == "true"
@@ -10,11 +10,17 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# The shared LLM helpers (_get_client.py) live in the repository root next to the notebooks.
+if str(BASE_DIR.parent) not in sys.path:
+    sys.path.append(str(BASE_DIR.parent))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
@@ -79,9 +85,98 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Keep each WSGI worker thread's connection for 10 minutes rather than one per request.
+        # asgi.py sets DJANGO_CONN_MAX_AGE=0 - async views run their queries on other threads,
+        # where a persistent connection is not cleaned up at the end of the request.
+        "CONN_MAX_AGE": int(os.getenv("DJANGO_CONN_MAX_AGE", 600)),
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": {
+            # Atomic blocks take the write lock up front, so they wait for busy_timeout
+            # instead of failing with "database is locked" when they first write.
+            "transaction_mode": "IMMEDIATE",
+        },
     }
 }
 
+# Pragmas run on every new SQLite connection, on top of WAL, synchronous=NORMAL, a 5s busy timeout,
+# a 20 MB cache and 256 MB mmap (see django_chatbot/sqlite.py).
+SQLITE_PRAGMAS = {}
+
+
+# LLM
+# The provider, model and timeouts each view uses (see _llm_config.py). VIEWS overrides PROVIDER, MODEL
+# or TIMEOUT for one view. LLM_PROVIDER / LLM_MODEL in the environment override the default.
+# Each provider's default model is in _llm_config.DEFAULTS - add "MODELS" here only to change it.
+LLM = {
+    "PROVIDER": "groq",
+    "TIMEOUT": 60,
+    "CONNECT_TIMEOUT": 5,
+    "VIEWS": {
+        "chatbot_groq": {"PROVIDER": "groq"},
+        "chat_view": {"PROVIDER": "openai"},
+        "history_summary": {"PROVIDER": "openai"},
+    },
+}
+
+# Providers to open a pooled connection to when the server starts, e.g. ["groq", "openai"].
+LLM_WARM_UP = []
+
+# Every LLM call is counted for the /metrics/ endpoint and, with STORE_CALLS, stored as an LLMCall row
+# (see chatbot/metrics.py).
+LLM_METRICS = {
+    "STORE_CALLS": True,
+}
+
+# Send FAQ answers to the view's provider first and hedge to the other provider when it is slow to
+# start answering (later than its p95 time to first token) or fails (see _failover.py).
+LLM_FAILOVER = {
+    "ENABLED": False,
+    "PERCENTILE": 95,
+    "DEFAULT_DELAY": 2.0,
+    "FAILURE_THRESHOLD": 5,
+    "RESET_TIMEOUT": 30,
+}
+
+# Number of FAQ chunks retrieved for each question (see _retrieval.py).
+FAQ_TOP_K = 4
+
+# FAQ answer cache in front of the LLM (see chatbot/cache.py).
+FAQ_CACHE = {
+    "BACKEND": "local",
+    "TTL": 60 * 60,
+    "MAX_ENTRIES": 1000,
+}
+
+# Batch chat transcript INSERTs on a background thread instead of writing them on the request path
+# (see django_chatbot/write_behind.py).
+WRITE_BEHIND = {
+    "ENABLED": False,
+    "MAX_ROWS": 50,
+    "MAX_DELAY": 0.5,
+    "MAX_PENDING": 5000,  # beyond this rows are saved on the request path instead
+    "MAX_RETRIES": 3,  # failed flushes before bad rows are set aside
+}
+
+# Answer chatbot POSTs from a durable job queue in the database - the view returns a job id at once
+# and the page polls for the answer (see chatbot/jobs.py). LOCAL_WORKERS threads in the web process
+# run the jobs - set it to 0 to run them with python manage.py run_chat_jobs instead.
+JOB_QUEUE = {
+    "ENABLED": False,
+    "LOCAL_WORKERS": 4,
+    "LEASE": 120,  # seconds - longer than LLM["TIMEOUT"]
+    "MAX_ATTEMPTS": 3,
+    "RETRY_DELAY": 2.0,
+    "POLL_INTERVAL": 1.0,
+}
+
+# Chats rendered per page of chatbot history - older pages are loaded on scroll (see chatbot/history.py).
+CHAT_PAGE_SIZE = 20
+
+# chatbot_app history window - older turns are folded into a rolling summary (see chatbot_app/history.py).
+CHAT_HISTORY_MAX_TURNS = 10
+CHAT_HISTORY_TOKEN_BUDGET = 2000
+CHAT_HISTORY_SUMMARY_BATCH = 4
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
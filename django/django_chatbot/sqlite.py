@@ -0,0 +1,50 @@
+"""
+SQLite tuned for many concurrent readers and writers on a single node.
+
+Out of the box SQLite uses a rollback journal, so a writer blocks every reader, and Django opens
+a new connection for every request. Under concurrent chats that shows up as "database is locked".
+apply_pragmas() runs on the connection_created signal (connected in ChatbotConfig.ready) and sets:
+
+- journal_mode=WAL: readers no longer wait for the writer, and the writer not for readers
+- synchronous=NORMAL: WAL is fsynced at checkpoints rather than every commit. A power cut can
+  lose the last commits but never corrupts the database
+- busy_timeout: a writer waits for the lock instead of failing straight away
+- cache_size, mmap_size and temp_store: fewer reads from disk and fewer syscalls
+
+The other half of the profile is in settings.DATABASES: CONN_MAX_AGE keeps a connection (and its
+page cache) per worker thread, and transaction_mode=IMMEDIATE takes the write lock when an atomic
+block starts. A deferred transaction that upgrades to a write fails with "database is locked"
+without waiting for busy_timeout.
+
+    SQLITE_PRAGMAS = {"mmap_size": 0}   # override or add pragmas in settings
+
+python manage.py benchmark_sqlite compares the default and tuned profiles.
+"""
+
+from django.conf import settings
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,  # ms
+    "cache_size": -20000,  # negative is KiB, so 20 MB
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+
+def pragmas() -> dict:
+    return {**PRAGMAS, **getattr(settings, "SQLITE_PRAGMAS", {})}
+
+
+def pragma_statements(values: dict) -> list:
+    return [f"PRAGMA {name} = {value}" for name, value in values.items()]
+
+
+def apply_pragmas(sender, connection, **kwargs) -> None:
+    """connection_created receiver - every new SQLite connection gets the profile."""
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for statement in pragma_statements(pragmas()):
+            cursor.execute(statement)
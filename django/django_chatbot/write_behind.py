@@ -0,0 +1,243 @@
+"""
+Optional write-behind persistence for chat transcripts.
+
+Saving a Chat or Message on the request path is a single row INSERT, and on SQLite every writer
+queues for the same lock. With WRITE_BEHIND["ENABLED"] the views hand the unsaved rows to a
+buffer instead, and a background thread writes them in one transaction, with one bulk_create per
+model, as soon as MAX_ROWS rows are waiting or the oldest has waited MAX_DELAY seconds. The
+buffer is flushed when the process exits.
+
+A failed flush is rolled back as a whole and retried. After MAX_RETRIES failures in a row the
+rows are written one at a time, and rows that still cannot be written (e.g. a foreign key to a
+deleted conversation) are logged and set aside in failed, so one bad row cannot wedge the
+buffer. While the database itself is unavailable the rows are kept. Once MAX_PENDING rows are
+waiting, new rows are saved directly on the request path instead of buffered.
+
+Buffered rows are not in the database yet, so views merge pending() into what they read
+to keep read-your-writes for the current user - see unsaved(). auto_now_add timestamps are set
+when the rows are flushed, so they can be up to MAX_DELAY seconds late.
+
+WRITE_BEHIND = {"ENABLED": False, "MAX_ROWS": 50, "MAX_DELAY": 0.5, "MAX_PENDING": 5000,
+                "MAX_RETRIES": 3}
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections, transaction
+
+DEFAULTS = {
+    "ENABLED": False,
+    "MAX_ROWS": 50,
+    "MAX_DELAY": 0.5,
+    "MAX_PENDING": 5000,
+    "MAX_RETRIES": 3,
+}
+
+logger = logging.getLogger(__name__)
+
+
+def forget_pk(row) -> None:
+    # bulk_create sets the pk before its transaction commits - after a rollback it must go again.
+    row.pk = None
+    row._state.adding = True
+
+
+class WriteBehindBuffer:
+    def __init__(
+        self, max_rows: int, max_delay: float, max_pending: int = 5000, max_retries: int = 3
+    ) -> None:
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        # Rows that could not be written even on their own, most recent last.
+        self.failed = deque(maxlen=max_pending)
+        self._rows: list = []
+        self._first_added = 0.0
+        self._failures = 0
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def add(self, obj) -> bool:
+        """Buffer obj. False when MAX_PENDING rows are waiting - the caller saves it instead."""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Write-behind buffer is closed")
+            if len(self._rows) >= self.max_pending:
+                return False
+            if not self._rows:
+                self._first_added = time.monotonic()
+            self._rows.append(obj)
+            # Wake the flusher to start the MAX_DELAY clock, or to flush a full buffer.
+            if len(self._rows) == 1 or len(self._rows) >= self.max_rows:
+                self._condition.notify()
+        return True
+
+    def pending(self, model, **filters) -> list:
+        """Buffered rows of model whose attributes equal filters, oldest first."""
+        with self._condition:
+            rows = list(self._rows)
+        return [
+            row
+            for row in rows
+            if type(row) is model
+            and all(getattr(row, name) == value for name, value in filters.items())
+        ]
+
+    def flush(self) -> None:
+        # One flush at a time. Rows stay in the buffer, visible to pending(), until they are in the database.
+        with self._flush_lock:
+            with self._condition:
+                rows = list(self._rows)
+            if not rows:
+                return
+            close_old_connections()
+            try:
+                self._write(rows)
+            except Exception:
+                for row in rows:
+                    forget_pk(row)
+                self._failures += 1
+                if self._failures < self.max_retries:
+                    raise
+                logger.exception(
+                    "Write-behind flush failed %d times - writing %d rows one at a time",
+                    self._failures,
+                    len(rows),
+                )
+                self._write_each(rows)
+            self._failures = 0
+            self._remove(len(rows))
+
+    def _write(self, rows: list) -> None:
+        by_model: dict = {}
+        for row in rows:
+            by_model.setdefault(type(row), []).append(row)
+        with transaction.atomic():
+            for model, model_rows in by_model.items():
+                model.objects.bulk_create(model_rows)
+
+    def _write_each(self, rows: list) -> None:
+        for done, row in enumerate(rows):
+            try:
+                with transaction.atomic():
+                    type(row).objects.bulk_create([row])
+            except (OperationalError, InterfaceError):
+                # The database is locked or unavailable rather than the row being bad - keep
+                # the rest for the next flush.
+                forget_pk(row)
+                self._remove(done)
+                raise
+            except Exception:
+                forget_pk(row)
+                self.failed.append(row)
+                logger.exception(
+                    "Write-behind set aside a %s it could not write", type(row).__name__
+                )
+
+    def _remove(self, count: int) -> None:
+        with self._condition:
+            del self._rows[:count]
+            if self._rows:
+                self._first_added = time.monotonic()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._closed:
+                    if len(self._rows) >= self.max_rows:
+                        break
+                    if self._rows:
+                        wait = self._first_added + self.max_delay - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self._condition.wait(wait)
+                    else:
+                        self._condition.wait()
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception:
+                # Keep the rows and try again on the next tick rather than lose them - or in
+                # close() when closing.
+                logger.warning("Write-behind flush failed, retrying", exc_info=True)
+                if not closed:
+                    time.sleep(self.max_delay)
+            if closed:
+                return
+
+    def close(self) -> None:
+        """Stop the background thread and write everything still buffered."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Write-behind lost %d rows at shutdown", len(self._rows))
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def config() -> dict:
+    return {**DEFAULTS, **getattr(settings, "WRITE_BEHIND", {})}
+
+
+def get_buffer():
+    """The process wide buffer, or None when write-behind is disabled."""
+    global _buffer
+    if not config()["ENABLED"]:
+        return None
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                options = config()
+                _buffer = WriteBehindBuffer(
+                    options["MAX_ROWS"],
+                    options["MAX_DELAY"],
+                    options["MAX_PENDING"],
+                    options["MAX_RETRIES"],
+                )
+                atexit.register(_buffer.close)
+    return _buffer
+
+
+def save(obj) -> None:
+    """Save obj now, or buffer it when write-behind is enabled."""
+    buffer = get_buffer()
+    if buffer is None or not buffer.add(obj):
+        obj.save()
+
+
+async def asave(obj) -> None:
+    """Async version of save - buffering never blocks so only the direct save is awaited."""
+    buffer = get_buffer()
+    if buffer is None or not buffer.add(obj):
+        await obj.asave()
+
+
+def pending(model, **filters) -> list:
+    buffer = get_buffer()
+    return buffer.pending(model, **filters) if buffer else []
+
+
+def unsaved(pending_rows: list, saved_ids) -> list:
+    """
+    The rows of a pending() snapshot that are not among saved_ids, the ids a query returned.
+
+    Take the snapshot before the query: a row flushed in between is then in the query and
+    dropped here (bulk_create has set its pk), and a row flushed after the query is kept.
+    """
+    saved_ids = set(saved_ids)
+    return [row for row in pending_rows if row.pk is None or row.pk not in saved_ids]